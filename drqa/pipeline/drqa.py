@@ -7,8 +7,8 @@
 """Full DrQA pipeline."""
 
 import torch
-import regex
 import heapq
+import functools
 import math
 import time
 import logging
@@ -16,8 +16,8 @@ import logging
 from multiprocessing import Pool as ProcessPool
 from multiprocessing.util import Finalize
 
-from ..reader.vector import batchify
-from ..reader.data import ReaderDataset, SortedBatchSampler
+from ..reader.vector import batchify, BatchBuffers
+from ..reader.data import ReaderDataset, SortedBatchSampler, CandidateIndex
 from .. import reader
 from .. import tokenizers
 from . import DEFAULTS
@@ -40,7 +40,7 @@ def init(tokenizer_class, tokenizer_opts, db_class, db_opts, candidates=None):
     Finalize(PROCESS_TOK, PROCESS_TOK.shutdown, exitpriority=100)
     PROCESS_DB = db_class(**db_opts)
     Finalize(PROCESS_DB, PROCESS_DB.close, exitpriority=100)
-    PROCESS_CANDS = candidates
+    PROCESS_CANDS = CandidateIndex(candidates) if candidates else None
 
 
 def fetch_text(doc_id):
@@ -48,6 +48,16 @@ def fetch_text(doc_id):
     return PROCESS_DB.get_doc_text(doc_id)
 
 
+def fetch_texts(doc_ids):
+    global PROCESS_DB
+    return PROCESS_DB.get_doc_texts(doc_ids)
+
+
+def fetch_paragraphs(doc_ids):
+    global PROCESS_DB
+    return PROCESS_DB.get_doc_paragraphs(doc_ids)
+
+
 def tokenize_text(text):
     global PROCESS_TOK
     return PROCESS_TOK.tokenize(text)
@@ -64,6 +74,9 @@ class DrQA(object):
     # infty = read all paragraphs together
     GROUP_LENGTH = 0
 
+    # Number of docs fetched from the db per worker task.
+    FETCH_BATCH_SIZE = 500
+
     def __init__(
             self,
             reader_model=None,
@@ -76,7 +89,10 @@ class DrQA(object):
             max_loaders=5,
             num_workers=None,
             db_config=None,
-            ranker_config=None
+            ranker_config=None,
+            tokenizer_cache=None,
+            token_store=None,
+            feature_store=None
     ):
         """Initialize the pipeline.
 
@@ -96,6 +112,13 @@ class DrQA(object):
               and post processing resuls.
             db_config: config for doc db.
             ranker_config: config for ranker.
+            tokenizer_cache: if given, path to an on-disk cache of tokenized
+              texts shared by all workers (see CachedTokenizer).
+            token_store: if given, path to a store of the pre-tokenized
+              paragraphs of the db (see build_token_store.py). Only the
+              paragraphs missing from it are tokenized.
+            feature_store: if given, path to the precomputed reader inputs of
+              the token store paragraphs (see build_feature_store.py).
         """
         self.batch_size = batch_size
         self.max_loaders = max_loaders
@@ -120,6 +143,7 @@ class DrQA(object):
             self.reader.cuda()
         if data_parallel:
             self.reader.parallelize()
+        self.buffers = BatchBuffers(pin_memory=cuda)
 
         if not tokenizer:
             tok_class = DEFAULTS['tokenizer']
@@ -127,6 +151,27 @@ class DrQA(object):
             tok_class = tokenizers.get_class(tokenizer)
         annotators = tokenizers.get_annotators_for_model(self.reader)
         tok_opts = {'annotators': annotators}
+        if tokenizer_cache:
+            tok_opts.update({'tokenizer_class': tok_class,
+                             'cache_path': tokenizer_cache})
+            tok_class = tokenizers.CachedTokenizer
+
+        self.token_store = None
+        if token_store:
+            logger.info('Loading token store %s' % token_store)
+            self.token_store = tokenizers.TokenStore(token_store)
+            self.token_store.check(
+                annotators, tok_opts.get('tokenizer_class', tok_class)
+            )
+
+        self.feature_store = None
+        if feature_store:
+            if self.token_store is None:
+                raise RuntimeError('A feature store needs a token store')
+            logger.info('Loading feature store %s' % feature_store)
+            self.feature_store = reader.FeatureStore(feature_store,
+                                                     self.token_store)
+            self.feature_store.check(self.reader)
 
         # ElasticSearch is also used as backend if used as ranker
         if hasattr(self.ranker, 'es'):
@@ -146,14 +191,11 @@ class DrQA(object):
             initargs=(tok_class, tok_opts, db_class, db_opts, fixed_candidates)
         )
 
-    def _split_doc(self, doc):
-        """Given a doc, split it into chunks (by paragraph)."""
+    def _group_paragraphs(self, paragraphs):
+        """Given the paragraphs of a doc, group them into chunks."""
         curr = []
         curr_len = 0
-        for split in regex.split(r'\n+', doc):
-            split = split.strip()
-            if len(split) == 0:
-                continue
+        for split in paragraphs:
             # Maybe group paragraphs together until we hit a length limit
             if len(curr) > 0 and curr_len + len(split) > self.GROUP_LENGTH:
                 yield ' '.join(curr)
@@ -172,12 +214,17 @@ class DrQA(object):
             self.batch_size,
             shuffle=False
         )
+        # Batches made in this process are used one at a time (the reader
+        # is done with a batch when predict returns): reuse their tensors.
+        collate_fn = batchify
+        if num_loaders == 0:
+            collate_fn = functools.partial(batchify, buffers=self.buffers)
         loader = torch.utils.data.DataLoader(
             dataset,
             batch_size=self.batch_size,
             sampler=sampler,
             num_workers=num_loaders,
-            collate_fn=batchify,
+            collate_fn=collate_fn,
             pin_memory=self.cuda,
         )
         return loader
@@ -207,28 +254,46 @@ class DrQA(object):
             )
         all_docids, all_doc_scores = zip(*ranked)
 
-        # Flatten document ids and retrieve text from database.
+        # Flatten document ids and retrieve paragraphs from database.
         # We remove duplicates for processing efficiency.
         flat_docids = list({d for docids in all_docids for d in docids})
         did2didx = {did: didx for didx, did in enumerate(flat_docids)}
-        doc_texts = self.processes.map(fetch_text, flat_docids)
+        step = self.FETCH_BATCH_SIZE
+        doc_paragraphs = self.processes.map(
+            fetch_paragraphs,
+            [flat_docids[i:i + step] for i in range(0, len(flat_docids), step)]
+        )
+        doc_paragraphs = [p for paragraphs in doc_paragraphs
+                          for p in paragraphs]
 
-        # Split and flatten documents. Maintain a mapping from doc (index in
+        # Group and flatten paragraphs. Maintain a mapping from doc (index in
         # flat list) to split (index in flat list).
         flat_splits = []
         didx2sidx = []
-        for text in doc_texts:
-            splits = self._split_doc(text)
+        for paragraphs in doc_paragraphs:
+            splits = self._group_paragraphs(paragraphs)
             didx2sidx.append([len(flat_splits), -1])
             for split in splits:
                 flat_splits.append(split)
             didx2sidx[-1][1] = len(flat_splits)
 
-        # Push through the tokenizers as fast as possible.
+        # Push through the tokenizers as fast as possible. Paragraphs are
+        # looked up in the token store first, if any.
         q_tokens = self.processes.map_async(tokenize_text, queries)
-        s_tokens = self.processes.map_async(tokenize_text, flat_splits)
+        if self.token_store is not None:
+            s_tokens = self.token_store.lookup(
+                flat_splits, lambda texts: self.processes.map(tokenize_text,
+                                                              texts)
+            )
+        else:
+            s_tokens = self.processes.map_async(tokenize_text, flat_splits)
+            s_tokens = s_tokens.get()
         q_tokens = q_tokens.get()
-        s_tokens = s_tokens.get()
+
+        # Precomputed reader inputs of the paragraphs, if any.
+        s_stored = [None] * len(flat_splits)
+        if self.feature_store is not None:
+            s_stored = [self.feature_store.get(s) for s in flat_splits]
 
         # Group into structured example inputs. Examples' ids represent
         # mappings to their question, document, and split ids.
@@ -239,7 +304,7 @@ class DrQA(object):
                 for sidx in range(start, end):
                     if (len(q_tokens[qidx].words()) > 0 and
                             len(s_tokens[sidx].words()) > 0):
-                        examples.append({
+                        ex = {
                             'id': (qidx, rel_didx, sidx),
                             'question': q_tokens[qidx].words(),
                             'qlemma': q_tokens[qidx].lemmas(),
@@ -247,7 +312,10 @@ class DrQA(object):
                             'lemma': s_tokens[sidx].lemmas(),
                             'pos': s_tokens[sidx].pos(),
                             'ner': s_tokens[sidx].entities(),
-                        })
+                        }
+                        if s_stored[sidx] is not None:
+                            ex['stored'] = s_stored[sidx]
+                        examples.append(ex)
 
         logger.info('Reading %d paragraphs...' % len(examples))
 
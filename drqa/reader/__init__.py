@@ -22,6 +22,8 @@ def set_default(key, value):
 
 from .model import DocReader
 from .predictor import Predictor
+from .feature_store import FeatureStore
+from .example_store import ExampleStore
 from . import config
 from . import vector
 from . import data
@@ -23,7 +23,7 @@ MODEL_ARCHITECTURE = {
 MODEL_OPTIMIZER = {
     'fix_embeddings', 'optimizer', 'learning_rate', 'momentum', 'weight_decay',
     'rnn_padding', 'dropout_rnn', 'dropout_rnn_output', 'dropout_emb',
-    'max_len', 'grad_clipping', 'tune_partial'
+    'max_len', 'grad_clipping', 'tune_partial', 'vocab_arrays'
 }
 
 
@@ -96,6 +96,8 @@ def add_model_args(parser):
                        help='Explicitly account for padding in RNN encoding')
     optim.add_argument('--max-len', type=int, default=15,
                        help='The max span allowed during decoding')
+    optim.add_argument('--vocab-arrays', type='bool', default=False,
+                       help='Save the word dictionary as arrays (smaller)')
 
 
 def get_model_args(args):
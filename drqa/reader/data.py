@@ -7,6 +7,8 @@
 """Data processing/loading helpers."""
 
 import numpy as np
+import bisect
+import functools
 import logging
 import unicodedata
 
@@ -27,7 +29,11 @@ class Dictionary(object):
     UNK = '<UNK>'
     START = 2
 
+    # Number of normalized tokens memoized (per process).
+    NORMALIZE_CACHE_SIZE = 2 ** 18
+
     @staticmethod
+    @functools.lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
     def normalize(token):
         return unicodedata.normalize('NFD', token)
 
@@ -35,6 +41,28 @@ class Dictionary(object):
         self.tok2ind = {self.NULL: 0, self.UNK: 1}
         self.ind2tok = {0: self.NULL, 1: self.UNK}
 
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Build a dictionary from its array form (see to_arrays)."""
+        data, offsets = arrays['data'].tobytes(), arrays['offsets']
+        dictionary = cls()
+        dictionary.ind2tok = {
+            i: data[offsets[i]:offsets[i + 1]].decode('utf-8')
+            for i in range(len(offsets) - 1)
+        }
+        dictionary.tok2ind = {t: i for i, t in dictionary.ind2tok.items()}
+        return dictionary
+
+    def to_arrays(self):
+        """Compact form of the dictionary: the utf-8 bytes of all tokens,
+        concatenated in index order, and their offsets.
+        """
+        encoded = [self.ind2tok[i].encode('utf-8') for i in range(len(self))]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        return {'data': np.frombuffer(b''.join(encoded), dtype=np.uint8),
+                'offsets': offsets}
+
     def __len__(self):
         return len(self.tok2ind)
 
@@ -48,11 +76,11 @@ class Dictionary(object):
             return self.normalize(key) in self.tok2ind
 
     def __getitem__(self, key):
-        if type(key) == int:
-            return self.ind2tok.get(key, self.UNK)
         if type(key) == str:
             return self.tok2ind.get(self.normalize(key),
                                     self.tok2ind.get(self.UNK))
+        if type(key) == int:
+            return self.ind2tok.get(key, self.UNK)
 
     def __setitem__(self, key, item):
         if type(key) == int and type(item) == str:
@@ -62,6 +90,13 @@ class Dictionary(object):
         else:
             raise RuntimeError('Invalid (key, item) types.')
 
+    def encode(self, tokens):
+        """Indices of a list of tokens, as an int32 array."""
+        get, normalize = self.tok2ind.get, self.normalize
+        unk = self.tok2ind.get(self.UNK)
+        return np.fromiter((get(normalize(t), unk) for t in tokens),
+                           dtype=np.int32, count=len(tokens))
+
     def add(self, token):
         token = self.normalize(token)
         if token not in self.tok2ind:
@@ -80,6 +115,66 @@ class Dictionary(object):
         return tokens
 
 
+# ------------------------------------------------------------------------------
+# Index of candidate answers.
+# ------------------------------------------------------------------------------
+
+
+class CandidateIndex(object):
+    """Index of candidate answer strings.
+
+    Candidates are also kept sorted, so that prefix queries are a binary
+    search. Spans of a document can then be grown token by token and abandoned
+    as soon as no candidate starts with their text.
+    """
+
+    def __init__(self, candidates):
+        self.candidates = set(candidates)
+        self.sorted = sorted(self.candidates)
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def __contains__(self, text):
+        return text in self.candidates
+
+    def has_prefix(self, prefix):
+        """Return True if some candidate starts with prefix."""
+        i = bisect.bisect_left(self.sorted, prefix)
+        return i < len(self.sorted) and self.sorted[i].startswith(prefix)
+
+    def find(self, tokens, max_len=None):
+        """Find all spans of tokens whose text (or lower cased text) is a
+        candidate.
+
+        Args:
+            tokens: Tokens to search.
+            max_len: max span length (in tokens) to consider.
+        Output:
+            spans: list of (start, end) token indices, end exclusive, in the
+              same order as tokens.ngrams.
+        """
+        n = len(tokens)
+        max_len = max_len or n
+        texts_ws = [t[tokens.TEXT_WS] for t in tokens.data]
+        # The text of a span ending at a token is untokenized like the token
+        # alone (e.g. with its trailing whitespace stripped)
+        texts_end = [tokens.slice(i, i + 1).untokenize() for i in range(n)]
+
+        spans = []
+        for s in range(n):
+            prefix = ''
+            for e in range(s + 1, min(s + max_len, n) + 1):
+                span = prefix + texts_end[e - 1]
+                if span in self.candidates or span.lower() in self.candidates:
+                    spans.append((s, e))
+                prefix += texts_ws[e - 1]
+                if not (self.has_prefix(prefix) or
+                        self.has_prefix(prefix.lower())):
+                    break
+        return spans
+
+
 # ------------------------------------------------------------------------------
 # PyTorch dataset class for SQuAD (and SQuAD-like) data.
 # ------------------------------------------------------------------------------
@@ -99,6 +194,9 @@ class ReaderDataset(Dataset):
         return vectorize(self.examples[index], self.model, self.single_answer)
 
     def lengths(self):
+        if hasattr(self.examples, 'lengths'):
+            # ExampleStore: read from the arrays, without decoding examples.
+            return self.examples.lengths()
         return [(len(ex['document']), len(ex['question']))
                 for ex in self.examples]
 
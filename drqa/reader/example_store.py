@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Binary, memory-mapped preprocessed examples (the output of
+scripts/reader/preprocess.py and scripts/shinra/preprocess.py with
+--format binary, or of scripts/reader/convert_processed.py).
+
+Contexts shared by several questions are stored once. An example store is a
+directory holding:
+
+* context_offsets.npy: first token of each context (plus the final end).
+* document.npy, lemma.npy, pos.npy, ner.npy: string ids of the context
+  tokens (-1 for None). Annotations are only stored if present.
+* offsets.npy: (begin, end) character offsets of the context tokens.
+* contexts.npy: context of each question.
+* question_offsets.npy: first token of each question (plus the final end).
+* question.npy, qlemma.npy: string ids of the question tokens.
+* ids.npy: string id of the id of each question.
+* answer_index.npy, answers.npy: first answer of each question (plus the
+  final end), and (start, end) token offsets of each answer.
+* string_data.npy, string_offsets.npy: utf-8 bytes of all distinct strings.
+* metadata.json: stored fields and sizes.
+
+Examples are only decoded when indexed: see ExampleStore.
+"""
+
+import functools
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from ..tokenizers.token_store import text_key, text_check, bin_to_npy
+
+# Token string fields of contexts and questions.
+CONTEXT_FIELDS = ['document', 'lemma', 'pos', 'ner']
+QUESTION_FIELDS = ['question', 'qlemma']
+
+
+def answer_offsets(answers, length):
+    """The 'answer_offsets' of a multiple answer example: 1 for each of its
+    length document tokens inside one of its (start, end) answers, else 0.
+    """
+    flags = np.zeros(length, dtype=np.int64)
+    for start, end in answers:
+        flags[start:end + 1] = 1
+    return flags.tolist()
+
+
+class ExampleStore(object):
+    """Read only, memory-mapped sequence of preprocessed examples.
+
+    Indexing returns the same dict as a line of the JSON lines format.
+    """
+
+    # Number of decoded strings kept in memory.
+    STRING_CACHE_SIZE = 2 ** 20
+
+    def __init__(self, path, uncased_question=False, uncased_doc=False):
+        """
+        Args:
+            path: path to the example store directory.
+            uncased_question: lower case question words.
+            uncased_doc: lower case document words.
+        """
+        self.path = path
+        self.uncased_question = uncased_question
+        self.uncased_doc = uncased_doc
+        self.indices = None
+        self._open()
+
+    def _open(self):
+        """Load the metadata and memory-map the arrays."""
+        with open(os.path.join(self.path, 'metadata.json')) as f:
+            self.metadata = json.load(f)
+
+        def load(name):
+            return np.load(os.path.join(self.path, name + '.npy'),
+                           mmap_mode='r')
+
+        self.fields = {name: load(name) for name in
+                       self.metadata['context_fields'] +
+                       self.metadata['question_fields']}
+        self.context_offsets = load('context_offsets')
+        self.offsets = load('offsets')
+        self.contexts = load('contexts')
+        self.question_offsets = load('question_offsets')
+        self.ids = load('ids')
+        self.answer_index = load('answer_index')
+        self.answers = load('answers')
+        self.string_data = load('string_data')
+        self.string_offsets = load('string_offsets')
+        self.string = functools.lru_cache(self.STRING_CACHE_SIZE)(self._string)
+
+    def __getstate__(self):
+        # Only pickle the options (e.g. for DataLoader workers): the arrays
+        # are memory-mapped again, and the string cache rebuilt, on unpickling.
+        return {'path': self.path, 'uncased_question': self.uncased_question,
+                'uncased_doc': self.uncased_doc, 'indices': self.indices}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        if self.indices is not None:
+            return len(self.indices)
+        return len(self.contexts)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def _string(self, string_id):
+        if string_id < 0:
+            return None
+        start = self.string_offsets[string_id]
+        end = self.string_offsets[string_id + 1]
+        return self.string_data[start:end].tobytes().decode('utf-8')
+
+    def _strings(self, name, start, end):
+        return [self.string(i) for i in self.fields[name][start:end].tolist()]
+
+    def __getitem__(self, index):
+        if self.indices is not None:
+            index = self.indices[index]
+        context = self.contexts[index]
+        c_start = self.context_offsets[context]
+        c_end = self.context_offsets[context + 1]
+        q_start = self.question_offsets[index]
+        q_end = self.question_offsets[index + 1]
+        a_start = self.answer_index[index]
+        a_end = self.answer_index[index + 1]
+
+        ex = {'id': self.string(int(self.ids[index]))}
+        for name in QUESTION_FIELDS:
+            ex[name] = (self._strings(name, q_start, q_end)
+                        if name in self.fields else None)
+        for name in CONTEXT_FIELDS:
+            ex[name] = (self._strings(name, c_start, c_end)
+                        if name in self.fields else None)
+        ex['offsets'] = self.offsets[c_start:c_end].tolist()
+        ex['answers'] = self.answers[a_start:a_end].tolist()
+        if self.metadata['answer_offsets']:
+            ex['answer_offsets'] = answer_offsets(ex['answers'],
+                                                  c_end - c_start)
+
+        if self.uncased_question:
+            ex['question'] = [w.lower() for w in ex['question']]
+        if self.uncased_doc:
+            ex['document'] = [w.lower() for w in ex['document']]
+        return ex
+
+    def _selected(self, array):
+        return array if self.indices is None else array[self.indices]
+
+    def lengths(self):
+        """(document, question) length of each example, without decoding."""
+        doc_lengths = np.diff(self.context_offsets)[self.contexts]
+        question_lengths = np.diff(self.question_offsets)
+        return np.stack([self._selected(doc_lengths),
+                         self._selected(question_lengths)], 1)
+
+    def num_answers(self):
+        """Number of answers of each example."""
+        return self._selected(np.diff(self.answer_index))
+
+    def subset(self, indices):
+        """Return a view of the examples at indices (sharing the arrays)."""
+        view = object.__new__(type(self))
+        view.__dict__.update(self.__dict__)
+        view.indices = np.asarray(
+            indices if self.indices is None else self.indices[indices],
+            dtype=np.int64
+        )
+        return view
+
+
+class ExampleStoreWriter(object):
+    """Writes an example store, streaming token columns to disk.
+
+    Only the string table and the context keys are kept in memory. Examples
+    are added in the JSON lines format: contexts written once, with a
+    'context_id' (see drqa.reader.utils.read_examples), are stored once. The
+    contexts of full examples are deduplicated by a hash of their content.
+    """
+
+    # Columns are flushed to disk every so many values.
+    FLUSH_SIZE = 2 ** 20
+
+    def __init__(self, path):
+        """
+        Args:
+            path: path to the example store directory. It is written in a
+              temporary directory, moved there on close (replacing any
+              previous example store).
+        """
+        if os.path.exists(path) and not ExampleStoreWriter.is_store(path):
+            raise RuntimeError('%s exists and is not an example store' % path)
+        self.final_path = path
+        self.path = tempfile.mkdtemp(
+            prefix='.%s.' % os.path.basename(os.path.normpath(path)),
+            dir=os.path.dirname(os.path.abspath(path))
+        )
+        self.context_fields = None
+        self.question_fields = None
+        self.answer_offsets = None
+        self.context_ids = {}
+        self.context_keys = {}
+        self.context_offsets = [0]
+        self.question_offsets = [0]
+        self.answer_index = [0]
+        self.strings = {}
+        self.columns = {}
+        self.files = {}
+        self.buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            for f in self.files.values():
+                f.close()
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    @staticmethod
+    def is_store(path):
+        return os.path.isfile(os.path.join(path, 'metadata.json'))
+
+    @property
+    def num_examples(self):
+        return len(self.question_offsets) - 1
+
+    @property
+    def num_contexts(self):
+        return len(self.context_offsets) - 1
+
+    def _string_id(self, string):
+        if string is None:
+            return -1
+        return self.strings.setdefault(string, len(self.strings))
+
+    def _extend(self, name, values):
+        self.columns.setdefault(name, []).extend(values)
+
+    def _add_context(self, ex):
+        """Store the context of ex and return its id."""
+        if self.context_fields is None:
+            self.context_fields = [name for name in CONTEXT_FIELDS
+                                   if ex.get(name) is not None]
+            self.answer_offsets = 'answer_offsets' in ex
+        for name in self.context_fields:
+            self._extend(name, map(self._string_id, ex[name]))
+        self._extend('offsets',
+                     (value for offset in ex['offsets'] for value in offset))
+        self.context_offsets.append(self.context_offsets[-1] +
+                                    len(ex['document']))
+        self.buffered += len(ex['document'])
+        return self.num_contexts - 1
+
+    def _context(self, ex):
+        """Id of the context of a full example, adding it if it is new.
+
+        Contexts match on two independent 64 bit hashes of their content,
+        and their length.
+        """
+        data = json.dumps([ex.get(name) for name in
+                           CONTEXT_FIELDS + ['offsets']])
+        key = (text_key(data), text_check(data))
+        if key in self.context_keys:
+            context = self.context_keys[key]
+            length = (self.context_offsets[context + 1] -
+                      self.context_offsets[context])
+            if length == len(ex['document']):
+                return context
+        context = self._add_context(ex)
+        self.context_keys.setdefault(key, context)
+        return context
+
+    def add(self, ex):
+        """Add a preprocessed example, or a context with a 'context_id' (as
+        yielded by process_dataset).
+        """
+        if 'id' not in ex:
+            self.context_ids[ex['context_id']] = self._add_context(ex)
+            return
+        if 'context_id' in ex:
+            context = self.context_ids[ex['context_id']]
+        else:
+            context = self._context(ex)
+        if self.question_fields is None:
+            self.question_fields = [name for name in QUESTION_FIELDS
+                                    if ex.get(name) is not None]
+        self._extend('contexts', [context])
+        for name in self.question_fields:
+            self._extend(name, map(self._string_id, ex[name]))
+        self.question_offsets.append(self.question_offsets[-1] +
+                                     len(ex['question']))
+        self._extend('ids', [self._string_id(ex['id'])])
+        for start, end in ex['answers']:
+            self._extend('answers', (start, end))
+        self.answer_index.append(self.answer_index[-1] + len(ex['answers']))
+        self.buffered += len(ex['question'])
+        if self.buffered >= self.FLUSH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        for name, values in self.columns.items():
+            if name not in self.files:
+                self.files[name] = open(
+                    os.path.join(self.path, name + '.bin'), 'wb'
+                )
+            self.files[name].write(np.array(values, dtype=np.int32).tobytes())
+            values.clear()
+        self.buffered = 0
+
+    def close(self):
+        """Write the remaining columns, string table and metadata."""
+        self.context_fields = self.context_fields or []
+        self.question_fields = self.question_fields or []
+        self.answer_offsets = bool(self.answer_offsets)
+        # Store empty columns too.
+        for name in (self.context_fields + self.question_fields +
+                     ['offsets', 'contexts', 'ids', 'answers']):
+            self.columns.setdefault(name, [])
+        self._flush()
+        for name, f in self.files.items():
+            f.close()
+            bin_to_npy(self.path, name,
+                       2 if name in ('offsets', 'answers') else None)
+
+        def save(name, array):
+            np.save(os.path.join(self.path, name + '.npy'), array)
+
+        save('context_offsets', np.array(self.context_offsets, dtype=np.int64))
+        save('question_offsets',
+             np.array(self.question_offsets, dtype=np.int64))
+        save('answer_index', np.array(self.answer_index, dtype=np.int64))
+
+        encoded = [s.encode('utf-8') for s in self.strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        save('string_data', np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        save('string_offsets', offsets)
+
+        metadata = {
+            'context_fields': self.context_fields,
+            'question_fields': self.question_fields,
+            'answer_offsets': self.answer_offsets,
+            'num_examples': self.num_examples,
+            'num_contexts': self.num_contexts,
+            'num_strings': len(encoded),
+        }
+        with open(os.path.join(self.path, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
+
+        # mkdtemp makes the directory private: use the default permissions
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(self.path, 0o777 & ~umask)
+        if os.path.exists(self.final_path):
+            shutil.rmtree(self.final_path)
+        os.rename(self.path, self.final_path)
+        self.path = self.final_path
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Precomputed model inputs of pre-tokenized texts (see
+scripts/reader/build_feature_store.py).
+
+A feature store extends a token store (see drqa.tokenizers.TokenStore) with
+the question independent inputs of a model, aligned with the tokens of the
+store:
+
+* word_ids.npy: word_dict index of each token.
+* pos.npy, ner.npy: feature_dict index of the 'pos=' and 'ner=' feature of
+  each token (-1 if none).
+* tf.npy: term frequency feature of each token.
+* string_hashes.npy, lower_hashes.npy: hash of each string of the token store
+  (and of its lower cased version), for in_question features. The last one
+  is that of None (string id -1).
+* metadata.json: fingerprint of the model dictionaries it was built for.
+
+Only the in_question features are left to compute for each question.
+"""
+
+import hashlib
+import json
+import os
+import numpy as np
+
+from ..tokenizers import TokenStore
+from ..tokenizers.tokenizer import Tokens
+from ..tokenizers.token_store import text_key
+
+
+def fingerprint(model):
+    """Hash of everything the stored inputs depend on in a model."""
+    args = model.args
+    h = hashlib.sha1()
+    h.update(json.dumps([args.use_pos, args.use_ner, args.use_tf]).encode())
+    for i in range(len(model.word_dict)):
+        h.update(model.word_dict[i].encode('utf-8'))
+        h.update(b'\0')
+    h.update(json.dumps(sorted(model.feature_dict.items())).encode('utf-8'))
+    return h.hexdigest()
+
+
+def hash_words(words):
+    """Hashes of words, comparable to the stored string hashes (None is 0)."""
+    return np.array([text_key(w) if w is not None else 0 for w in words],
+                    dtype=np.uint64)
+
+
+class FeatureStore(object):
+    """Read only, memory-mapped store of model inputs, keyed by text."""
+
+    def __init__(self, path, token_store=None):
+        """
+        Args:
+            path: path to the feature store directory.
+            token_store: the token store it was built from (TokenStore or
+              path, default: the one recorded in the metadata).
+        """
+        self.path = path
+        with open(os.path.join(path, 'metadata.json')) as f:
+            self.metadata = json.load(f)
+        token_store = token_store or self.metadata['token_store']
+        if not isinstance(token_store, TokenStore):
+            token_store = TokenStore(token_store)
+        self.token_store = token_store
+
+        def load(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+        self.word_ids = load('word_ids')
+        self.pos = load('pos')
+        self.ner = load('ner')
+        self.tf = load('tf')
+        self.string_hashes = load('string_hashes')
+        self.lower_hashes = load('lower_hashes')
+        if len(self.word_ids) != len(self.token_store.spans):
+            raise RuntimeError('%s does not match the token store %s' %
+                               (path, self.token_store.path))
+
+    def check(self, model):
+        """Raise an error if the store was built for other dictionaries."""
+        if fingerprint(model) != self.metadata['fingerprint']:
+            raise RuntimeError('Feature store %s was built for another '
+                               'word_dict/feature_dict' % self.path)
+
+    def get(self, text):
+        """Return the stored inputs of text (a dict of arrays), or None.
+
+        The arrays are copies, not views of the read only memory maps.
+        """
+        entry = self.token_store.index(text)
+        if entry is None:
+            return None
+        start = self.token_store.entry_offsets[entry]
+        end = self.token_store.entry_offsets[entry + 1]
+        fields = dict(self.token_store.fields)
+        words = fields[Tokens.TEXT][start:end]
+        stored = {
+            'word_ids': np.array(self.word_ids[start:end]),
+            'pos': np.array(self.pos[start:end]),
+            'ner': np.array(self.ner[start:end]),
+            'tf': np.array(self.tf[start:end]),
+            'word_hashes': self.string_hashes[words],
+            'uncased_hashes': self.lower_hashes[words],
+        }
+        if Tokens.LEMMA in fields:
+            lemmas = fields[Tokens.LEMMA][start:end]
+            stored['lemma_hashes'] = self.string_hashes[lemmas]
+        return stored
@@ -15,6 +15,7 @@ import logging
 import copy
 
 from .config import override_model_args
+from .data import CandidateIndex, Dictionary
 from .rnn_reader import RnnDocReader
 
 logger = logging.getLogger(__name__)
@@ -301,28 +302,62 @@ class DocReader(object):
         else:
             inputs = [e for e in ex[:5]]
         
+        # Run forward
+        with torch.no_grad():
+            scores = self.network(*inputs)
+
+        return self._decode(scores, candidates, top_n, threshold, async_pool)
+
+    def predict_multi(self, ex, candidates=None, top_n=1, threshold=0.5,
+                      async_pool=None):
+        """Forward one document with several questions to get predictions.
+
+        The question independent part of the network is only run once for
+        the document (see RnnDocReader.forward_multi).
+
+        Args:
+            ex: the output of vector.vectorize_multi
+            candidates, top_n, threshold, async_pool: see predict
+        Output:
+            pred_s, pred_e, pred_score: n_questions * top_n predictions
+
+        If async_pool is given, these will be AsyncResult handles.
+        """
+        # Eval mode
+        self.network.eval()
+
+        # Transfer to GPU
+        if self.use_cuda:
+            inputs = [e if e is None else e.cuda(non_blocking=True)
+                      for e in ex[:5]]
+        else:
+            inputs = [e for e in ex[:5]]
+
+        # Run forward
+        network = self.network.module if self.parallel else self.network
+        with torch.no_grad():
+            scores = network.forward_multi(*inputs)
+
+        return self._decode(scores, candidates, top_n, threshold, async_pool)
+
+    def _decode(self, scores, candidates=None, top_n=1, threshold=0.5,
+                async_pool=None):
+        """Decode network output scores into predictions (maybe async)."""
         if self.args.multiple_answer:
-            # Run forward
-            score_offsets = self.network(*inputs)
-            
             # Decode predictions
-            score_offsets = score_offsets.data.cpu()
+            score_offsets = scores.data.cpu()
 
             args = (score_offsets, top_n, threshold)
             if async_pool:
                 return async_pool.apply_async(self.decode_multiple_answer, args)
             else:
                 return self.decode_multiple_answer(*args)
-                                
-        else:
-            # Run forward
-            with torch.no_grad():
-                score_s, score_e = self.network(*inputs)
 
+        else:
             # Decode predictions
-            score_s = score_s.data.cpu()
-            score_e = score_e.data.cpu()
-            
+            score_s = scores[0].data.cpu()
+            score_e = scores[1].data.cpu()
+
             if candidates:
                 args = (score_s, score_e, candidates, top_n, self.args.max_len)
                 if async_pool:
@@ -340,47 +375,61 @@ class DocReader(object):
     def decode(score_s, score_e, top_n=1, max_len=None):
         """Take argmax of constrained score_s * score_e.
 
+        Only the band of valid spans (start <= end < start + max_len) is
+        scored, for the whole batch at once: a batch * len_d * max_len tensor
+        instead of a len_d * len_d outer product per example. Ties are broken
+        in favour of the earliest (start, end) pair. At most the number of
+        valid spans is returned per example.
+
         Args:
             score_s: independent start predictions
             score_e: independent end predictions
             top_n: number of top scored pairs to take
             max_len: max span length to consider
         """
-        pred_s = []
-        pred_e = []
-        pred_score = []
-        max_len = max_len or score_s.size(1)
-        for i in range(score_s.size(0)):
-            # Outer product of scores to get full p_s * p_e matrix
-            scores = torch.ger(score_s[i], score_e[i])
-
-            # Zero out negative length and over-length span scores
-            scores.triu_().tril_(max_len - 1)
-
-            # Take argmax or top n
-            scores = scores.numpy()
-            scores_flat = scores.flatten()
-            if top_n == 1:
-                idx_sort = [np.argmax(scores_flat)]
-            elif len(scores_flat) < top_n:
-                idx_sort = np.argsort(-scores_flat)
+        batch_size, len_d = score_s.size()
+        max_len = min(max_len or len_d, len_d)
+
+        # band[b, i, k] = score of the span starting at i and ending at i + k
+        score_e = torch.cat([score_e, score_e.new_zeros(batch_size,
+                                                        max_len - 1)], 1)
+        band = score_s.unsqueeze(2) * score_e.unfold(1, max_len, 1)
+
+        # Never select spans running past the end (all scores are >= 0)
+        ends = (torch.arange(len_d).unsqueeze(1) +
+                torch.arange(max_len).unsqueeze(0))
+        band.masked_fill_((ends >= len_d).unsqueeze(0), -1)
+        num_spans = int((ends < len_d).sum())
+
+        # Take argmax or top n
+        scores_flat = band.view(batch_size, -1).numpy()
+        top_n = min(top_n, num_spans)
+        if top_n == 1:
+            idx_sort = np.argmax(scores_flat, 1)[:, None]
+        else:
+            if top_n < scores_flat.shape[1]:
+                idx = np.argpartition(-scores_flat, top_n - 1, 1)[:, :top_n]
             else:
-                idx = np.argpartition(-scores_flat, top_n)[0:top_n]
-                idx_sort = idx[np.argsort(-scores_flat[idx])]
-            s_idx, e_idx = np.unravel_index(idx_sort, scores.shape)
-            pred_s.append(s_idx)
-            pred_e.append(e_idx)
-            pred_score.append(scores_flat[idx_sort])
-        return pred_s, pred_e, pred_score
+                idx = np.tile(np.arange(scores_flat.shape[1]), (batch_size, 1))
+            scores = np.take_along_axis(scores_flat, idx, 1)
+            idx_sort = np.take_along_axis(idx, np.lexsort((idx, -scores)), 1)
+        s_idx = idx_sort // max_len
+        e_idx = s_idx + idx_sort % max_len
+        pred_score = np.take_along_axis(scores_flat, idx_sort, 1)
+        return list(s_idx), list(e_idx), list(pred_score)
 
     @staticmethod
     def decode_candidates(score_s, score_e, candidates, top_n=1, max_len=None):
         """Take argmax of constrained score_s * score_e. Except only consider
         spans that are in the candidates list.
+
+        Candidates may be given as a CandidateIndex (built once) or as any
+        collection of strings (indexed here once per call).
         """
         pred_s = []
         pred_e = []
         pred_score = []
+        indexes = {}
         for i in range(score_s.size(0)):
             # Extract original tokens stored with candidates
             tokens = candidates[i]['input']
@@ -392,86 +441,85 @@ class DocReader(object):
                 cands = PROCESS_CANDS
             if not cands:
                 raise RuntimeError('No candidates given.')
+            if not isinstance(cands, CandidateIndex):
+                if id(cands) not in indexes:
+                    indexes[id(cands)] = CandidateIndex(cands)
+                cands = indexes[id(cands)]
+
+            # Find all valid candidates in text, then score them all at once.
+            spans = cands.find(tokens, max_len)
 
-            # Score all valid candidates found in text.
-            # Brute force get all ngrams and compare against the candidate list.
-            max_len = max_len or len(tokens)
-            scores, s_idx, e_idx = [], [], []
-            for s, e in tokens.ngrams(n=max_len, as_strings=False):
-                span = tokens.slice(s, e).untokenize()
-                if span in cands or span.lower() in cands:
-                    # Match! Record its score.
-                    scores.append(score_s[i][s] * score_e[i][e - 1])
-                    s_idx.append(s)
-                    e_idx.append(e - 1)
-
-            if len(scores) == 0:
+            if len(spans) == 0:
                 # No candidates present
                 pred_s.append([])
                 pred_e.append([])
                 pred_score.append([])
             else:
                 # Rank found candidates
-                scores = np.array(scores)
-                s_idx = np.array(s_idx)
-                e_idx = np.array(e_idx)
+                s_idx, e_idx = np.array(spans).T
+                e_idx = e_idx - 1
+                scores = score_s[i].numpy()[s_idx] * score_e[i].numpy()[e_idx]
 
-                idx_sort = np.argsort(-scores)[0:top_n]
+                idx_sort = np.argsort(-scores, kind='stable')[0:top_n]
                 pred_s.append(s_idx[idx_sort])
                 pred_e.append(e_idx[idx_sort])
                 pred_score.append(scores[idx_sort])
         return pred_s, pred_e, pred_score
 
     @staticmethod
-    def decode_multiple_answer(score_ans_offsets, top_n=10, threshold=0.5):
+    def decode_multiple_answer(score_ans_offsets, top_n=10, threshold=0.5,
+                               sort=True):
         """Extract a sequence of words whose score is higher than the threshold
 
+        Runs of words above the threshold (and their mean scores) are found
+        for the whole batch at once, from the edges of the thresholded mask
+        and cumulative sums of the scores.
+
         Args:
             score_ans_offsets: offset predictions
-            top_n: number of top scored pairs to take
+            top_n: number of top scored chunks to take (None = all chunks)
             threshold: used to extract words
+            sort: return the chunks sorted by score (else in document order)
         """
-        def get_top_chunks(in_arr):
-            chunks = []
-            start_idx, end_idx = -1, -1
-            for idx, val in enumerate(in_arr):
-                if val > threshold:
-                    if start_idx == -1:
-                        start_idx, end_idx = idx, idx
-                    else:
-                        end_idx = idx
-                else:
-                    if start_idx != -1:
-                        chunks.append((
-                            start_idx, end_idx,
-                            np.average(in_arr[start_idx:end_idx+1])))
-                        start_idx, end_idx = -1, -1
-            if start_idx != -1:
-                chunks.append((
-                    start_idx, end_idx,
-                    np.average(in_arr[start_idx:end_idx+1])))
-
-            chunks.sort(key=lambda x: x[2], reverse=True)
-
-            return chunks[:top_n]
-        
-        pred_s = []
-        pred_e = []
-        pred_ans_offsets = []
-        pred_score = []
-        for i in range(score_ans_offsets.size(0)):
-            scores = score_ans_offsets[i].numpy()
-            chunks = get_top_chunks(scores)
-            pred_s.append([])
-            pred_e.append([])
-            pred_score.append([])
-            for c in chunks:
-                pred_s[-1].append(c[0])
-                pred_e[-1].append(c[1])
-                pred_score[-1].append(c[2])
+        scores = score_ans_offsets.numpy()
+        batch_size, len_d = scores.shape
+
+        # Chunk starts (+1) and ends (-1, exclusive) are the edges of the mask
+        above = np.zeros((batch_size, len_d + 2), dtype=np.int8)
+        above[:, 1:-1] = scores > threshold
+        edges = np.diff(above, axis=1)
+        rows, starts = np.nonzero(edges == 1)
+        _, ends = np.nonzero(edges == -1)
+
+        # Mean score of each chunk
+        cumsum = np.zeros((batch_size, len_d + 1))
+        np.cumsum(scores, axis=1, out=cumsum[:, 1:])
+        means = (cumsum[rows, ends] - cumsum[rows, starts]) / (ends - starts)
+
+        if sort or top_n is not None:
+            # Sort by row, then score (ties kept in document order)
+            order = np.lexsort((starts, -means, rows))
+            rows, starts, ends, means = (rows[order], starts[order],
+                                         ends[order], means[order])
+        if top_n is not None:
+            rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+            keep = rank < top_n
+            rows, starts, ends, means = (rows[keep], starts[keep],
+                                         ends[keep], means[keep])
+            if not sort:
+                # Back to document order
+                order = np.lexsort((starts, rows))
+                rows, starts, ends, means = (rows[order], starts[order],
+                                             ends[order], means[order])
+
+        # Split back into one list of chunks per row
+        splits = np.cumsum(np.bincount(rows, minlength=batch_size))[:-1]
+        pred_s = np.split(starts, splits)
+        pred_e = np.split(ends - 1, splits)
+        pred_score = np.split(means, splits)
 
         return pred_s, pred_e, pred_score
-        
+
     # --------------------------------------------------------------------------
     # Saving and loading
     # --------------------------------------------------------------------------
@@ -486,7 +534,7 @@ class DocReader(object):
             state_dict.pop('fixed_embedding')
         params = {
             'state_dict': state_dict,
-            'word_dict': self.word_dict,
+            'word_dict': self._saved_word_dict(),
             'feature_dict': self.feature_dict,
             'args': self.args,
         }
@@ -502,7 +550,7 @@ class DocReader(object):
             network = self.network
         params = {
             'state_dict': network.state_dict(),
-            'word_dict': self.word_dict,
+            'word_dict': self._saved_word_dict(),
             'feature_dict': self.feature_dict,
             'args': self.args,
             'epoch': epoch,
@@ -513,13 +561,25 @@ class DocReader(object):
         except BaseException:
             logger.warning('WARN: Saving failed... continuing anyway.')
 
+    def _saved_word_dict(self):
+        """The word dict, in array form with --vocab-arrays."""
+        if getattr(self.args, 'vocab_arrays', False):
+            return self.word_dict.to_arrays()
+        return self.word_dict
+
+    @staticmethod
+    def _load_word_dict(word_dict):
+        if isinstance(word_dict, Dictionary):
+            return word_dict
+        return Dictionary.from_arrays(word_dict)
+
     @staticmethod
     def load(filename, new_args=None, normalize=True):
         logger.info('Loading model %s' % filename)
         saved_params = torch.load(
             filename, map_location=lambda storage, loc: storage
         )
-        word_dict = saved_params['word_dict']
+        word_dict = DocReader._load_word_dict(saved_params['word_dict'])
         feature_dict = saved_params['feature_dict']
         state_dict = saved_params['state_dict']
         args = saved_params['args']
@@ -533,7 +593,7 @@ class DocReader(object):
         saved_params = torch.load(
             filename, map_location=lambda storage, loc: storage
         )
-        word_dict = saved_params['word_dict']
+        word_dict = DocReader._load_word_dict(saved_params['word_dict'])
         feature_dict = saved_params['feature_dict']
         state_dict = saved_params['state_dict']
         epoch = saved_params['epoch']
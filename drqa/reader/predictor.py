@@ -12,8 +12,9 @@ import logging
 from multiprocessing import Pool as ProcessPool
 from multiprocessing.util import Finalize
 
-from .vector import vectorize, batchify
+from .vector import vectorize, vectorize_multi, batchify, BatchBuffers
 from .model import DocReader
+from .feature_store import FeatureStore
 from . import DEFAULTS, utils
 from .. import tokenizers
 
@@ -27,9 +28,9 @@ logger = logging.getLogger(__name__)
 PROCESS_TOK = None
 
 
-def init(tokenizer_class, annotators):
+def init(tokenizer_class, tokenizer_opts):
     global PROCESS_TOK
-    PROCESS_TOK = tokenizer_class(annotators=annotators)
+    PROCESS_TOK = tokenizer_class(**tokenizer_opts)
     Finalize(PROCESS_TOK, PROCESS_TOK.shutdown, exitpriority=100)
 
 
@@ -47,7 +48,8 @@ class Predictor(object):
     """Load a pretrained DocReader model and predict inputs on the fly."""
 
     def __init__(self, model=None, tokenizer=None, normalize=True,
-                 embedding_file=None, num_workers=None):
+                 embedding_file=None, num_workers=None, tokenizer_cache=None,
+                 token_store=None, feature_store=None):
         """
         Args:
             model: path to saved model file.
@@ -56,6 +58,13 @@ class Predictor(object):
             embedding_file: if provided, will expand dictionary to use all
               available pretrained vectors in this file.
             num_workers: number of CPU processes to use to preprocess batches.
+            tokenizer_cache: if provided, path to an on-disk cache of
+              tokenized texts shared by all workers (see CachedTokenizer).
+            token_store: if provided, path to a store of pre-tokenized
+              documents (see build_token_store.py). Only the documents
+              missing from it are tokenized.
+            feature_store: if provided, path to the precomputed model inputs
+              of the token store documents (see build_feature_store.py).
         """
         logger.info('Initializing model...')
         self.model = DocReader.load(model or DEFAULTS['model'],
@@ -73,16 +82,40 @@ class Predictor(object):
             tokenizer_class = DEFAULTS['tokenizer']
         else:
             tokenizer_class = tokenizers.get_class(tokenizer)
+        tok_opts = {'annotators': annotators}
+        if tokenizer_cache:
+            tok_opts.update({'tokenizer_class': tokenizer_class,
+                             'cache_path': tokenizer_cache})
+            tokenizer_class = tokenizers.CachedTokenizer
+
+        self.token_store = None
+        if token_store:
+            logger.info('Loading token store %s' % token_store)
+            self.token_store = tokenizers.TokenStore(token_store)
+            self.token_store.check(
+                annotators, tok_opts.get('tokenizer_class', tokenizer_class)
+            )
+
+        self.feature_store = None
+        if feature_store:
+            if self.token_store is None:
+                raise RuntimeError('A feature store needs a token store')
+            logger.info('Loading feature store %s' % feature_store)
+            self.feature_store = FeatureStore(feature_store, self.token_store)
+            self.feature_store.check(self.model)
+
+        # Batches are made one at a time: reuse their tensors.
+        self.buffers = BatchBuffers()
 
         if num_workers is None or num_workers > 0:
             self.workers = ProcessPool(
                 num_workers,
                 initializer=init,
-                initargs=(tokenizer_class, annotators),
+                initargs=(tokenizer_class, tok_opts),
             )
         else:
             self.workers = None
-            self.tokenizer = tokenizer_class(annotators=annotators)
+            self.tokenizer = tokenizer_class(**tok_opts)
 
     def predict(self, document, question, candidates=None, top_n=1):
         """Predict a single document - question pair."""
@@ -99,18 +132,11 @@ class Predictor(object):
         candidates = candidates if any(candidates) else None
 
         # Tokenize the inputs, perhaps multi-processed.
-        if self.workers:
-            q_tokens = self.workers.map_async(tokenize, questions)
-            d_tokens = self.workers.map_async(tokenize, documents)
-            q_tokens = list(q_tokens.get())
-            d_tokens = list(d_tokens.get())
-        else:
-            q_tokens = list(map(self.tokenizer.tokenize, questions))
-            d_tokens = list(map(self.tokenizer.tokenize, documents))
+        q_tokens, d_tokens = self._tokenize(questions, documents)
 
         examples = []
         for i in range(len(questions)):
-            examples.append({
+            examples.append(self._add_stored({
                 'id': i,
                 'question': q_tokens[i].words(),
                 'qlemma': q_tokens[i].lemmas(),
@@ -118,7 +144,7 @@ class Predictor(object):
                 'lemma': d_tokens[i].lemmas(),
                 'pos': d_tokens[i].pos(),
                 'ner': d_tokens[i].entities(),
-            })
+            }, documents[i]))
 
         # Stick document tokens in candidates for decoding
         if candidates:
@@ -126,28 +152,128 @@ class Predictor(object):
                           for i in range(len(candidates))]
 
         # Build the batch and run it through the model
-        batch_exs = batchify([vectorize(e, self.model) for e in examples])
+        batch_exs = batchify([vectorize(e, self.model) for e in examples],
+                             self.buffers)
         s, e, score = self.model.predict(batch_exs, candidates, top_n, threshold)
 
         # Retrieve the predicted spans
         results = []
         for i in range(len(s)):
-            predictions = []
-            for j in range(len(s[i])):
-                span = d_tokens[i].slice(s[i][j], e[i][j] + 1).untokenize()
-                #predictions.append((span, score[i][j].item()))
-                #predictions.append(({"answer_start": s[i][j], "text": span}, score[i][j].item()))
-                answer_line_offsets = d_tokens[i].slice(s[i][j], e[i][j] + 1).line_offsets()
-                s_line, s_offset = answer_line_offsets[0]
-                e_line = answer_line_offsets[-1][0]
-                e_offset = answer_line_offsets[-1][1]+len(d_tokens[i].words()[e[i][j]])
-                
-                predictions.append(({"start": {"line_id": s_line, "offset": s_offset}, "end": {"line_id": e_line, "offset": e_offset}, "text": span}, score[i][j].item()))
-            results.append(predictions)
+            results.append(self._format_predictions(d_tokens[i], s[i], e[i],
+                                                    score[i]))
         return results
 
+    def predict_multi(self, document, questions, candidates=None, top_n=1,
+                      threshold=0.5):
+        """Predict several questions against a single document."""
+        results = self.predict_multi_batch(
+            [(document, questions, candidates,)], top_n, threshold
+        )
+        return results[0]
+
+    def predict_multi_batch(self, batch, top_n=1, threshold=0.5):
+        """Predict a batch of document - questions groups.
+
+        Each document is tokenized and vectorized once, and the question
+        independent part of the model is run once for all of its questions.
+        Returns, per document, the list of predictions for each question.
+        """
+        documents, questions, candidates = [], [], []
+        for b in batch:
+            documents.append(b[0])
+            questions.append(b[1])
+            candidates.append(b[2] if len(b) == 3 else None)
+        flat_questions = [q for qs in questions for q in qs]
+
+        # Tokenize the inputs, perhaps multi-processed.
+        q_tokens, d_tokens = self._tokenize(flat_questions, documents)
+
+        results = []
+        q_offset = 0
+        for i in range(len(documents)):
+            tokens = q_tokens[q_offset:q_offset + len(questions[i])]
+            q_offset += len(questions[i])
+            if len(tokens) == 0:
+                results.append([])
+                continue
+            ex = self._add_stored({
+                'id': i,
+                'questions': [t.words() for t in tokens],
+                'qlemmas': [t.lemmas() for t in tokens],
+                'document': d_tokens[i].words(),
+                'lemma': d_tokens[i].lemmas(),
+                'pos': d_tokens[i].pos(),
+                'ner': d_tokens[i].entities(),
+            }, documents[i])
+
+            # Stick document tokens in candidates for decoding
+            cands = None
+            if candidates[i]:
+                cands = [{'input': d_tokens[i], 'cands': candidates[i]}
+                         for _ in range(len(tokens))]
+
+            # Run the shared document through the model
+            s, e, score = self.model.predict_multi(
+                vectorize_multi(ex, self.model), cands, top_n, threshold
+            )
+            results.append([
+                self._format_predictions(d_tokens[i], s[j], e[j], score[j])
+                for j in range(len(s))
+            ])
+        return results
+
+    def _tokenize(self, questions, documents):
+        """Tokenize questions and documents (looking the documents up in the
+        token store first, if any).
+        """
+        if self.workers:
+            q_tokens = self.workers.map_async(tokenize, questions)
+            if self.token_store is not None:
+                d_tokens = self.token_store.lookup(
+                    documents, lambda texts: self.workers.map(tokenize, texts)
+                )
+            else:
+                d_tokens = self.workers.map(tokenize, documents)
+            return list(q_tokens.get()), list(d_tokens)
+
+        q_tokens = list(map(self.tokenizer.tokenize, questions))
+        if self.token_store is not None:
+            d_tokens = self.token_store.lookup(
+                documents, lambda texts: list(map(self.tokenizer.tokenize,
+                                                  texts))
+            )
+        else:
+            d_tokens = list(map(self.tokenizer.tokenize, documents))
+        return q_tokens, d_tokens
+
+    def _add_stored(self, ex, document):
+        """Add the precomputed inputs of document to ex, if any."""
+        if self.feature_store is not None:
+            stored = self.feature_store.get(document)
+            if stored is not None:
+                ex['stored'] = stored
+        return ex
+
+    @staticmethod
+    def _format_predictions(d_tokens, s, e, score):
+        """Map predicted token spans of one example back to the document."""
+        predictions = []
+        for j in range(len(s)):
+            span = d_tokens.slice(s[j], e[j] + 1).untokenize()
+            #predictions.append((span, score[j].item()))
+            #predictions.append(({"answer_start": s[j], "text": span}, score[j].item()))
+            answer_line_offsets = d_tokens.slice(s[j], e[j] + 1).line_offsets()
+            s_line, s_offset = answer_line_offsets[0]
+            e_line = answer_line_offsets[-1][0]
+            e_offset = answer_line_offsets[-1][1]+len(d_tokens.words()[e[j]])
+            
+            predictions.append(({"start": {"line_id": s_line, "offset": s_offset}, "end": {"line_id": e_line, "offset": e_offset}, "text": span}, score[j].item()))
+        return predictions
+
     def cuda(self):
         self.model.cuda()
+        self.buffers = BatchBuffers(pin_memory=True)
 
     def cpu(self):
         self.model.cpu()
+        self.buffers = BatchBuffers()
@@ -98,16 +98,62 @@ class RnnDocReader(nn.Module):
         x2_mask = question padding mask        [batch * len_q]
         """
         # Embed both document and question
-        x1_emb = self.embedding(x1)
-        x2_emb = self.embedding(x2)
+        x1_emb = self._dropout_emb(self.embedding(x1))
+        x2_emb = self._dropout_emb(self.embedding(x2))
 
-        # Dropout on embeddings
+        # Encode document and question
+        doc_hiddens = self._encode_document(x1_emb, x1_f, x1_mask,
+                                            x2_emb, x2_mask)
+        question_hidden = self._encode_question(x2_emb, x2_mask)
+
+        return self._predict(doc_hiddens, question_hidden, x1_mask)
+
+    def forward_multi(self, x1, x1_f, x1_mask, x2, x2_mask):
+        """Score several questions against a single document.
+
+        The document is embedded once and broadcast across the questions. If
+        the document encoding does not depend on the question (no qemb and no
+        in_question features) the document RNN is also run only once.
+
+        Inputs:
+        x1 = document word indices             [1 * len_d]
+        x1_f = document word features indices  [n_q * len_d * nfeat]
+        x1_mask = document padding mask        [1 * len_d]
+        x2 = question word indices             [n_q * len_q]
+        x2_mask = question padding mask        [n_q * len_q]
+        """
+        n_q = x2.size(0)
+
+        # Embed both document and question
+        x1_emb = self._dropout_emb(self.embedding(x1))
+        x2_emb = self._dropout_emb(self.embedding(x2))
+        x1_mask = x1_mask.expand(n_q, x1_mask.size(1))
+
+        if self.args.use_qemb or self.args.use_in_question:
+            # Question dependent document inputs: encode once per question
+            x1_emb = x1_emb.expand(n_q, -1, -1).contiguous()
+            doc_hiddens = self._encode_document(x1_emb, x1_f, x1_mask,
+                                                x2_emb, x2_mask)
+        else:
+            # Question independent document inputs: encode once and share
+            x1_f = x1_f[:1] if x1_f is not None else None
+            doc_hiddens = self._encode_document(x1_emb, x1_f, x1_mask[:1],
+                                                None, None)
+            doc_hiddens = doc_hiddens.expand(n_q, -1, -1)
+
+        question_hidden = self._encode_question(x2_emb, x2_mask)
+
+        return self._predict(doc_hiddens, question_hidden, x1_mask)
+
+    def _dropout_emb(self, emb):
+        """Dropout on embeddings."""
         if self.args.dropout_emb > 0:
-            x1_emb = nn.functional.dropout(x1_emb, p=self.args.dropout_emb,
-                                           training=self.training)
-            x2_emb = nn.functional.dropout(x2_emb, p=self.args.dropout_emb,
-                                           training=self.training)
+            emb = nn.functional.dropout(emb, p=self.args.dropout_emb,
+                                        training=self.training)
+        return emb
 
+    def _encode_document(self, x1_emb, x1_f, x1_mask, x2_emb, x2_mask):
+        """Encode the document (with its question-aware inputs) with RNN."""
         # Form document encoding inputs
         drnn_input = [x1_emb]
 
@@ -121,16 +167,19 @@ class RnnDocReader(nn.Module):
             drnn_input.append(x1_f)
 
         # Encode document with RNN
-        doc_hiddens = self.doc_rnn(torch.cat(drnn_input, 2), x1_mask)
+        return self.doc_rnn(torch.cat(drnn_input, 2), x1_mask)
 
-        # Encode question with RNN + merge hiddens
+    def _encode_question(self, x2_emb, x2_mask):
+        """Encode question with RNN + merge hiddens."""
         question_hiddens = self.question_rnn(x2_emb, x2_mask)
         if self.args.question_merge == 'avg':
             q_merge_weights = layers.uniform_weights(question_hiddens, x2_mask)
         elif self.args.question_merge == 'self_attn':
             q_merge_weights = self.self_attn(question_hiddens, x2_mask)
-        question_hidden = layers.weighted_avg(question_hiddens, q_merge_weights)
-        
+        return layers.weighted_avg(question_hiddens, q_merge_weights)
+
+    def _predict(self, doc_hiddens, question_hidden, x1_mask):
+        """Score answer offsets (or span start and end positions)."""
         if self.args.multiple_answer:
             return self.start_attn(doc_hiddens, question_hidden, x1_mask)
         else:
@@ -7,13 +7,16 @@
 """DrQA reader utilities."""
 
 import json
+import os
 import time
 import logging
 import string
 import regex as re
+import numpy as np
 
 from collections import Counter
 from .data import Dictionary
+from .example_store import ExampleStore, answer_offsets
 
 logger = logging.getLogger(__name__)
 
@@ -23,21 +26,55 @@ logger = logging.getLogger(__name__)
 # ------------------------------------------------------------------------------
 
 
+def read_examples(lines, uncased_question=False, uncased_doc=False):
+    """Iterate the examples of JSON encoded lines.
+
+    Contexts may be written once, on their own line with a 'context_id' (see
+    scripts/shinra/preprocess.py --dedup-contexts), and referenced by id from
+    the examples: all examples of a context then share its lists. If the
+    context has 'answer_offsets': true, those of its examples are rebuilt from
+    their answers.
+    """
+    contexts = {}
+    for line in lines:
+        ex = json.loads(line)
+        if 'id' not in ex:
+            if uncased_doc:
+                ex['document'] = [w.lower() for w in ex['document']]
+            contexts[ex.pop('context_id')] = ex
+            continue
+        if 'context_id' in ex:
+            ex.update(contexts[ex.pop('context_id')])
+            if ex.get('answer_offsets') is True:
+                ex['answer_offsets'] = answer_offsets(ex['answers'],
+                                                      len(ex['document']))
+        elif uncased_doc:
+            ex['document'] = [w.lower() for w in ex['document']]
+        if uncased_question:
+            ex['question'] = [w.lower() for w in ex['question']]
+        yield ex
+
+
 def load_data(args, filename, skip_no_answer=False):
     """Load examples from preprocessed file.
-    One example per line, JSON encoded.
+    One example per line, JSON encoded (see read_examples), or a directory in
+    the binary format (see ExampleStore), which is memory-mapped and decoded
+    lazily.
     """
-    # Load JSON lines
+    if os.path.isdir(filename):
+        examples = ExampleStore(filename,
+                                uncased_question=args.uncased_question,
+                                uncased_doc=args.uncased_doc)
+        if skip_no_answer:
+            examples = examples.subset(
+                np.flatnonzero(examples.num_answers() > 0)
+            )
+        return examples
+
+    # Load JSON lines (case insensitive?)
     with open(filename) as f:
-        examples = [json.loads(line) for line in f]
-
-    # Make case insensitive?
-    if args.uncased_question or args.uncased_doc:
-        for ex in examples:
-            if args.uncased_question:
-                ex['question'] = [w.lower() for w in ex['question']]
-            if args.uncased_doc:
-                ex['document'] = [w.lower() for w in ex['document']]
+        examples = list(read_examples(f, args.uncased_question,
+                                      args.uncased_doc))
 
     # Skip unparsed (start/end) examples
     if skip_no_answer:
@@ -74,6 +111,74 @@ def load_answers(filename):
     return ans
 
 
+def iter_articles(filename, chunk_size=2 ** 20):
+    """Iterate the articles of a SQuAD dataset ({"data": [...], ...}),
+    reading the file incrementally instead of loading it all.
+    """
+    decoder = json.JSONDecoder()
+    buf, pos = '', 0
+
+    def peek():
+        """Skip whitespace and return the next char ('' at the end)."""
+        nonlocal buf, pos
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            more = f.read(chunk_size)
+            if not more:
+                return ''
+            buf, pos = more, 0
+
+    def expect(char):
+        nonlocal pos
+        if peek() != char:
+            raise ValueError('%s: expected %r at char %d of the buffer' %
+                             (filename, char, pos))
+        pos += 1
+
+    def decode():
+        """Decode the next JSON value, reading more until it is complete."""
+        nonlocal buf, pos
+        peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                value, end = None, None
+            # A value ending with the buffer may be cut, as may a number
+            # followed by a digit, sign, dot or exponent.
+            if end is not None and end < len(buf) and \
+                    buf[end] not in '0123456789+-.eE':
+                break
+            more = f.read(chunk_size)
+            if not more:
+                if end is None:
+                    decoder.raw_decode(buf, pos)
+                break
+            buf, pos = buf[pos:] + more, 0
+        pos = end
+        return value
+
+    with open(filename) as f:
+        expect('{')
+        while peek() != '}':
+            if peek() == ',':
+                pos += 1
+            key = decode()
+            expect(':')
+            if key != 'data':
+                decode()
+                continue
+            expect('[')
+            while peek() != ']':
+                if peek() == ',':
+                    pos += 1
+                yield decode()
+            pos += 1
+
+
 # ------------------------------------------------------------------------------
 # Dictionary building
 # ------------------------------------------------------------------------------
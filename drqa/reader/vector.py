@@ -8,58 +8,140 @@
 """Functions for putting examples into torch format."""
 
 from collections import Counter
+import numpy as np
 import torch
 
+from .feature_store import hash_words
 
-def vectorize(ex, model, single_answer=False):
-    """Torchify a single example."""
+
+def lookup(values, fn):
+    """Map fn over values, calling it once per distinct value."""
+    cache = {}
+    return [cache[v] if v in cache else cache.setdefault(v, fn(v))
+            for v in values]
+
+
+def index_words(words, word_dict):
+    """LongTensor of the word_dict indices of words."""
+    return torch.from_numpy(word_dict.encode(words).astype(np.int64))
+
+
+def isin(values, words):
+    """Boolean array: which of values are in words (any hashable values)."""
+    ids = {}
+    values = np.array([ids.setdefault(v, len(ids)) for v in values],
+                      dtype=np.int64)
+    words = np.array([ids.get(w, -1) for w in words], dtype=np.int64)
+    return np.isin(values, words)
+
+
+def one_hot(features, cols):
+    """Set features[i, cols[i]] to 1 for all tokens i with cols[i] >= 0."""
+    cols = torch.as_tensor(cols, dtype=torch.long)
+    mask = cols >= 0
+    features[torch.arange(features.size(0))[mask], cols[mask]] = 1.0
+
+
+def document_features(ex, model):
+    """Build the question independent features (POS, NER, TF) of a document.
+
+    The in_question features are left at zero, see question_features.
+    """
     args = model.args
-    word_dict = model.word_dict
     feature_dict = model.feature_dict
 
-    # Index words
-    document = torch.LongTensor([word_dict[w] for w in ex['document']])
-    question = torch.LongTensor([word_dict[w] for w in ex['question']])
-
     # Create extra features vector
     if len(feature_dict) > 0:
         features = torch.zeros(len(ex['document']), len(feature_dict))
     else:
-        features = None
+        return None
 
-    # f_{exact_match}
-    if args.use_in_question:
-        q_words_cased = {w for w in ex['question']}
-        q_words_uncased = {w.lower() for w in ex['question']}
-        q_lemma = {w for w in ex['qlemma']} if args.use_lemma else None
-        for i in range(len(ex['document'])):
-            if ex['document'][i] in q_words_cased:
-                features[i][feature_dict['in_question']] = 1.0
-            if ex['document'][i].lower() in q_words_uncased:
-                features[i][feature_dict['in_question_uncased']] = 1.0
-            if q_lemma and ex['lemma'][i] in q_lemma:
-                features[i][feature_dict['in_question_lemma']] = 1.0
-
-    # f_{token} (POS)
-    if args.use_pos:
-        for i, w in enumerate(ex['pos']):
-            f = 'pos=%s' % w
-            if f in feature_dict:
-                features[i][feature_dict[f]] = 1.0
-
-    # f_{token} (NER)
-    if args.use_ner:
-        for i, w in enumerate(ex['ner']):
-            f = 'ner=%s' % w
-            if f in feature_dict:
-                features[i][feature_dict[f]] = 1.0
+    # Precomputed (see FeatureStore)
+    if 'stored' in ex:
+        return stored_document_features(features, ex['stored'], model)
+
+    # f_{token} (POS, NER): one column per tag
+    for name, use in [('pos', args.use_pos), ('ner', args.use_ner)]:
+        if use:
+            one_hot(features, lookup(
+                ex[name], lambda w: feature_dict.get('%s=%s' % (name, w), -1)
+            ))
 
     # f_{token} (TF)
     if args.use_tf:
-        counter = Counter([w.lower() for w in ex['document']])
-        l = len(ex['document'])
-        for i, w in enumerate(ex['document']):
-            features[i][feature_dict['tf']] = counter[w.lower()] * 1.0 / l
+        words = [w.lower() for w in ex['document']]
+        counter = Counter(words)
+        tf = torch.DoubleTensor([counter[w] for w in words]) / len(words)
+        features[:, feature_dict['tf']] = tf
+
+    return features
+
+
+def stored_document_features(features, stored, model):
+    """Fill in the question independent features from the precomputed
+    inputs of a document.
+    """
+    args = model.args
+    for name, use in [('pos', args.use_pos), ('ner', args.use_ner)]:
+        if use:
+            one_hot(features, stored[name].astype(np.int64))
+    if args.use_tf:
+        features[:, model.feature_dict['tf']] = torch.from_numpy(stored['tf'])
+    return features
+
+
+def question_features(features, ex, question, qlemma, model):
+    """Fill in the in_question features of a document for one question."""
+    args = model.args
+    feature_dict = model.feature_dict
+    if not args.use_in_question:
+        return features
+
+    # f_{exact_match}
+    if 'stored' in ex:
+        # Precomputed document (see FeatureStore): compare hashes
+        stored = ex['stored']
+        matches = [
+            ('in_question', stored['word_hashes'], hash_words(question)),
+            ('in_question_uncased', stored['uncased_hashes'],
+             hash_words([w.lower() for w in question])),
+        ]
+        if args.use_lemma:
+            matches.append(('in_question_lemma', stored['lemma_hashes'],
+                            hash_words(qlemma)))
+        for name, hashes, q_hashes in matches:
+            match = np.isin(hashes, q_hashes)
+            features[torch.from_numpy(match), feature_dict[name]] = 1.0
+        return features
+
+    matches = [
+        ('in_question', isin(ex['document'], question)),
+        ('in_question_uncased', isin([w.lower() for w in ex['document']],
+                                     [w.lower() for w in question])),
+    ]
+    if args.use_lemma:
+        matches.append(('in_question_lemma', isin(ex['lemma'], qlemma)))
+    for name, match in matches:
+        features[torch.from_numpy(match), feature_dict[name]] = 1.0
+    return features
+
+
+def vectorize(ex, model, single_answer=False):
+    """Torchify a single example."""
+    args = model.args
+    word_dict = model.word_dict
+
+    # Index words
+    if 'stored' in ex:
+        document = torch.from_numpy(ex['stored']['word_ids'].astype(np.int64))
+    else:
+        document = index_words(ex['document'], word_dict)
+    question = index_words(ex['question'], word_dict)
+
+    # Create extra features vector
+    features = document_features(ex, model)
+    if features is not None:
+        question_features(features, ex, ex['question'], ex['qlemma'], model)
 
     # Maybe return without target
     if 'answers' not in ex:
@@ -84,72 +166,175 @@ def vectorize(ex, model, single_answer=False):
         return document, features, question, start, end, ex['id']
 
 
-def batchify(batch):
-    """Gather a batch of individual examples into one batch."""
+class BatchBuffers(object):
+    """Pool of preallocated (optionally pinned) tensors for batchify.
+
+    The tensors of a batch are views on flat buffers, whose sizes are
+    rounded up to powers of two so that a few buckets serve all batch
+    shapes. There are `size` sets of buffers, used round robin: a batch must
+    no longer be used (e.g. copied to the gpu and forwarded) once `size`
+    more batches have been made. Not for DataLoader workers, whose batches
+    outlive the next ones.
+    """
+
+    def __init__(self, size=2, pin_memory=False):
+        self.size = size
+        self.pin_memory = pin_memory
+        self.pools = [{} for _ in range(size)]
+        self.current = 0
+
+    def next(self):
+        """Switch to the next set of buffers."""
+        self.current = (self.current + 1) % self.size
+
+    def get(self, name, factory, *shape):
+        """A tensor of shape (uninitialized) made by factory (e.g.
+        torch.LongTensor), on the buffer of name.
+        """
+        numel = 1
+        for dim in shape:
+            numel *= dim
+        pool = self.pools[self.current]
+        buffer = pool.get(name)
+        if buffer is None or buffer.numel() < numel:
+            buffer = factory(1 << max(numel - 1, 0).bit_length())
+            if self.pin_memory:
+                buffer = buffer.pin_memory()
+            pool[name] = buffer
+        return buffer[:numel].view(*shape)
+
+
+def pad(tensors, valid, factory, buffers=None, name=None):
+    """Pad tensors (of lengths given by the valid mask) into a zero filled
+    batch tensor, with a single masked copy.
+    """
+    shape = tuple(valid.size()) + tuple(tensors[0].size()[1:])
+    if buffers is not None:
+        padded = buffers.get(name, factory, *shape).zero_()
+    else:
+        padded = factory(*shape).zero_()
+    padded[valid] = torch.cat(tensors).type_as(padded)
+    return padded
+
+
+def pad_mask(valid, buffers=None, name=None):
+    """Padding mask (1 for padding) of a valid mask."""
+    if buffers is not None:
+        mask = buffers.get(name, torch.ByteTensor, *valid.size())
+    else:
+        mask = torch.ByteTensor(*valid.size())
+    return mask.copy_(~valid)
+
+
+def lengths_mask(lengths, max_length=None):
+    """[batch, max_length] mask of the positions within lengths."""
+    lengths = torch.LongTensor(lengths)
+    max_length = max_length or int(lengths.max())
+    return torch.arange(max_length).unsqueeze(0) < lengths.unsqueeze(1)
+
+
+def batchify(batch, buffers=None):
+    """Gather a batch of individual examples into one batch.
+
+    Args:
+        batch: list of vectorized examples.
+        buffers: if given, BatchBuffers to build the batch tensors in
+          (instead of allocating new ones).
+    """
     NUM_INPUTS = 3
     NUM_TARGETS = 2
     NUM_EXTRA = 1
 
+    if buffers is not None:
+        buffers.next()
+
     ids = [ex[-1] for ex in batch]
     docs = [ex[0] for ex in batch]
     features = [ex[1] for ex in batch]
     questions = [ex[2] for ex in batch]
 
     # Batch documents and features
-    d_max_length = max([d.size(0) for d in docs])
-    x1 = torch.LongTensor(len(docs), d_max_length).zero_()
-    x1_mask = torch.ByteTensor(len(docs), d_max_length).fill_(1)
+    d_valid = lengths_mask([d.size(0) for d in docs])
+    d_max_length = d_valid.size(1)
+    x1 = pad(docs, d_valid, torch.LongTensor, buffers, 'x1')
+    x1_mask = pad_mask(d_valid, buffers, 'x1_mask')
     if features[0] is None:
         x1_f = None
     else:
-        x1_f = torch.zeros(len(docs), d_max_length, features[0].size(1))
-    for i, d in enumerate(docs):
-        x1[i, :d.size(0)].copy_(d)
-        x1_mask[i, :d.size(0)].fill_(0)
-        if x1_f is not None:
-            x1_f[i, :d.size(0)].copy_(features[i])
+        x1_f = pad(features, d_valid, torch.FloatTensor, buffers, 'x1_f')
 
     # Batch questions
-    q_max_length = max([q.size(0) for q in questions])
-    x2 = torch.LongTensor(len(questions), q_max_length).zero_()
-    x2_mask = torch.ByteTensor(len(questions), q_max_length).fill_(1)
-    for i, q in enumerate(questions):
-        x2[i, :q.size(0)].copy_(q)
-        x2_mask[i, :q.size(0)].fill_(0)
+    q_valid = lengths_mask([q.size(0) for q in questions])
+    x2 = pad(questions, q_valid, torch.LongTensor, buffers, 'x2')
+    x2_mask = pad_mask(q_valid, buffers, 'x2_mask')
 
     # Maybe return without targets
     if len(batch[0]) == NUM_INPUTS + NUM_EXTRA:
         return x1, x1_f, x1_mask, x2, x2_mask, ids
 
-    elif len(batch[0]) == NUM_INPUTS + NUM_EXTRA + NUM_TARGETS:
-        # ...Otherwise add targets
-        if torch.is_tensor(batch[0][3]):
-            y_s = torch.cat([ex[3] for ex in batch])
-            y_e = torch.cat([ex[4] for ex in batch])
-        else:
-            y_s = [ex[3] for ex in batch]
-            y_e = [ex[4] for ex in batch]
+    if len(batch[0]) not in [NUM_INPUTS + NUM_EXTRA + NUM_TARGETS,
+                             NUM_INPUTS + NUM_EXTRA + NUM_TARGETS + 1]:
+        raise RuntimeError('Incorrect number of inputs per example.')
+
+    # ...Otherwise add targets
+    if torch.is_tensor(batch[0][3]):
+        y_s = torch.cat([ex[3] for ex in batch])
+        y_e = torch.cat([ex[4] for ex in batch])
+    else:
+        y_s = [ex[3] for ex in batch]
+        y_e = [ex[4] for ex in batch]
+    if len(batch[0]) == NUM_INPUTS + NUM_EXTRA + NUM_TARGETS:
         return x1, x1_f, x1_mask, x2, x2_mask, y_s, y_e, ids
-    
-    elif len(batch[0]) == NUM_INPUTS + NUM_EXTRA + NUM_TARGETS + 1:
-        if torch.is_tensor(batch[0][5]):
-            y_offset = torch.FloatTensor(len(docs), d_max_length).zero_()
-            for i, offset in enumerate([ex[5] for ex in batch]):
-              y_offset[i, :offset.size(0)].copy_(offset)
-        else:
-            y_offset = [[0] * d_max_length] * len(docs)
-            for i, offset in enumerate([ex[5] for ex in batch]):
-              y_offset[i, :len(offset)] = offset
-
-        if torch.is_tensor(batch[0][3]):
-            y_s = torch.cat([ex[3] for ex in batch])
-            y_e = torch.cat([ex[4] for ex in batch])
-        else:
-            y_s = [ex[3] for ex in batch]
-            y_e = [ex[4] for ex in batch]
-        return x1, x1_f, x1_mask, x2, x2_mask, y_s, y_e, y_offset, ids
 
+    # Multiple answer: per token answer targets (tensors, lists, or None if
+    # missing), padded with zeros.
+    offsets = [ex[5] for ex in batch]
+    if all(offset is None for offset in offsets):
+        y_offset = None
     else:
-        raise RuntimeError('Incorrect number of inputs per example.')
+        offsets = [torch.FloatTensor([] if offset is None else offset)
+                   if not torch.is_tensor(offset) else offset
+                   for offset in offsets]
+        o_valid = lengths_mask([o.size(0) for o in offsets], d_max_length)
+        y_offset = pad(offsets, o_valid, torch.FloatTensor, buffers,
+                       'y_offset')
+    return x1, x1_f, x1_mask, x2, x2_mask, y_s, y_e, y_offset, ids
+
+
+def vectorize_multi(ex, model):
+    """Torchify one document shared by several questions, as a single batch.
+
+    Besides the document fields, ex holds 'questions' and 'qlemmas' (one entry
+    per question). Document word indices and the question independent
+    features are computed once; only the in_question features are computed per
+    question.
+    """
+    word_dict = model.word_dict
+    num_questions = len(ex['questions'])
+
+    # Index document words
+    if 'stored' in ex:
+        x1 = torch.from_numpy(
+            ex['stored']['word_ids'].astype(np.int64)
+        ).unsqueeze(0)
+    else:
+        x1 = index_words(ex['document'], word_dict).unsqueeze(0)
+    x1_mask = torch.ByteTensor(1, x1.size(1)).fill_(0)
+
+    # Build document features, then copy them for each question
+    features = document_features(ex, model)
+    if features is None:
+        x1_f = None
+    else:
+        x1_f = features.unsqueeze(0).repeat(num_questions, 1, 1)
+        for i in range(num_questions):
+            question_features(x1_f[i], ex, ex['questions'][i],
+                              ex['qlemmas'][i], model)
+
+    # Batch questions
+    questions = [index_words(q, word_dict) for q in ex['questions']]
+    q_valid = lengths_mask([q.size(0) for q in questions])
+    x2 = pad(questions, q_valid, torch.LongTensor)
+    x2_mask = pad_mask(q_valid)
 
-    return x1, x1_f, x1_mask, x2, x2_mask, y_s, y_e, ids
+    return x1, x1_f, x1_mask, x2, x2_mask, ex['id']
@@ -26,13 +26,19 @@ def set_default(key, value):
 def get_class(name):
     if name == 'tfidf':
         return TfidfDocRanker
+    if name == 'sharded_tfidf':
+        return ShardedTfidfDocRanker
     if name == 'sqlite':
         return DocDB
+    if name == 'compressed':
+        return CompressedDocDB
     if name == 'elasticsearch':
         return ElasticDocRanker
     raise RuntimeError('Invalid retriever class: %s' % name)
 
 
 from .doc_db import DocDB
+from .compressed_doc_db import CompressedDocDB
 from .tfidf_doc_ranker import TfidfDocRanker
+from .sharded_tfidf_doc_ranker import ShardedTfidfDocRanker
 from .elastic_doc_ranker import ElasticDocRanker
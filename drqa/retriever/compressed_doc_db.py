@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Documents, in compressed blocks (see scripts/retriever/compress_db.py).
+
+A compressed db is a directory holding:
+
+* blocks.bin: the compressed blocks of document texts (utf-8), concatenated.
+* block_offsets.npy: start of each block in blocks.bin (plus the final end).
+* doc_block.npy, doc_start.npy, doc_length.npy: block of each document, and
+  its byte range in the decompressed block.
+* doc_id_*.npy: the doc ids (see utils.DocIdTable).
+* dictionary.bin: the zstd dictionary the blocks are compressed with, if any.
+* metadata.json: the codec and build options.
+"""
+
+import json
+import os
+import zlib
+import numpy as np
+
+from collections import OrderedDict
+
+from . import utils
+from . import DEFAULTS
+
+# Zstandard is optional
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class CompressedDocDB(object):
+    """Compressed, random access document storage.
+
+    Implements get_doc_ids(), get_doc_text(doc_id), get_doc_texts(doc_ids)
+    and get_doc_paragraphs(doc_ids). Only the blocks holding the requested
+    documents are read and decompressed; the last few are kept in a small
+    cache.
+    """
+
+    # Number of decompressed blocks kept in memory.
+    BLOCK_CACHE_SIZE = 16
+
+    def __init__(self, db_path=None):
+        self.path = db_path or DEFAULTS['db_path']
+        with open(os.path.join(self.path, 'metadata.json')) as f:
+            self.metadata = json.load(f)
+
+        def load(name):
+            return np.load(os.path.join(self.path, name + '.npy'),
+                           mmap_mode='r')
+
+        self.block_offsets = load('block_offsets')
+        self.doc_block = load('doc_block')
+        self.doc_start = load('doc_start')
+        self.doc_length = load('doc_length')
+        self.doc_ids = utils.DocIdTable(
+            load('doc_id_data'), load('doc_id_offsets'), load('doc_id_order')
+        )
+
+        codec = self.metadata['codec']
+        if codec == 'zstd':
+            if zstandard is None:
+                raise RuntimeError('zstandard is needed to read %s' %
+                                   self.path)
+            dict_data = None
+            if self.metadata.get('dictionary'):
+                with open(os.path.join(self.path, 'dictionary.bin'),
+                          'rb') as f:
+                    dict_data = zstandard.ZstdCompressionDict(f.read())
+            self.decompress = zstandard.ZstdDecompressor(
+                dict_data=dict_data
+            ).decompress
+        elif codec == 'zlib':
+            self.decompress = zlib.decompress
+        else:
+            raise RuntimeError('Invalid codec: %s' % codec)
+
+        self.blocks = open(os.path.join(self.path, 'blocks.bin'), 'rb')
+        self.cache = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the blocks file."""
+        self.blocks.close()
+        self.cache.clear()
+
+    def get_doc_ids(self):
+        """Fetch all ids of docs stored in the db."""
+        return [self.doc_ids[i] for i in range(len(self.doc_ids))]
+
+    def get_doc_text(self, doc_id):
+        """Fetch the raw text of the doc for 'doc_id'."""
+        return self.get_doc_texts([doc_id])[0]
+
+    def get_doc_texts(self, doc_ids):
+        """Fetch the raw texts of the docs for 'doc_ids' (None if missing).
+
+        Docs are read block by block, so that each block is decompressed
+        once.
+        """
+        indices = []
+        for doc_id in doc_ids:
+            try:
+                indices.append(self.doc_ids.index(utils.normalize(doc_id)))
+            except KeyError:
+                indices.append(None)
+
+        texts = [None] * len(indices)
+        found = sorted((self.doc_block[idx], i)
+                       for i, idx in enumerate(indices) if idx is not None)
+        for block_idx, i in found:
+            block = self._get_block(int(block_idx))
+            start = self.doc_start[indices[i]]
+            end = start + self.doc_length[indices[i]]
+            texts[i] = block[start:end].decode('utf-8')
+        return texts
+
+    def get_doc_paragraphs(self, doc_ids):
+        """Fetch the paragraphs of the docs for 'doc_ids' (empty if missing).
+        """
+        return [utils.split_paragraphs(text or '')
+                for text in self.get_doc_texts(doc_ids)]
+
+    def _get_block(self, block_idx):
+        """Read and decompress a block (or get it from the cache)."""
+        if block_idx in self.cache:
+            self.cache.move_to_end(block_idx)
+            return self.cache[block_idx]
+        start = int(self.block_offsets[block_idx])
+        end = int(self.block_offsets[block_idx + 1])
+        block = self.decompress(
+            os.pread(self.blocks.fileno(), end - start, start)
+        )
+        self.cache[block_idx] = block
+        if len(self.cache) > self.BLOCK_CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return block
@@ -6,7 +6,9 @@
 # LICENSE file in the root directory of this source tree.
 """Documents, in a sqlite database."""
 
+import os
 import sqlite3
+from urllib.request import pathname2url
 from . import utils
 from . import DEFAULTS
 
@@ -14,12 +16,36 @@ from . import DEFAULTS
 class DocDB(object):
     """Sqlite backed document storage.
 
-    Implements get_doc_text(doc_id).
+    Implements get_doc_text(doc_id), get_doc_texts(doc_ids) and
+    get_doc_paragraphs(doc_ids).
     """
 
-    def __init__(self, db_path=None):
+    # Max number of ids per IN (...) query of get_doc_texts (sqlite limits
+    # the number of parameters of a query to 999 by default).
+    FETCH_CHUNK_SIZE = 500
+
+    def __init__(self, db_path=None, immutable=True, mmap_size=2 ** 30,
+                 cache_size=2 ** 16):
+        """
+        Args:
+            db_path: path to the sqlite db holding document texts.
+            immutable: open the db as immutable (no locking nor change
+              detection). Set to False if it can be written while open.
+            mmap_size: max bytes of the db read through memory-mapping.
+            cache_size: page cache size (KiB).
+        """
         self.path = db_path or DEFAULTS['db_path']
-        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        uri = 'file:%s?mode=ro' % pathname2url(os.path.abspath(self.path))
+        if immutable:
+            uri += '&immutable=1'
+        self.connection = sqlite3.connect(uri, uri=True,
+                                          check_same_thread=False)
+        self.connection.execute('PRAGMA mmap_size = %d' % mmap_size)
+        self.connection.execute('PRAGMA cache_size = -%d' % cache_size)
+        self.has_paragraphs = self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+            "AND name = 'paragraphs'"
+        ).fetchone() is not None
 
     def __enter__(self):
         return self
@@ -53,3 +79,45 @@ class DocDB(object):
         result = cursor.fetchone()
         cursor.close()
         return result if result is None else result[0]
+
+    def get_doc_texts(self, doc_ids):
+        """Fetch the raw texts of the docs for 'doc_ids' (None if missing),
+        with one query per FETCH_CHUNK_SIZE ids.
+        """
+        doc_ids = [utils.normalize(doc_id) for doc_id in doc_ids]
+        texts = {}
+        cursor = self.connection.cursor()
+        for i in range(0, len(doc_ids), self.FETCH_CHUNK_SIZE):
+            chunk = list(set(doc_ids[i:i + self.FETCH_CHUNK_SIZE]))
+            cursor.execute(
+                "SELECT id, text FROM documents WHERE id IN (%s)" %
+                ','.join('?' * len(chunk)), chunk
+            )
+            texts.update(cursor.fetchall())
+        cursor.close()
+        return [texts.get(doc_id) for doc_id in doc_ids]
+
+    def get_doc_paragraphs(self, doc_ids):
+        """Fetch the paragraphs of the docs for 'doc_ids' (empty if missing).
+
+        They are read from the paragraph table stored by build_db.py
+        --paragraphs, or split from the doc texts if the db has none.
+        """
+        if not self.has_paragraphs:
+            return [utils.split_paragraphs(text or '')
+                    for text in self.get_doc_texts(doc_ids)]
+
+        doc_ids = [utils.normalize(doc_id) for doc_id in doc_ids]
+        paragraphs = {}
+        cursor = self.connection.cursor()
+        for i in range(0, len(doc_ids), self.FETCH_CHUNK_SIZE):
+            chunk = list(set(doc_ids[i:i + self.FETCH_CHUNK_SIZE]))
+            cursor.execute(
+                "SELECT doc_id, text FROM paragraphs WHERE doc_id IN (%s) "
+                "ORDER BY doc_id, para_idx" % ','.join('?' * len(chunk)),
+                chunk
+            )
+            for doc_id, text in cursor.fetchall():
+                paragraphs.setdefault(doc_id, []).append(text)
+        cursor.close()
+        return [paragraphs.get(doc_id, []) for doc_id in doc_ids]
@@ -107,3 +107,12 @@ class ElasticDocRanker(object):
         result = self.es.get(index=self.elastic_index, doc_type='_doc', id=idx)
         return result if result is None else result['_source'][self.elastic_field_content]
 
+    def get_doc_texts(self, doc_ids):
+        """Fetch the raw texts of the docs for 'doc_ids'."""
+        return [self.get_doc_text(doc_id) for doc_id in doc_ids]
+
+    def get_doc_paragraphs(self, doc_ids):
+        """Fetch the paragraphs of the docs for 'doc_ids'."""
+        return [utils.split_paragraphs(text or '')
+                for text in self.get_doc_texts(doc_ids)]
+
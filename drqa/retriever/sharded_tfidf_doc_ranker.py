@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Rank documents with TF-IDF scores, over an index split in shards.
+
+Each shard holds the columns of a range of documents, and is loaded by its
+own worker process. Queries are weighted once (with the global doc freqs),
+scored by all shards in parallel, and the per-shard top k are merged.
+"""
+
+import heapq
+import json
+import logging
+import os
+import numpy as np
+import scipy.sparse as sp
+
+from multiprocessing import Pool as ProcessPool
+from operator import itemgetter
+
+from . import utils
+from . import DEFAULTS
+from .tfidf_doc_ranker import TfidfDocRanker
+from .. import tokenizers
+
+logger = logging.getLogger(__name__)
+
+# Name of the file listing the shards of a sharded index directory
+MANIFEST = 'shards.json'
+
+
+# ------------------------------------------------------------------------------
+# Shard worker functions.
+# ------------------------------------------------------------------------------
+
+
+PROCESS_SHARD = None
+
+
+def init(shard_path):
+    global PROCESS_SHARD
+    matrix, metadata = utils.load_sparse_csr(shard_path)
+    PROCESS_SHARD = (matrix, utils.DocIdTable.from_metadata(metadata),
+                     metadata.get('row_scales'))
+
+
+def shard_closest_docs(spmat, k):
+    """Top k docs of the shard for each row of spmat (weighted queries)."""
+    global PROCESS_SHARD
+    doc_mat, doc_ids, row_scales = PROCESS_SHARD
+    results = []
+    for scores, doc_indices in utils.score_docs(spmat, doc_mat, row_scales):
+        o_sort = utils.top_k(scores, k)
+        results.append(([doc_ids[j] for j in doc_indices[o_sort]],
+                        scores[o_sort]))
+    return results
+
+
+# ------------------------------------------------------------------------------
+# Coordinator.
+# ------------------------------------------------------------------------------
+
+
+class ShardedTfidfDocRanker(TfidfDocRanker):
+    """Scatters queries to shards of a tf-idf index and gathers the top docs.
+
+    The index is a directory of shards (see build_tfidf.py --num-shards),
+    each holding the weights of a range of documents and the global doc
+    freqs. Every shard is served by its own process.
+    """
+
+    def __init__(self, tfidf_path=None, strict=True):
+        """
+        Args:
+            tfidf_path: path to the directory of a sharded index
+            strict: fail on empty queries or continue (and return empty result)
+        """
+        tfidf_path = tfidf_path or DEFAULTS['tfidf_path']
+        logger.info('Loading %s' % tfidf_path)
+        with open(os.path.join(tfidf_path, MANIFEST)) as f:
+            manifest = json.load(f)
+        paths = [os.path.join(tfidf_path, name) for name in manifest['shards']]
+
+        # Query weighting only needs the (global) metadata
+        metadata = [utils.load_metadata(path) for path in paths]
+        self.doc_mat = None
+        self.ngrams = metadata[0]['ngram']
+        self.hash_size = metadata[0]['hash_size']
+        self.tokenizer = tokenizers.get_class(metadata[0]['tokenizer'])()
+        self.doc_freqs = metadata[0]['doc_freqs'].squeeze()
+        self.num_docs = manifest['num_docs']
+        self.strict = strict
+
+        # Doc index = offset of the shard + index in the shard
+        self.shard_doc_ids = [utils.DocIdTable.from_metadata(m)
+                              for m in metadata]
+        self.offsets = [0]
+        for doc_ids in self.shard_doc_ids:
+            self.offsets.append(self.offsets[-1] + len(doc_ids))
+
+        self.shards = [
+            ProcessPool(1, initializer=init, initargs=(path,))
+            for path in paths
+        ]
+
+    def get_doc_index(self, doc_id):
+        """Convert doc_id --> doc_index"""
+        for offset, doc_ids in zip(self.offsets, self.shard_doc_ids):
+            try:
+                return offset + doc_ids.index(doc_id)
+            except KeyError:
+                continue
+        raise KeyError(doc_id)
+
+    def get_doc_id(self, doc_index):
+        """Convert doc_index --> doc_id"""
+        for offset, doc_ids in zip(self.offsets, self.shard_doc_ids):
+            if doc_index < offset + len(doc_ids):
+                return doc_ids[doc_index - offset]
+        raise IndexError(doc_index)
+
+    def closest_docs(self, query, k=1):
+        """Closest docs by dot product between query and documents
+        in tfidf weighted word vector space.
+        """
+        return self.batch_closest_docs([query], k)[0]
+
+    def batch_closest_docs(self, queries, k=1, num_workers=None):
+        """Process a batch of closest_docs requests.
+
+        Queries are weighted and sent to all shards QUERY_BATCH_SIZE at a
+        time; chunks are queued on all shards before gathering the results.
+        num_workers is unused (there is one process per shard).
+        """
+        pending = []
+        for i in range(0, len(queries), self.QUERY_BATCH_SIZE):
+            chunk = queries[i:i + self.QUERY_BATCH_SIZE]
+            spmat = sp.vstack([self.text2spvec(q) for q in chunk],
+                              format='csr')
+            pending.append([
+                shard.apply_async(shard_closest_docs, (spmat, k))
+                for shard in self.shards
+            ])
+
+        results = []
+        for chunk in pending:
+            shard_results = [r.get() for r in chunk]
+            for per_shard in zip(*shard_results):
+                results.append(self._merge(per_shard, k))
+        return results
+
+    def _merge(self, shard_results, k):
+        """Merge the (sorted) top k docs of each shard."""
+        candidates = (
+            (score, doc_id)
+            for doc_ids, scores in shard_results
+            for doc_id, score in zip(doc_ids, scores)
+        )
+        top = heapq.nlargest(k, candidates, key=itemgetter(0))
+        doc_ids = [doc_id for _, doc_id in top]
+        doc_scores = np.array([score for score, _ in top])
+        return doc_ids, doc_scores
+
+    def shutdown(self):
+        """Stop the shard processes."""
+        for shard in getattr(self, 'shards', []):
+            shard.terminate()
+        self.shards = []
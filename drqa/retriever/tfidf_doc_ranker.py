@@ -25,58 +25,108 @@ class TfidfDocRanker(object):
     Scores new queries by taking sparse dot products.
     """
 
-    def __init__(self, tfidf_path=None, strict=True):
+    # Number of queries scored together by batch_closest_docs
+    QUERY_BATCH_SIZE = 256
+
+    def __init__(self, tfidf_path=None, strict=True, early_termination=False):
         """
         Args:
-            tfidf_path: path to saved model file
+            tfidf_path: path to saved model file (.npz), or directory of a
+              memory-mapped one. Compact (quantized or pruned) models are
+              scored directly.
             strict: fail on empty queries or continue (and return empty result)
+            early_termination: find the top docs by MaxScore pruning instead
+              of scoring all docs sharing a term with the query (same
+              results, faster on queries with frequent terms)
         """
         # Load from disk
         tfidf_path = tfidf_path or DEFAULTS['tfidf_path']
         logger.info('Loading %s' % tfidf_path)
         matrix, metadata = utils.load_sparse_csr(tfidf_path)
         self.doc_mat = matrix
+        self.row_scales = metadata.get('row_scales')
         self.ngrams = metadata['ngram']
         self.hash_size = metadata['hash_size']
         self.tokenizer = tokenizers.get_class(metadata['tokenizer'])()
         self.doc_freqs = metadata['doc_freqs'].squeeze()
-        self.doc_dict = metadata['doc_dict']
-        self.num_docs = len(self.doc_dict[0])
+        self.doc_ids = utils.DocIdTable.from_metadata(metadata)
+        # Shards of a sharded index hold the number of docs of the full index
+        self.num_docs = metadata.get('num_docs', len(self.doc_ids))
         self.strict = strict
 
+        self.early_termination = early_termination
+        if early_termination:
+            # Older models have neither sorted postings nor row maxes
+            self.row_maxes = metadata.get('row_max')
+            if self.row_maxes is None:
+                logger.warning('Sorting postings of %s' % tfidf_path)
+                self.doc_mat = utils.sort_postings(self.doc_mat)
+                self.row_maxes = utils.row_max(self.doc_mat)
+
     def get_doc_index(self, doc_id):
         """Convert doc_id --> doc_index"""
-        return self.doc_dict[0][doc_id]
+        return self.doc_ids.index(doc_id)
 
     def get_doc_id(self, doc_index):
         """Convert doc_index --> doc_id"""
-        return self.doc_dict[1][doc_index]
+        return self.doc_ids[doc_index]
 
     def closest_docs(self, query, k=1):
         """Closest docs by dot product between query and documents
         in tfidf weighted word vector space.
         """
         spvec = self.text2spvec(query)
-        res = spvec * self.doc_mat
-
-        if len(res.data) <= k:
-            o_sort = np.argsort(-res.data)
+        if self.early_termination:
+            scores, doc_indices = self._max_score_docs(spvec, k)
         else:
-            o = np.argpartition(-res.data, k)[0:k]
-            o_sort = o[np.argsort(-res.data[o])]
-
-        doc_scores = res.data[o_sort]
-        doc_ids = [self.get_doc_id(i) for i in res.indices[o_sort]]
-        return doc_ids, doc_scores
+            scores, doc_indices = utils.score_docs(
+                spvec, self.doc_mat, self.row_scales
+            )[0]
+        return self._top_docs(scores, doc_indices, k)
 
     def batch_closest_docs(self, queries, k=1, num_workers=None):
-        """Process a batch of closest_docs requests multithreaded.
+        """Process a batch of closest_docs requests.
+
+        Queries are scored QUERY_BATCH_SIZE at a time, with a single sparse
+        (queries x hash_size) * (hash_size x docs) product per chunk. Chunks
+        are processed multithreaded.
         Note: we can use plain threads here as scipy is outside of the GIL.
         """
+        chunks = [queries[i:i + self.QUERY_BATCH_SIZE]
+                  for i in range(0, len(queries), self.QUERY_BATCH_SIZE)]
         with ThreadPool(num_workers) as threads:
-            closest_docs = partial(self.closest_docs, k=k)
-            results = threads.map(closest_docs, queries)
-        return results
+            closest_docs = partial(self._chunk_closest_docs, k=k)
+            results = threads.map(closest_docs, chunks)
+        return [r for chunk in results for r in chunk]
+
+    def _chunk_closest_docs(self, queries, k=1):
+        """Score a chunk of queries against all documents at once."""
+        spmat = sp.vstack([self.text2spvec(q) for q in queries], format='csr')
+        if self.early_termination:
+            return [self._top_docs(*self._max_score_docs(spmat[i], k), k)
+                    for i in range(len(queries))]
+        # One argpartition per query is linear in the size of the product;
+        # a segmented sort of all of it (lexsort by query, then score) is
+        # not, and is much slower on queries matching many docs.
+        return [self._top_docs(scores, doc_indices, k) for scores, doc_indices
+                in utils.score_docs(spmat, self.doc_mat, self.row_scales)]
+
+    def _max_score_docs(self, spvec, k):
+        """Scores of the docs that can be in the top k (see
+        utils.max_score_docs).
+        """
+        wids, weights = spvec.indices, spvec.data
+        if self.row_scales is not None:
+            weights = weights * self.row_scales[wids]
+        return utils.max_score_docs(wids, weights, self.doc_mat,
+                                    self.row_maxes, k)
+
+    def _top_docs(self, scores, doc_indices, k):
+        """Return the ids and scores of the k top scored documents."""
+        o_sort = utils.top_k(scores, k)
+        doc_scores = scores[o_sort]
+        doc_ids = [self.get_doc_id(i) for i in doc_indices[o_sort]]
+        return doc_ids, doc_scores
 
     def parse(self, query):
         """Parse the query into tokens (either ngrams or tokens)."""
@@ -6,9 +6,12 @@
 # LICENSE file in the root directory of this source tree.
 """Various retriever utilities."""
 
+import os
+import json
 import regex
 import unicodedata
 import numpy as np
+from collections import namedtuple
 import scipy.sparse as sp
 from sklearn.utils import murmurhash3_32
 
@@ -29,13 +32,300 @@ def save_sparse_csr(filename, matrix, metadata=None):
     np.savez(filename, **data)
 
 
-def load_sparse_csr(filename):
-    loader = np.load(filename)
-    matrix = sp.csr_matrix((loader['data'], loader['indices'],
-                            loader['indptr']), shape=loader['shape'])
+# Arrays of a csr matrix whose dtype scipy does not support (float16)
+CsrArrays = namedtuple('CsrArrays', ['data', 'indices', 'indptr', 'shape'])
+
+
+def make_csr(data, indices, indptr, shape, copy=True):
+    """Build a csr matrix, or CsrArrays if scipy does not support its dtype."""
+    if data.dtype == np.float16:
+        return CsrArrays(data, indices, indptr, tuple(shape))
+    return sp.csr_matrix((data, indices, indptr), shape=tuple(shape),
+                         copy=copy)
+
+
+def load_sparse_csr(filename, mmap=True):
+    if os.path.isdir(filename):
+        return load_sparse_csr_dir(filename, mmap)
+    loader = np.load(filename, allow_pickle=True)
+    matrix = make_csr(loader['data'], loader['indices'], loader['indptr'],
+                      loader['shape'])
     return matrix, loader['metadata'].item(0) if 'metadata' in loader else None
 
 
+def save_sparse_csr_dir(dirname, matrix, metadata=None):
+    """Save a csr matrix as a directory of raw .npy arrays.
+
+    Array values of metadata are saved as .npy files too, the other (JSON
+    serializable) values go to metadata.json.
+    """
+    os.makedirs(dirname, exist_ok=True)
+    for name in ['data', 'indices', 'indptr']:
+        np.save(os.path.join(dirname, name + '.npy'), getattr(matrix, name))
+    info = {'shape': list(matrix.shape), 'arrays': [], 'metadata': {}}
+    for key, value in (metadata or {}).items():
+        if isinstance(value, np.ndarray):
+            np.save(os.path.join(dirname, key + '.npy'), value)
+            info['arrays'].append(key)
+        else:
+            info['metadata'][key] = value
+    with open(os.path.join(dirname, 'metadata.json'), 'w') as f:
+        json.dump(info, f)
+
+
+def load_sparse_csr_dir(dirname, mmap=True):
+    """Load a csr matrix saved by save_sparse_csr_dir.
+
+    With mmap, arrays are memory-mapped read-only instead of read into memory:
+    loading is near instant, and processes loading the same index share the
+    page cache.
+    """
+    mmap_mode = 'r' if mmap else None
+    with open(os.path.join(dirname, 'metadata.json')) as f:
+        info = json.load(f)
+    arrays = {
+        name: np.load(os.path.join(dirname, name + '.npy'), mmap_mode=mmap_mode)
+        for name in ['data', 'indices', 'indptr'] + info['arrays']
+    }
+    matrix = make_csr(arrays['data'], arrays['indices'], arrays['indptr'],
+                      info['shape'], copy=False)
+    metadata = info['metadata']
+    for name in info['arrays']:
+        metadata[name] = arrays[name]
+    return matrix, metadata
+
+
+def load_metadata(filename):
+    """Load only the metadata saved with a sparse matrix (by save_sparse_csr
+    or save_sparse_csr_dir). Arrays of a directory are memory-mapped.
+    """
+    if os.path.isdir(filename):
+        with open(os.path.join(filename, 'metadata.json')) as f:
+            info = json.load(f)
+        metadata = info['metadata']
+        for name in info['arrays']:
+            metadata[name] = np.load(os.path.join(filename, name + '.npy'),
+                                     mmap_mode='r')
+        return metadata
+    loader = np.load(filename, allow_pickle=True)
+    return loader['metadata'].item(0) if 'metadata' in loader else None
+
+
+# ------------------------------------------------------------------------------
+# Scoring.
+# ------------------------------------------------------------------------------
+
+
+def score_docs(spmat, doc_mat, row_scales=None):
+    """Score each row of spmat (weighted queries) against doc_mat.
+
+    Compact (quantized) matrices, i.e. with row_scales or a float16 dtype,
+    are scored term at a time from their raw arrays, without converting
+    doc_mat.
+
+    Returns:
+        list of (scores, doc indices) of the docs matching each row (views
+        of the product for a plain doc_mat, not copies).
+    """
+    if row_scales is None and sp.issparse(doc_mat):
+        res = spmat * doc_mat
+        return [(res.data[res.indptr[i]:res.indptr[i + 1]],
+                 res.indices[res.indptr[i]:res.indptr[i + 1]])
+                for i in range(spmat.shape[0])]
+
+    results = []
+    for i in range(spmat.shape[0]):
+        start, end = spmat.indptr[i], spmat.indptr[i + 1]
+        wids = spmat.indices[start:end]
+        weights = spmat.data[start:end]
+        if row_scales is not None:
+            weights = weights * row_scales[wids]
+
+        # Gather the postings of the query terms
+        starts, ends = doc_mat.indptr[wids], doc_mat.indptr[wids + 1]
+        lengths = ends - starts
+        positions = np.concatenate(
+            [np.arange(s, e) for s, e in zip(starts, ends)] +
+            [np.zeros(0, dtype=np.int64)]
+        )
+        values = doc_mat.data[positions] * np.repeat(weights, lengths)
+
+        # Sum them per doc
+        doc_indices, inverse = np.unique(doc_mat.indices[positions],
+                                         return_inverse=True)
+        scores = np.bincount(inverse, weights=values,
+                             minlength=len(doc_indices))
+        results.append((scores, doc_indices))
+    return results
+
+
+def row_max(matrix):
+    """Max stored value of each row of a csr matrix (0 for empty rows)."""
+    lengths = np.diff(matrix.indptr)
+    maxes = np.zeros(len(lengths))
+    nonempty = lengths > 0
+    maxes[nonempty] = np.maximum.reduceat(matrix.data,
+                                          matrix.indptr[:-1][nonempty])
+    return maxes
+
+
+def sort_postings(matrix):
+    """Return a csr matrix (or CsrArrays) with column indices sorted in each
+    row, copying it if needed.
+    """
+    if sp.issparse(matrix):
+        return matrix if matrix.has_sorted_indices else matrix.sorted_indices()
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    order = np.lexsort((matrix.indices, rows))
+    return CsrArrays(matrix.data[order], matrix.indices[order], matrix.indptr,
+                     matrix.shape)
+
+
+def max_score_docs(wids, weights, doc_mat, row_maxes, k):
+    """Exact top k docs of one weighted query, by MaxScore pruning.
+
+    Terms are processed from the shortest postings list. Once the k-th best
+    exact score of the docs seen so far exceeds the sum of the upper bounds
+    (weight * row max) of the remaining terms, no other doc can enter the top
+    k, and the (long) postings lists of these terms are only probed for the
+    docs already seen. Postings of doc_mat rows must be sorted by doc index.
+
+    Args:
+        wids: term (row) indices of the query.
+        weights: term weights (times the row scales of a quantized doc_mat).
+        doc_mat: term-major csr matrix (or CsrArrays) of the docs.
+        row_maxes: max value of each row of doc_mat (see row_max).
+        k: number of docs to find.
+    Returns:
+        scores, doc indices of a superset of the top k docs.
+    """
+    starts = doc_mat.indptr[wids]
+    ends = doc_mat.indptr[wids + 1]
+    order = np.argsort(ends - starts, kind='stable')
+    bounds = weights[order] * row_maxes[wids[order]]
+    # remaining[i] = max score of a doc only in the terms order[i:]
+    remaining = np.append(np.cumsum(bounds[::-1])[::-1], 0)
+
+    doc_indices = np.zeros(0, dtype=doc_mat.indices.dtype)
+    scores = np.zeros(0)
+    for i, t in enumerate(order):
+        if len(scores) >= k:
+            threshold = np.partition(scores, len(scores) - k)[-k]
+            if remaining[i] < threshold:
+                break
+        new = np.setdiff1d(doc_mat.indices[starts[t]:ends[t]], doc_indices,
+                           assume_unique=True)
+        if len(new) == 0:
+            continue
+
+        # Exact scores of the new docs, probing all postings lists
+        new_scores = np.zeros(len(new))
+        for j in range(len(wids)):
+            postings = doc_mat.indices[starts[j]:ends[j]]
+            if len(postings) == 0:
+                continue
+            pos = np.minimum(np.searchsorted(postings, new), len(postings) - 1)
+            hit = postings[pos] == new
+            new_scores[hit] += (
+                weights[j] * doc_mat.data[starts[j] + pos[hit]]
+            )
+        doc_indices = np.concatenate([doc_indices, new])
+        scores = np.concatenate([scores, new_scores])
+    return scores, doc_indices
+
+
+# ------------------------------------------------------------------------------
+# Top k selection.
+# ------------------------------------------------------------------------------
+
+
+def top_k(scores, k):
+    """Return the positions of the k highest scores, best first."""
+    if len(scores) <= k:
+        return np.argsort(-scores)
+    o = np.argpartition(-scores, k)[0:k]
+    return o[np.argsort(-scores[o])]
+
+
+# ------------------------------------------------------------------------------
+# Doc id <--> doc index table.
+# ------------------------------------------------------------------------------
+
+
+class DocIdTable(object):
+    """Compact two-way map between doc ids and doc indices.
+
+    The ids are stored as arrays only (so they can be saved alongside, and
+    memory-mapped like, the tf-idf matrix) instead of a dict and a list of
+    Python strings:
+
+    * data: utf-8 bytes of all ids, concatenated in doc index order.
+    * offsets: start of each id in data (plus the final end).
+    * order: doc indices sorted by id bytes, for binary search.
+    """
+
+    def __init__(self, data, offsets, order):
+        self.data = data
+        self.offsets = offsets
+        self.order = order
+
+    @classmethod
+    def build(cls, doc_ids):
+        """Build the table of a list of doc ids (index i = doc_ids[i])."""
+        encoded = [doc_id.encode('utf-8') for doc_id in doc_ids]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        order = np.array(sorted(range(len(encoded)), key=encoded.__getitem__),
+                         dtype=np.int64)
+        return cls(data, offsets, order)
+
+    @classmethod
+    def from_metadata(cls, metadata):
+        """Load the table from tf-idf metadata (see to_metadata).
+
+        Older metadata holding a pickled (doc_id -> index, doc_ids) doc_dict
+        are converted.
+        """
+        if 'doc_id_data' in metadata:
+            return cls(metadata['doc_id_data'], metadata['doc_id_offsets'],
+                       metadata['doc_id_order'])
+        return cls.build(metadata['doc_dict'][1])
+
+    def to_metadata(self):
+        return {
+            'doc_id_data': self.data,
+            'doc_id_offsets': self.offsets,
+            'doc_id_order': self.order,
+        }
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, doc_index):
+        """Convert doc_index --> doc_id"""
+        start, end = self.offsets[doc_index], self.offsets[doc_index + 1]
+        return self.data[start:end].tobytes().decode('utf-8')
+
+    def _key(self, doc_index):
+        start, end = self.offsets[doc_index], self.offsets[doc_index + 1]
+        return self.data[start:end].tobytes()
+
+    def index(self, doc_id):
+        """Convert doc_id --> doc_index (binary search)"""
+        key = doc_id.encode('utf-8')
+        lo, hi = 0, len(self.order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(self.order[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.order) and self._key(self.order[lo]) == key:
+            return int(self.order[lo])
+        raise KeyError(doc_id)
+
+
 # ------------------------------------------------------------------------------
 # Token hashing.
 # ------------------------------------------------------------------------------
@@ -77,6 +367,16 @@ def normalize(text):
     return unicodedata.normalize('NFD', text)
 
 
+def split_paragraphs(text):
+    """Split a document text into paragraphs (its non empty lines)."""
+    paragraphs = []
+    for split in regex.split(r'\n+', text):
+        split = split.strip()
+        if len(split) > 0:
+            paragraphs.append(split)
+    return paragraphs
+
+
 def filter_word(text):
     """Take out english stopwords, punctuation, and compound endings."""
     text = normalize(text)
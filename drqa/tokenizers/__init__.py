@@ -21,6 +21,8 @@ from .corenlp_tokenizer import CoreNLPTokenizer
 from .regexp_tokenizer import RegexpTokenizer
 from .simple_tokenizer import SimpleTokenizer
 from .mecab_tokenizer import MecabTokenizer
+from .cached_tokenizer import CachedTokenizer, TokenCache
+from .token_store import TokenStore, TokenStoreWriter
 
 # Spacy is optional
 try:
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Tokenizer wrapper that caches tokenized text on disk.
+
+Entries are keyed by a hash of the text, the tokenizer class (and MeCab
+dictionary), its options and the set of annotators, and hold the compressed Tokens (data tuples, including any line
+offsets) encoded as JSON, so that reading a cache never runs code. The cache
+is a single sqlite file, so it can be shared by all the processes of a
+ProcessPool and reused across runs.
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+import zlib
+
+from .tokenizer import Tokens, Tokenizer
+from .mecab_tokenizer import MecabTokens
+from .token_store import tokenizer_name
+
+logger = logging.getLogger(__name__)
+
+# Tokens classes that can be stored, by name.
+TOKENS_CLASSES = {cls.__name__: cls for cls in [Tokens, MecabTokens]}
+
+
+def encode_tokens(tokens):
+    """Compressed JSON encoding of Tokens (class, data, annotators, opts)."""
+    return zlib.compress(json.dumps({
+        'class': type(tokens).__name__,
+        'data': tokens.data,
+        'annotators': sorted(tokens.annotators or []),
+        'opts': tokens.opts,
+    }, ensure_ascii=False).encode('utf-8'))
+
+
+def decode_tokens(value):
+    """Tokens of an encode_tokens value (spans and line offsets as tuples)."""
+    value = json.loads(zlib.decompress(value).decode('utf-8'))
+    data = [tuple(tuple(v) if isinstance(v, list) else v for v in t)
+            for t in value['data']]
+    return TOKENS_CLASSES[value['class']](data, set(value['annotators']),
+                                          value['opts'])
+
+
+class TokenCache(object):
+    """Size bounded, least recently used, on-disk store of Tokens."""
+
+    # Only refresh the access time of an entry when it is older than this
+    # (in seconds), to avoid a write on every hit.
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, path, max_size=None):
+        """
+        Args:
+            path: path to the sqlite file holding the cache.
+            max_size: max total size (bytes) of the cached entries. Least
+              recently used entries are evicted past it. None = unbounded.
+        """
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path, timeout=60,
+                                          check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS tokens '
+                '(key BLOB PRIMARY KEY, value BLOB, size INTEGER, atime REAL)'
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS tokens_atime ON tokens (atime)'
+            )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS meta (name PRIMARY KEY, value)'
+            )
+            for name in ['size', 'hits', 'misses']:
+                self.connection.execute(
+                    'INSERT OR IGNORE INTO meta VALUES (?, 0)', (name,)
+                )
+
+    # Version of the encoding (and keys) of the entries, part of their key.
+    FORMAT = 'json2'
+
+    @classmethod
+    def key(cls, text, tokenizer_name, annotators):
+        """Content address of a text tokenized with the given options."""
+        h = hashlib.sha1()
+        h.update(cls.FORMAT.encode('utf-8'))
+        h.update(b'\0')
+        h.update(tokenizer_name.encode('utf-8'))
+        h.update(b'\0')
+        h.update(','.join(sorted(annotators or [])).encode('utf-8'))
+        h.update(b'\0')
+        h.update(text.encode('utf-8'))
+        return h.digest()
+
+    def get(self, key):
+        """Return the cached Tokens for key, or None."""
+        row = self.connection.execute(
+            'SELECT value, atime FROM tokens WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        now = time.time()
+        if now - row[1] > self.TOUCH_INTERVAL:
+            with self.connection:
+                self.connection.execute(
+                    'UPDATE tokens SET atime = ? WHERE key = ?', (now, key)
+                )
+        return decode_tokens(row[0])
+
+    def put(self, key, tokens):
+        """Store tokens under key, evicting old entries if over budget."""
+        value = encode_tokens(tokens)
+        with self.connection:
+            cursor = self.connection.execute(
+                'INSERT OR IGNORE INTO tokens VALUES (?, ?, ?, ?)',
+                (key, value, len(value), time.time())
+            )
+            if cursor.rowcount > 0:
+                self.connection.execute(
+                    "UPDATE meta SET value = value + ? WHERE name = 'size'",
+                    (len(value),)
+                )
+                self._evict()
+
+    def _evict(self):
+        """Drop least recently used entries down to 90% of max_size."""
+        if not self.max_size:
+            return
+        size = self.size()
+        if size <= self.max_size:
+            return
+        target = size - int(0.9 * self.max_size)
+        freed, keys = 0, []
+        cursor = self.connection.execute(
+            'SELECT key, size FROM tokens ORDER BY atime'
+        )
+        for key, entry_size in cursor:
+            keys.append((key,))
+            freed += entry_size
+            if freed >= target:
+                break
+        cursor.close()
+        self.connection.executemany('DELETE FROM tokens WHERE key = ?', keys)
+        self.connection.execute(
+            "UPDATE meta SET value = value - ? WHERE name = 'size'", (freed,)
+        )
+        logger.debug('Evicted %d entries (%d bytes) from %s' %
+                     (len(keys), freed, self.path))
+
+    def size(self):
+        """Total size (bytes) of the cached entries."""
+        return self._meta('size')
+
+    def stats(self):
+        """Hit/miss counters of this process, and totals over all processes
+        (those of other processes are added when they close the cache).
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'total_hits': self._meta('hits') + self.hits,
+            'total_misses': self._meta('misses') + self.misses,
+            'size': self.size(),
+        }
+
+    def _meta(self, name):
+        return self.connection.execute(
+            'SELECT value FROM meta WHERE name = ?', (name,)
+        ).fetchone()[0]
+
+    def close(self):
+        """Flush the counters of this process and close the connection."""
+        if self.connection is None:
+            return
+        with self.connection:
+            for name in ['hits', 'misses']:
+                self.connection.execute(
+                    'UPDATE meta SET value = value + ? WHERE name = ?',
+                    (getattr(self, name), name)
+                )
+        self.hits = self.misses = 0
+        self.connection.close()
+        self.connection = None
+
+
+class CachedTokenizer(Tokenizer):
+    """Wraps a tokenizer, looking up its output in a TokenCache first.
+
+    The wrapped tokenizer is only started on the first cache miss.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        Args:
+            tokenizer_class: tokenizer class (or its name) to wrap.
+            cache_path: path to the sqlite cache file.
+            cache_size: max size (bytes) of the cache (None = unbounded).
+            Other arguments (e.g. annotators) go to the wrapped tokenizer.
+        """
+        from . import get_class
+        kwargs = dict(kwargs)
+        tokenizer_class = kwargs.pop('tokenizer_class')
+        if isinstance(tokenizer_class, str):
+            tokenizer_class = get_class(tokenizer_class)
+        self.tokenizer_class = tokenizer_class
+        self.cache = TokenCache(kwargs.pop('cache_path'),
+                                kwargs.pop('cache_size', None))
+        self.annotators = set(kwargs.get('annotators', set()))
+        self.kwargs = kwargs
+        self.tokenizer = None
+
+        # Entries are only shared by the same tokenizer (and dictionary),
+        # with the same options.
+        options = {k: v for k, v in kwargs.items() if k != 'annotators'}
+        self.tokenizer_name = tokenizer_name(tokenizer_class)
+        if options:
+            self.tokenizer_name += ' ' + json.dumps(options, sort_keys=True,
+                                                    default=str)
+
+    def tokenize(self, text):
+        key = self.cache.key(text, self.tokenizer_name, self.annotators)
+        tokens = self.cache.get(key)
+        if tokens is None:
+            if self.tokenizer is None:
+                self.tokenizer = self.tokenizer_class(**self.kwargs)
+            tokens = self.tokenizer.tokenize(text)
+            self.cache.put(key, tokens)
+        return tokens
+
+    def shutdown(self):
+        if getattr(self, 'tokenizer', None) is not None:
+            self.tokenizer.shutdown()
+            self.tokenizer = None
+        if getattr(self, 'cache', None) and self.cache.connection:
+            stats = self.cache.stats()
+            logger.info('Token cache %s: %d hits, %d misses' %
+                        (self.cache.path, stats['hits'], stats['misses']))
+            self.cache.close()
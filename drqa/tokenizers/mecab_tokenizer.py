@@ -9,6 +9,7 @@
 
 import copy
 import json
+import os
 import re
 import unicodedata
 
@@ -35,7 +36,12 @@ class MecabTokens(Tokens):
         return [t[self.LINE_OFFSETS] for t in self.data]
 
 class MecabTokenizer(Tokenizer):
-  
+  # Dictionary of the tagger (tokens differ from one to another): its
+  # directory, version and number of entries.
+  DICTIONARY = '%s-v%d-%d' % (
+    os.path.join(*os.path.normpath(info.filename).split(os.sep)[-3:-1]),
+    info.version, info.size)
+
   def __init__(self, **kwargs):
     """
     Args:
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Columnar store of pre-tokenized texts (see
+scripts/retriever/build_token_store.py).
+
+Texts are tokenized and annotated once, offline, and looked up by content at
+query time. A token store is a directory holding:
+
+* keys.npy, key_checks.npy, key_entries.npy: 64 bit hashes of the stored
+  texts (sorted), a second, independent 64 bit hash of each, and its entry.
+* entry_offsets.npy: first token of each entry (plus the final end).
+* text_lengths.npy: length of each text (to check lookups).
+* spans.npy: (start, end, end_ws) character offsets of each token; the
+  whitespace of a token is text[end:end_ws].
+* words.npy, pos.npy, lemmas.npy, ner.npy: ids of the token strings in the
+  string table (-1 for None). Annotations are only stored if present.
+* line_offsets.npy: (line id, offset in line) of each token (MecabTokens).
+* string_data.npy, string_offsets.npy: utf-8 bytes of all distinct strings.
+* metadata.json: tokenizer (see tokenizer_name), annotators and Tokens
+  options.
+
+All arrays are memory-mapped, so a store can be much larger than memory.
+"""
+
+import functools
+import hashlib
+import json
+import os
+import numpy as np
+
+from .tokenizer import Tokens
+from .mecab_tokenizer import MecabTokens
+
+# Token string fields, by index in the Tokens data tuples.
+FIELDS = [(Tokens.TEXT, 'words'), (Tokens.POS, 'pos'),
+          (Tokens.LEMMA, 'lemmas'), (Tokens.NER, 'ner')]
+
+
+def text_key(text):
+    """64 bit content hash of a text."""
+    digest = hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def text_check(text):
+    """Second 64 bit content hash of a text, independent of text_key."""
+    digest = hashlib.blake2b(text.encode('utf-8'), digest_size=8,
+                             person=b'check').digest()
+    return int.from_bytes(digest, 'little')
+
+
+def tokenizer_name(tokenizer_class):
+    """Identifier of the tokens of a tokenizer class: its name, plus its
+    dictionary if it has one (MeCab).
+    """
+    dictionary = getattr(tokenizer_class, 'DICTIONARY', None)
+    if dictionary:
+        return '%s:%s' % (tokenizer_class.__name__, dictionary)
+    return tokenizer_class.__name__
+
+
+def bin_to_npy(path, name, columns=None):
+    """Convert a raw int32 column file of directory path to .npy (without
+    loading it).
+    """
+    bin_path = os.path.join(path, name + '.bin')
+    size = os.path.getsize(bin_path) // 4
+    shape = (size // columns, columns) if columns else (size,)
+    if size == 0:
+        np.save(os.path.join(path, name + '.npy'),
+                np.zeros(shape, dtype=np.int32))
+        os.remove(bin_path)
+        return
+    array = np.lib.format.open_memmap(
+        os.path.join(path, name + '.npy'), mode='w+',
+        dtype=np.int32, shape=shape
+    )
+    array.reshape(-1)[:] = np.memmap(bin_path, dtype=np.int32, mode='r',
+                                     shape=(size,))
+    array.flush()
+    del array
+    os.remove(bin_path)
+
+
+class TokenStore(object):
+    """Read only, memory-mapped store of Tokens, keyed by text."""
+
+    # Number of decoded strings kept in memory.
+    STRING_CACHE_SIZE = 2 ** 20
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'metadata.json')) as f:
+            self.metadata = json.load(f)
+        self.annotators = set(self.metadata['annotators'])
+        self.width = self.metadata['width']
+        self.opts = self.metadata['opts']
+        self.tokens_class = (MecabTokens if self.width > MecabTokens.LINE_OFFSETS
+                             else Tokens)
+
+        def load(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+        self.keys = load('keys')
+        self.key_checks = load('key_checks')
+        self.key_entries = load('key_entries')
+        self.entry_offsets = load('entry_offsets')
+        self.text_lengths = load('text_lengths')
+        self.spans = load('spans')
+        self.fields = [(i, load(name)) for i, name in FIELDS if i < self.width]
+        self.line_offsets = (load('line_offsets')
+                             if self.tokens_class is MecabTokens else None)
+        self.string_data = load('string_data')
+        self.string_offsets = load('string_offsets')
+        self.string = functools.lru_cache(self.STRING_CACHE_SIZE)(self._string)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def check(self, annotators, tokenizer_class=None):
+        """Raise an error if the store lacks any of annotators, or was built
+        with another tokenizer (or dictionary) than tokenizer_class.
+        """
+        if tokenizer_class is not None:
+            name = tokenizer_name(tokenizer_class)
+            if self.metadata['tokenizer'] != name:
+                raise RuntimeError(
+                    'Token store %s was built with tokenizer %s, not %s' %
+                    (self.path, self.metadata['tokenizer'], name)
+                )
+        missing = set(annotators or []) - self.annotators
+        if missing:
+            raise RuntimeError('Token store %s lacks annotators: %s' %
+                               (self.path, ', '.join(sorted(missing))))
+
+    def _string(self, string_id):
+        if string_id < 0:
+            return None
+        start = self.string_offsets[string_id]
+        end = self.string_offsets[string_id + 1]
+        return self.string_data[start:end].tobytes().decode('utf-8')
+
+    def index(self, text):
+        """Entry of text, or None if it is not stored."""
+        key = np.uint64(text_key(text))
+        start = np.searchsorted(self.keys, key, 'left')
+        end = np.searchsorted(self.keys, key, 'right')
+        if start == end:
+            return None
+        check = np.uint64(text_check(text))
+        for i in range(start, end):
+            entry = int(self.key_entries[i])
+            if (self.key_checks[i] == check and
+                    self.text_lengths[entry] == len(text)):
+                return entry
+        return None
+
+    def get(self, text):
+        """Return the stored Tokens of text, or None."""
+        entry = self.index(text)
+        if entry is None:
+            return None
+        start = self.entry_offsets[entry]
+        end = self.entry_offsets[entry + 1]
+
+        # Build the data tuples column by column.
+        columns = [None] * self.width
+        spans = self.spans[start:end].tolist()
+        columns[Tokens.TEXT_WS] = [text[s:ws] for s, _, ws in spans]
+        columns[Tokens.SPAN] = [(s, e) for s, e, _ in spans]
+        for i, ids in self.fields:
+            columns[i] = [self.string(j) for j in ids[start:end].tolist()]
+        if self.line_offsets is not None:
+            columns[MecabTokens.LINE_OFFSETS] = [
+                tuple(o) for o in self.line_offsets[start:end].tolist()
+            ]
+        return self.tokens_class(list(zip(*columns)), self.annotators,
+                                 opts=self.opts)
+
+    def lookup(self, texts, tokenize):
+        """Return the Tokens of all texts.
+
+        Args:
+            texts: list of texts.
+            tokenize: function mapping a list of texts to their Tokens, used
+              for the texts that are not stored.
+        """
+        tokens = [self.get(text) for text in texts]
+        missing = [i for i, t in enumerate(tokens) if t is None]
+        if missing:
+            for i, t in zip(missing, tokenize([texts[i] for i in missing])):
+                tokens[i] = t
+        return tokens
+
+
+class TokenStoreWriter(object):
+    """Writes a token store, streaming token columns to disk.
+
+    Only the string table and the keys are kept in memory. Texts that are
+    already stored are skipped.
+
+    Args:
+        path: path to the token store directory (created).
+        tokenizer: the tokenizer class the Tokens come from.
+        annotators: set of annotators of the Tokens.
+    """
+
+    # Token columns are flushed to disk every so many tokens.
+    FLUSH_SIZE = 2 ** 20
+
+    def __init__(self, path, tokenizer, annotators):
+        self.path = path
+        self.tokenizer = tokenizer_name(tokenizer)
+        self.annotators = sorted(annotators or [])
+        os.makedirs(path)
+        self.width = None
+        self.opts = {}
+        self.keys = {}
+        self.entry_offsets = [0]
+        self.text_lengths = []
+        self.strings = {}
+        self.columns = None
+        self.files = {}
+        self.buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            for f in self.files.values():
+                f.close()
+
+    def _string_id(self, string):
+        if string is None:
+            return -1
+        return self.strings.setdefault(string, len(self.strings))
+
+    def add(self, text, tokens):
+        """Add the Tokens of text."""
+        key = (text_key(text), text_check(text))
+        if key in self.keys:
+            return
+        self.keys[key] = len(self.text_lengths)
+        self.text_lengths.append(len(text))
+        self.entry_offsets.append(self.entry_offsets[-1] + len(tokens))
+        if len(tokens) == 0:
+            return
+
+        if self.width is None:
+            self._open(tokens)
+        for t in tokens.data:
+            self.columns['spans'].append(
+                (t[Tokens.SPAN][0], t[Tokens.SPAN][1],
+                 t[Tokens.SPAN][0] + len(t[Tokens.TEXT_WS]))
+            )
+            for i, name in self.fields:
+                self.columns[name].append(self._string_id(t[i]))
+            if 'line_offsets' in self.columns:
+                self.columns['line_offsets'].append(
+                    t[MecabTokens.LINE_OFFSETS]
+                )
+        self.buffered += len(tokens)
+        if self.buffered >= self.FLUSH_SIZE:
+            self._flush()
+
+    def _open(self, tokens):
+        """Set the columns up from the first (non empty) Tokens."""
+        self.width = len(tokens.data[0])
+        self.opts = tokens.opts
+        self.fields = [(i, name) for i, name in FIELDS if i < self.width]
+        names = ['spans'] + [name for _, name in self.fields]
+        if self.width > MecabTokens.LINE_OFFSETS:
+            names.append('line_offsets')
+        self.columns = {name: [] for name in names}
+        self.files = {name: open(os.path.join(self.path, name + '.bin'), 'wb')
+                      for name in names}
+
+    def _flush(self):
+        for name, values in self.columns.items():
+            self.files[name].write(np.array(values, dtype=np.int32).tobytes())
+            values.clear()
+        self.buffered = 0
+
+    def close(self):
+        """Write the remaining columns, string table, keys and metadata."""
+        if self.columns is not None:
+            self._flush()
+        for name, f in self.files.items():
+            f.close()
+            bin_to_npy(self.path, name, 2 if name == 'line_offsets' else
+                       3 if name == 'spans' else None)
+
+        def save(name, array):
+            np.save(os.path.join(self.path, name + '.npy'), array)
+
+        keys = np.array(list(self.keys.keys()), dtype=np.uint64).reshape(-1, 2)
+        entries = np.fromiter(self.keys.values(), dtype=np.int64,
+                              count=len(self.keys))
+        order = np.lexsort((keys[:, 1], keys[:, 0]))
+        save('keys', keys[order, 0])
+        save('key_checks', keys[order, 1])
+        save('key_entries', entries[order])
+        save('entry_offsets', np.array(self.entry_offsets, dtype=np.int64))
+        save('text_lengths', np.array(self.text_lengths, dtype=np.int64))
+
+        encoded = [s.encode('utf-8') for s in self.strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        save('string_data', np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        save('string_offsets', offsets)
+
+        if self.width is None:
+            # Only empty texts: store empty columns.
+            self.width = Tokens.SPAN + 1
+            save('spans', np.zeros((0, 3), dtype=np.int32))
+            save('words', np.zeros(0, dtype=np.int32))
+
+        metadata = {
+            'tokenizer': self.tokenizer,
+            'annotators': self.annotators,
+            'width': self.width,
+            'opts': self.opts,
+            'num_texts': len(self.text_lengths),
+            'num_tokens': self.entry_offsets[-1],
+            'num_strings': len(encoded),
+        }
+        with open(os.path.join(self.path, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
@@ -56,6 +56,14 @@ parser.add_argument('--parallel', action='store_true',
                     help='Use data parallel (split across gpus)')
 parser.add_argument('--num-workers', type=int, default=None,
                     help='Number of CPU processes (for tokenizing, etc)')
+parser.add_argument('--tokenizer-cache', type=str, default=None,
+                    help='Path to an on-disk cache of tokenized texts')
+parser.add_argument('--token-store', type=str, default=None,
+                    help=('Path to a store of pre-tokenized texts (see '
+                          'scripts/retriever/build_token_store.py)'))
+parser.add_argument('--feature-store', type=str, default=None,
+                    help=('Path to the precomputed model inputs of the token '
+                          'store (see scripts/reader/build_feature_store.py)'))
 parser.add_argument('--batch-size', type=int, default=128,
                     help='Document paragraph batching size')
 parser.add_argument('--predict-batch-size', type=int, default=1000,
@@ -94,6 +102,9 @@ DrQA = pipeline.DrQA(
                                'strict': False}},
     db_config={'options': {'db_path': args.doc_db}},
     num_workers=args.num_workers,
+    tokenizer_cache=args.tokenizer_cache,
+    token_store=args.token_store,
+    feature_store=args.feature_store,
 )
 
 
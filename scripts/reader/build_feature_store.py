@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""A script to precompute the question independent inputs of a model for
+all texts of a token store (see scripts/retriever/build_token_store.py).
+
+See drqa.reader.FeatureStore for the format.
+"""
+
+import argparse
+import json
+import os
+import logging
+import numpy as np
+
+from tqdm import tqdm
+from drqa import reader
+from drqa import tokenizers
+from drqa.tokenizers.tokenizer import Tokens
+from drqa.tokenizers.token_store import text_key
+from drqa.reader.feature_store import fingerprint
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+fmt = logging.Formatter('%(asctime)s: [ %(message)s ]', '%m/%d/%Y %I:%M:%S %p')
+console = logging.StreamHandler()
+console.setFormatter(fmt)
+logger.addHandler(console)
+
+
+def string_tables(model, store):
+    """Inputs of each string of the token store (the last one is None)."""
+    strings = [store.string(i) for i in range(store.metadata['num_strings'])]
+    strings.append(None)
+    word_dict, feature_dict = model.word_dict, model.feature_dict
+
+    lower_ids = {}
+    tables = {
+        'word_ids': [word_dict[s] if s is not None else 0
+                     for s in strings],
+        'lower_ids': [lower_ids.setdefault(s.lower() if s is not None
+                                           else None, len(lower_ids))
+                      for s in strings],
+        'string_hashes': [text_key(s) if s is not None else 0
+                          for s in strings],
+        'lower_hashes': [text_key(s.lower()) if s is not None else 0
+                         for s in strings],
+    }
+    for name, use in [('pos', model.args.use_pos),
+                      ('ner', model.args.use_ner)]:
+        tables[name] = [feature_dict.get('%s=%s' % (name, s), -1) if use
+                        else -1 for s in strings]
+
+    dtypes = {'word_ids': np.int32, 'lower_ids': np.int64,
+              'string_hashes': np.uint64, 'lower_hashes': np.uint64,
+              'pos': np.int16, 'ner': np.int16}
+    return {name: np.array(values, dtype=dtypes[name])
+            for name, values in tables.items()}
+
+
+def term_frequencies(words, lower_ids, lengths):
+    """tf feature of the tokens of consecutive entries (of given lengths)."""
+    entries = np.repeat(np.arange(len(lengths)), lengths)
+    keys = entries * (lower_ids.max() + 1) + lower_ids[words]
+    _, inverse, counts = np.unique(keys, return_inverse=True,
+                                   return_counts=True)
+    return (counts[inverse] / lengths[entries]).astype(np.float32)
+
+
+def build_feature_store(args):
+    logger.info('Loading model %s' % args.model)
+    model = reader.DocReader.load(args.model, normalize=False)
+    if args.embedding_file:
+        logger.info('Expanding dictionary...')
+        words = reader.utils.index_embedding_words(args.embedding_file)
+        added = model.expand_dictionary(words)
+        model.load_embeddings(added, args.embedding_file)
+
+    store = tokenizers.TokenStore(args.token_store)
+    store.check(tokenizers.get_annotators_for_model(model))
+    tables = string_tables(model, store)
+    fields = dict(store.fields)
+    num_tokens = len(store.spans)
+
+    os.makedirs(args.out_dir)
+    for name in ['string_hashes', 'lower_hashes']:
+        np.save(os.path.join(args.out_dir, name + '.npy'), tables[name])
+
+    def open_array(name, dtype):
+        return np.lib.format.open_memmap(
+            os.path.join(args.out_dir, name + '.npy'), mode='w+',
+            dtype=dtype, shape=(num_tokens,)
+        )
+
+    outputs = {
+        'word_ids': open_array('word_ids', np.int32),
+        'pos': open_array('pos', np.int16),
+        'ner': open_array('ner', np.int16),
+        'tf': open_array('tf', np.float32),
+    }
+
+    # Whole entries at a time, about CHUNK_SIZE tokens per chunk.
+    offsets = np.asarray(store.entry_offsets)
+    start = 0
+    with tqdm(total=len(offsets) - 1) as pbar:
+        while start < len(offsets) - 1:
+            end = np.searchsorted(offsets, offsets[start] + args.chunk_size,
+                                  side='right') - 1
+            end = max(end, start + 1)
+            t0, t1 = offsets[start], offsets[end]
+            words = np.asarray(fields[Tokens.TEXT][t0:t1])
+            outputs['word_ids'][t0:t1] = tables['word_ids'][words]
+            for name, field in [('pos', Tokens.POS),
+                                ('ner', Tokens.NER)]:
+                if field in fields:
+                    ids = np.asarray(fields[field][t0:t1])
+                    outputs[name][t0:t1] = tables[name][ids]
+                else:
+                    outputs[name][t0:t1] = -1
+            if model.args.use_tf and t1 > t0:
+                outputs['tf'][t0:t1] = term_frequencies(
+                    words, tables['lower_ids'], np.diff(offsets[start:end + 1])
+                )
+            else:
+                outputs['tf'][t0:t1] = 0
+            pbar.update(end - start)
+            start = end
+    for output in outputs.values():
+        output.flush()
+
+    metadata = {
+        'fingerprint': fingerprint(model),
+        'token_store': os.path.abspath(args.token_store),
+        'model': args.model,
+        'num_tokens': int(num_tokens),
+    }
+    with open(os.path.join(args.out_dir, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f)
+    logger.info('Stored the inputs of %d tokens' % num_tokens)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model', type=str,
+                        help='Path to the reader model')
+    parser.add_argument('token_store', type=str,
+                        help='Path to the token store')
+    parser.add_argument('out_dir', type=str,
+                        help='Directory to save the feature store to')
+    parser.add_argument('--embedding-file', type=str, default=None,
+                        help=('Expand dictionary to use all pretrained '
+                              'embeddings in this file (as at prediction)'))
+    parser.add_argument('--chunk-size', type=int, default=2 ** 22,
+                        help='Number of tokens processed at a time')
+    args = parser.parse_args()
+
+    if os.path.exists(args.out_dir):
+        raise RuntimeError('%s already exists! Not overwriting.' %
+                           args.out_dir)
+    build_feature_store(args)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Convert a preprocessed JSON lines file to the binary format (see
+drqa.reader.ExampleStore), without loading it in memory.
+"""
+
+import argparse
+import json
+import logging
+
+from drqa.reader.example_store import ExampleStoreWriter
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+fmt = logging.Formatter('%(asctime)s: [ %(message)s ]', '%m/%d/%Y %I:%M:%S %p')
+console = logging.StreamHandler()
+console.setFormatter(fmt)
+logger.addHandler(console)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('in_file', type=str, help='Preprocessed JSON lines')
+    parser.add_argument('out_dir', type=str, nargs='?', default=None,
+                        help='Output directory (default: in_file minus .txt)')
+    args = parser.parse_args()
+
+    out_dir = args.out_dir
+    if out_dir is None:
+        out_dir = (args.in_file[:-len('.txt')]
+                   if args.in_file.endswith('.txt') else args.in_file + '.bin')
+
+    logger.info('Converting %s to %s' % (args.in_file, out_dir))
+    with ExampleStoreWriter(out_dir) as writer, open(args.in_file) as f:
+        for line in f:
+            writer.add(json.loads(line))
+    logger.info('Wrote %d examples (%d distinct contexts)' %
+                (writer.num_examples, writer.num_contexts))
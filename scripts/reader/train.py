@@ -8,6 +8,7 @@
 """Main DrQA reader training script."""
 
 import argparse
+import itertools
 import torch
 import numpy as np
 import json
@@ -74,10 +75,10 @@ def add_train_args(parser):
                        help='Directory of training/validation data')
     files.add_argument('--train-file', type=str,
                        default='SQuAD-v1.1-train-processed-corenlp.txt',
-                       help='Preprocessed train file')
+                       help='Preprocessed train file (or binary dir)')
     files.add_argument('--dev-file', type=str,
                        default='SQuAD-v1.1-dev-processed-corenlp.txt',
-                       help='Preprocessed dev file')
+                       help='Preprocessed dev file (or binary dir)')
     files.add_argument('--dev-json', type=str, default='SQuAD-v1.1-dev.json',
                        help=('Unprocessed dev file to run validation '
                              'while training on'))
@@ -125,10 +126,10 @@ def set_defaults(args):
     if not os.path.isfile(args.dev_json):
         raise IOError('No such file: %s' % args.dev_json)
     args.train_file = os.path.join(args.data_dir, args.train_file)
-    if not os.path.isfile(args.train_file):
+    if not os.path.exists(args.train_file):
         raise IOError('No such file: %s' % args.train_file)
     args.dev_file = os.path.join(args.data_dir, args.dev_file)
-    if not os.path.isfile(args.dev_file):
+    if not os.path.exists(args.dev_file):
         raise IOError('No such file: %s' % args.dev_file)
     if args.embedding_file:
         args.embedding_file = os.path.join(args.embed_dir, args.embedding_file)
@@ -192,7 +193,7 @@ def init_from_scratch(args, train_exs, dev_exs):
     # Build a dictionary from the data questions + words (train/dev splits)
     logger.info('-' * 100)
     logger.info('Build dictionary')
-    word_dict = utils.build_word_dict(args, train_exs + dev_exs)
+    word_dict = utils.build_word_dict(args, itertools.chain(train_exs, dev_exs))
     logger.info('Num words = %d' % len(word_dict))
 
     # Initialize model
@@ -403,7 +404,7 @@ def main(args):
             if args.expand_dictionary:
                 logger.info('Expanding dictionary for new data...')
                 # Add words in training + dev examples
-                words = utils.load_words(args, train_exs + dev_exs)
+                words = utils.load_words(args, itertools.chain(train_exs, dev_exs))
                 added = model.expand_dictionary(words)
                 # Load pretrained embeddings for added words
                 if args.embedding_file:
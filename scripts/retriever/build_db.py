@@ -14,6 +14,7 @@ import logging
 import importlib.util
 
 from multiprocessing import Pool as ProcessPool
+from functools import partial
 from tqdm import tqdm
 from drqa.retriever import utils
 
@@ -83,9 +84,58 @@ def get_contents(filename):
     return documents
 
 
-def store_contents(data_path, save_path, preprocess, num_workers=None):
+def get_file_contents(split, filename):
+    """Parse the contents of a file, returned with its name and, if split,
+    the (doc id, paragraph index, paragraph) of its docs.
+    """
+    documents = get_contents(filename)
+    paragraphs = []
+    if split:
+        for doc_id, text in documents:
+            for i, paragraph in enumerate(utils.split_paragraphs(text)):
+                paragraphs.append((doc_id, i, paragraph))
+    return filename, documents, paragraphs
+
+
+def remove_duplicates(conn, paragraphs=False):
+    """Keep only the first stored copy of each doc id (and re-split its
+    paragraphs if stored). Return the number of duplicated ids.
+    """
+    c = conn.cursor()
+    c.execute("CREATE TEMP TABLE duplicates AS SELECT id FROM documents "
+              "GROUP BY id HAVING COUNT(*) > 1;")
+    c.execute("SELECT COUNT(*) FROM duplicates")
+    num_duplicates = c.fetchone()[0]
+    if num_duplicates:
+        c.execute("DELETE FROM documents WHERE id IN "
+                  "(SELECT id FROM duplicates) AND rowid NOT IN "
+                  "(SELECT MIN(rowid) FROM documents GROUP BY id);")
+        if paragraphs:
+            c.execute("DELETE FROM paragraphs WHERE doc_id IN "
+                      "(SELECT id FROM duplicates);")
+            c.execute("SELECT id, text FROM documents WHERE id IN "
+                      "(SELECT id FROM duplicates);")
+            splits = [(doc_id, i, paragraph)
+                      for doc_id, text in c.fetchall()
+                      for i, paragraph in
+                      enumerate(utils.split_paragraphs(text))]
+            c.executemany("INSERT INTO paragraphs VALUES (?,?,?)", splits)
+    c.execute("DROP TABLE duplicates;")
+    conn.commit()
+    return num_duplicates
+
+
+def store_contents(data_path, save_path, preprocess, num_workers=None,
+                   resume=False, journal_mode='memory', page_size=65536,
+                   commit_every=100000, paragraphs=False,
+                   drop_duplicates=False):
     """Preprocess and store a corpus of documents in sqlite.
 
+    Documents are bulk loaded with no durability guarantees (synchronous off,
+    no on-disk journal by default), and committed every `commit_every` docs
+    along with the names of the files they come from. The unique index on
+    doc ids is only built once all documents are loaded.
+
     Args:
         data_path: Root path to directory (or directory of directories) of files
           containing json encoded documents (must have `id` and `text` fields).
@@ -93,25 +143,100 @@ def store_contents(data_path, save_path, preprocess, num_workers=None):
         preprocess: Path to file defining a custom `preprocess` function. Takes
           in and outputs a structured doc.
         num_workers: Number of parallel processes to use when reading docs.
+        resume: continue loading a partially built db, skipping the files
+          already committed.
+        journal_mode: sqlite journal mode during the load ('memory', 'off',
+          or e.g. 'truncate' to keep the db safe from crashes).
+        page_size: sqlite page size of a new db.
+        commit_every: number of docs per transaction.
+        paragraphs: also store docs split in paragraphs, in a table keyed by
+          (doc_id, para_idx) (see DocDB.get_doc_paragraphs).
+        drop_duplicates: keep only the first stored doc of each id, instead
+          of failing on duplicate ids.
     """
-    if os.path.isfile(save_path):
+    if os.path.isfile(save_path) and not resume:
         raise RuntimeError('%s already exists! Not overwriting.' % save_path)
 
     logger.info('Reading into database...')
     conn = sqlite3.connect(save_path)
+    conn.execute('PRAGMA page_size = %d' % page_size)
+    conn.execute('PRAGMA journal_mode = %s' % journal_mode)
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA cache_size = -%d' % (256 * 1024))
+    conn.execute('PRAGMA temp_store = MEMORY')
     c = conn.cursor()
-    c.execute("CREATE TABLE documents (id PRIMARY KEY, text);")
+    c.execute("CREATE TABLE IF NOT EXISTS documents (id, text);")
+    c.execute("CREATE TABLE IF NOT EXISTS loaded_files "
+              "(filename PRIMARY KEY);")
+    if paragraphs:
+        c.execute("CREATE TABLE IF NOT EXISTS paragraphs "
+                  "(doc_id, para_idx, text);")
+    conn.commit()
 
-    workers = ProcessPool(num_workers, initializer=init, initargs=(preprocess,))
     files = [f for f in iter_files(data_path)]
+    if resume:
+        c.execute("SELECT filename FROM loaded_files")
+        loaded = {r[0] for r in c.fetchall()}
+        logger.info('Resuming: %d/%d files already loaded.' %
+                    (len(loaded & set(files)), len(files)))
+        files = [f for f in files if f not in loaded]
+
+    workers = ProcessPool(num_workers, initializer=init,
+                          initargs=(preprocess,))
     count = 0
-    with tqdm(total=len(files)) as pbar:
-        for pairs in tqdm(workers.imap_unordered(get_contents, files)):
-            count += len(pairs)
-            c.executemany("INSERT INTO documents VALUES (?,?)", pairs)
-            pbar.update()
+    pending = 0
+    try:
+        with tqdm(total=len(files)) as pbar:
+            contents = workers.imap_unordered(
+                partial(get_file_contents, paragraphs), files
+            )
+            for filename, pairs, splits in contents:
+                count += len(pairs)
+                pending += len(pairs)
+                c.executemany("INSERT INTO documents VALUES (?,?)", pairs)
+                if splits:
+                    c.executemany("INSERT INTO paragraphs VALUES (?,?,?)",
+                                  splits)
+                c.execute("INSERT INTO loaded_files VALUES (?)", (filename,))
+                if pending >= commit_every:
+                    conn.commit()
+                    pending = 0
+                pbar.update()
+        conn.commit()
+    except BaseException:
+        # Only keep fully loaded files, for resuming
+        conn.rollback()
+        conn.close()
+        raise
+    finally:
+        workers.terminate()
     logger.info('Read %d docs.' % count)
-    logger.info('Committing...')
+
+    if drop_duplicates:
+        logger.info('Dropped %d duplicate doc ids.' %
+                    remove_duplicates(conn, paragraphs))
+
+    logger.info('Indexing doc ids...')
+    try:
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS documents_id "
+                  "ON documents (id);")
+    except sqlite3.IntegrityError:
+        # Docs are only checked for unique ids once all are loaded
+        c.execute("SELECT id, COUNT(*) FROM documents GROUP BY id "
+                  "HAVING COUNT(*) > 1;")
+        duplicates = c.fetchall()
+        conn.close()
+        for doc_id, num in duplicates[:100]:
+            logger.error('Doc id %s is used %d times' % (doc_id, num))
+        raise RuntimeError(
+            '%d doc ids are not unique (see above). All docs are loaded in '
+            '%s: run again with --resume --drop-duplicates to keep the '
+            'first of each, or fix the data and start over.' %
+            (len(duplicates), save_path)
+        )
+    if paragraphs:
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS paragraphs_id "
+                  "ON paragraphs (doc_id, para_idx);")
     conn.commit()
     conn.close()
 
@@ -130,8 +255,24 @@ if __name__ == '__main__':
                               'a `preprocess` function'))
     parser.add_argument('--num-workers', type=int, default=None,
                         help='Number of CPU processes (for tokenizing, etc)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue loading a partially built db')
+    parser.add_argument('--journal-mode', type=str, default='memory',
+                        choices=['memory', 'off', 'truncate', 'delete'],
+                        help=('Sqlite journal mode while loading (memory/off '
+                              'are fastest, but a crash can corrupt the db)'))
+    parser.add_argument('--page-size', type=int, default=65536,
+                        help='Sqlite page size of the db')
+    parser.add_argument('--commit-every', type=int, default=100000,
+                        help='Number of docs per transaction')
+    parser.add_argument('--paragraphs', action='store_true',
+                        help='Also store docs split in paragraphs')
+    parser.add_argument('--drop-duplicates', action='store_true',
+                        help='Keep the first doc of each duplicate id')
     args = parser.parse_args()
 
     store_contents(
-        args.data_path, args.save_path, args.preprocess, args.num_workers
+        args.data_path, args.save_path, args.preprocess, args.num_workers,
+        args.resume, args.journal_mode, args.page_size, args.commit_every,
+        args.paragraphs, args.drop_duplicates
     )
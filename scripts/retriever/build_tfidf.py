@@ -12,6 +12,8 @@ import argparse
 import os
 import math
 import logging
+import tempfile
+import json
 
 from multiprocessing import Pool as ProcessPool
 from multiprocessing.util import Finalize
@@ -38,9 +40,9 @@ PROCESS_TOK = None
 PROCESS_DB = None
 
 
-def init(tokenizer_class, db_class, db_opts):
+def init(tokenizer_class, tokenizer_opts, db_class, db_opts):
     global PROCESS_TOK, PROCESS_DB
-    PROCESS_TOK = tokenizer_class()
+    PROCESS_TOK = tokenizer_class(**tokenizer_opts)
     Finalize(PROCESS_TOK, PROCESS_TOK.shutdown, exitpriority=100)
     PROCESS_DB = db_class(**db_opts)
     Finalize(PROCESS_DB, PROCESS_DB.close, exitpriority=100)
@@ -64,7 +66,6 @@ def tokenize(text):
 def count(ngram, hash_size, doc_id):
     """Fetch the text of a document and compute hashed ngrams counts."""
     global DOC2IDX
-    row, col, data = [], [], []
     # Tokenize
     tokens = tokenize(retriever.utils.normalize(fetch_text(doc_id)))
 
@@ -76,70 +77,233 @@ def count(ngram, hash_size, doc_id):
     # Hash ngrams and count occurences
     counts = Counter([retriever.utils.hash(gram, hash_size) for gram in ngrams])
 
-    # Return in sparse matrix data format.
-    row.extend(counts.keys())
-    col.extend([DOC2IDX[doc_id]] * len(counts))
-    data.extend(counts.values())
-    return row, col, data
+    # Return in sparse matrix column format.
+    row = np.fromiter(counts.keys(), dtype=np.int32, count=len(counts))
+    data = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+    return DOC2IDX[doc_id], row, data
 
 
-def get_count_matrix(args, db, db_opts):
+def get_count_matrix(args, db, db_opts, doc_ids=None):
     """Form a sparse word to document count matrix (inverted index).
 
     M[i, j] = # times word i appears in document j.
+
+    Documents are all those of the db, or only doc_ids if given (then column j
+    is doc_ids[j]).
+
+    Document columns are buffered up to args.memory_budget MB, then spilled
+    to disk as shards which are merged at the end. Peak memory is about the
+    size of the final matrix plus the budget.
     """
     # Map doc_ids to indexes
     global DOC2IDX
     db_class = retriever.get_class(db)
-    with db_class(**db_opts) as doc_db:
-        doc_ids = doc_db.get_doc_ids()
+    if doc_ids is None:
+        with db_class(**db_opts) as doc_db:
+            doc_ids = doc_db.get_doc_ids()
     DOC2IDX = {doc_id: i for i, doc_id in enumerate(doc_ids)}
 
     # Setup worker pool
     tok_class = tokenizers.get_class(args.tokenizer)
+    tok_opts = {}
+    if args.tokenizer_cache:
+        tok_opts = {'tokenizer_class': tok_class,
+                    'cache_path': args.tokenizer_cache}
+        tok_class = tokenizers.CachedTokenizer
     workers = ProcessPool(
         args.num_workers,
         initializer=init,
-        initargs=(tok_class, db_class, db_opts)
+        initargs=(tok_class, tok_opts, db_class, db_opts)
     )
 
-    # Compute the count matrix in steps (to keep in memory)
+    # Compute the count matrix in steps, spilling shards to disk
     logger.info('Mapping...')
-    row, col, data = [], [], []
+    budget = args.memory_budget * 1024 * 1024
     step = max(int(len(doc_ids) / 10), 1)
     batches = [doc_ids[i:i + step] for i in range(0, len(doc_ids), step)]
     _count = partial(count, args.ngram, args.hash_size)
-    for i, batch in enumerate(batches):
-        logger.info('-' * 25 + 'Batch %d/%d' % (i + 1, len(batches)) + '-' * 25)
-        for b_row, b_col, b_data in workers.imap_unordered(_count, batch):
-            row.extend(b_row)
-            col.extend(b_col)
-            data.extend(b_data)
-    workers.close()
-    workers.join()
-
-    logger.info('Creating sparse matrix...')
-    count_matrix = sp.csr_matrix(
-        (data, (row, col)), shape=(args.hash_size, len(doc_ids))
-    )
-    count_matrix.sum_duplicates()
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        shards, columns, size = [], [], 0
+        for i, batch in enumerate(batches):
+            logger.info(
+                '-' * 25 + 'Batch %d/%d' % (i + 1, len(batches)) + '-' * 25
+            )
+            for column in workers.imap_unordered(_count, batch):
+                columns.append(column)
+                size += column[1].nbytes + column[2].nbytes
+                if size >= budget:
+                    shards.append(save_shard(tmp_dir, len(shards), columns))
+                    columns, size = [], 0
+        if columns:
+            shards.append(save_shard(tmp_dir, len(shards), columns))
+        workers.close()
+        workers.join()
+
+        logger.info('Creating sparse matrix from %d shards...' % len(shards))
+        count_matrix = merge_shards(shards, (args.hash_size, len(doc_ids)))
     return count_matrix, (DOC2IDX, doc_ids)
 
 
+def save_shard(tmp_dir, idx, columns):
+    """Save document columns (doc index, rows, counts) as a row sorted shard
+    of (row, col, data) entries.
+    """
+    row = np.concatenate([c[1] for c in columns])
+    col = np.repeat(np.array([c[0] for c in columns], dtype=np.int32),
+                    [len(c[1]) for c in columns])
+    data = np.concatenate([c[2] for c in columns])
+    order = np.argsort(row, kind='stable')
+    filename = os.path.join(tmp_dir, 'shard-%d.npz' % idx)
+    np.savez(filename, row=row[order], col=col[order], data=data[order])
+    logger.info('Saved shard %d (%d entries)' % (idx, len(row)))
+    return filename
+
+
+def merge_shards(filenames, shape):
+    """Merge shards into a single csr matrix, filling it in place."""
+    # Count entries per row, to allocate the matrix once
+    indptr = np.zeros(shape[0] + 1, dtype=np.int64)
+    for filename in filenames:
+        with np.load(filename) as shard:
+            rows, counts = np.unique(shard['row'], return_counts=True)
+            indptr[rows + 1] += counts
+    np.cumsum(indptr, out=indptr)
+
+    # Copy each shard at the end of the rows filled so far
+    indices = np.empty(indptr[-1], dtype=np.int32)
+    data = np.empty(indptr[-1], dtype=np.int64)
+    cursor = indptr[:-1].copy()
+    for filename in filenames:
+        with np.load(filename) as shard:
+            row = shard['row']
+            rank = np.arange(len(row)) - np.searchsorted(row, row)
+            pos = cursor[row] + rank
+            indices[pos] = shard['col']
+            data[pos] = shard['data']
+            rows, counts = np.unique(row, return_counts=True)
+            cursor[rows] += counts
+
+    count_matrix = sp.csr_matrix((data, indices, indptr), shape=shape)
+    count_matrix.sort_indices()
+    return count_matrix
+
+
+# ------------------------------------------------------------------------------
+# Update the count matrix of a previous generation.
+# ------------------------------------------------------------------------------
+
+
+def read_doc_ids(filename):
+    """Read a file of doc ids, one per line."""
+    if not filename:
+        return []
+    with open(filename) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def update_count_matrix(args, db, db_opts):
+    """Patch the count matrix saved by a previous run (args.update).
+
+    Only the added and modified documents are counted again. Removed
+    documents are dropped, modified ones keep their column and added ones are
+    appended. Doc freqs are patched from the changed columns only.
+
+    Returns:
+        count_matrix, doc_ids, doc_freqs and metadata of the previous run.
+    """
+    logger.info('Loading previous counts from %s' % args.update)
+    counts, metadata = retriever.utils.load_sparse_csr(args.update, mmap=False)
+
+    # Count with the same options as the previous run
+    for key in ['tokenizer', 'hash_size', 'ngram']:
+        if getattr(args, key) != metadata[key]:
+            logger.info('Using %s = %s of previous run' % (key, metadata[key]))
+            setattr(args, key, metadata[key])
+
+    table = retriever.utils.DocIdTable.from_metadata(metadata)
+    doc_ids = [table[i] for i in range(len(table))]
+    added = read_doc_ids(args.added)
+    removed = set(read_doc_ids(args.removed))
+    modified = read_doc_ids(args.modified)
+
+    # Resolve changed ids to columns. Unknown modified docs are new, known
+    # added docs were modified.
+    changed = {}
+    for doc_id in modified + added:
+        try:
+            changed[doc_id] = table.index(doc_id)
+        except KeyError:
+            changed[doc_id] = None
+    for doc_id in removed:
+        if doc_id in changed:
+            raise RuntimeError('%s is both removed and added/modified' %
+                               doc_id)
+    modified = [d for d, i in changed.items() if i is not None]
+    added = [d for d, i in changed.items() if i is None]
+    removed_idx = set()
+    for doc_id in removed:
+        try:
+            removed_idx.add(table.index(doc_id))
+        except KeyError:
+            logger.warning('Removed doc %s is not in the index' % doc_id)
+    logger.info('Docs: %d added, %d removed, %d modified' %
+                (len(added), len(removed_idx), len(modified)))
+
+    # Count the new versions of the changed documents
+    recount_ids = modified + added
+    recounts, _ = get_count_matrix(args, db, db_opts, recount_ids)
+
+    # Patch doc freqs with the old and new columns of changed documents
+    stale = np.array(sorted(removed_idx | {changed[d] for d in modified}),
+                     dtype=np.int64)
+    freqs = np.array(metadata['doc_freqs'], dtype=np.int64)
+    freqs -= get_doc_freqs(counts[:, stale])
+    freqs += get_doc_freqs(recounts)
+
+    # Clear stale columns, drop removed ones, then add the new counts
+    logger.info('Patching count matrix...')
+    is_stale = np.zeros(counts.shape[1], dtype=bool)
+    is_stale[stale] = True
+    keep = np.array([i for i in range(len(doc_ids)) if i not in removed_idx],
+                    dtype=np.int64)
+    new_doc_ids = [doc_ids[i] for i in keep] + added
+    base = counts.tocsc(copy=True)
+    base.data[np.repeat(is_stale, np.diff(base.indptr))] = 0
+    base = base[:, keep].tocsr()
+    base.eliminate_zeros()
+    base.resize((counts.shape[0], len(new_doc_ids)))
+    cols = np.concatenate([
+        np.searchsorted(keep, [changed[d] for d in modified]),
+        np.arange(len(keep), len(keep) + len(added)),
+    ]).astype(np.int64)
+    placement = sp.csr_matrix(
+        (np.ones(len(recount_ids), dtype=counts.dtype),
+         (np.arange(len(recount_ids)), cols)),
+        shape=(len(recount_ids), len(new_doc_ids))
+    )
+    count_matrix = (base + recounts.dot(placement)).tocsr()
+    count_matrix = count_matrix.astype(counts.dtype, copy=False)
+    count_matrix.sort_indices()
+    return count_matrix, new_doc_ids, freqs, metadata
+
+
 # ------------------------------------------------------------------------------
 # Transform count matrix to different forms.
 # ------------------------------------------------------------------------------
 
 
-def get_tfidf_matrix(cnts):
+def get_tfidf_matrix(cnts, Ns=None):
     """Convert the word count matrix into tfidf one.
 
     tfidf = log(tf + 1) * log((N - Nt + 0.5) / (Nt + 0.5))
     * tf = term frequency in document
     * N = number of documents
     * Nt = number of occurences of term in all documents
+
+    Ns can be given if already known (see get_doc_freqs).
     """
-    Ns = get_doc_freqs(cnts)
+    if Ns is None:
+        Ns = get_doc_freqs(cnts)
     idfs = np.log((cnts.shape[1] - Ns + 0.5) / (Ns + 0.5))
     idfs[idfs < 0] = 0
     idfs = sp.diags(idfs, 0)
@@ -148,6 +312,62 @@ def get_tfidf_matrix(cnts):
     return tfidfs
 
 
+def prune_tfidf_matrix(tfidfs, threshold=None, top=None):
+    """Drop the postings of a tfidf matrix below a weight threshold, and/or
+    beyond the top weighted ones of each term (row).
+    """
+    tfidfs = tfidfs.tocsr()
+    if threshold:
+        tfidfs.data[tfidfs.data < threshold] = 0
+        tfidfs.eliminate_zeros()
+    if top:
+        lengths = np.diff(tfidfs.indptr)
+        rows = np.repeat(np.arange(tfidfs.shape[0]), lengths)
+        # Rank of each posting in its row, by decreasing weight
+        order = np.lexsort((-tfidfs.data, rows))
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order)) - tfidfs.indptr[rows[order]]
+        keep = rank < top
+        indptr = np.zeros(tfidfs.shape[0] + 1, dtype=tfidfs.indptr.dtype)
+        np.cumsum(np.bincount(rows[keep], minlength=tfidfs.shape[0]),
+                  out=indptr[1:])
+        tfidfs = sp.csr_matrix(
+            (tfidfs.data[keep], tfidfs.indices[keep], indptr),
+            shape=tfidfs.shape
+        )
+    return tfidfs
+
+
+def quantize_tfidf_matrix(tfidfs, dtype):
+    """Store the weights of a tfidf matrix as float16, or as uint8 with a
+    scale per term (row): weight ~= value * row_scales[row].
+
+    Returns:
+        matrix (csr or retriever.utils.CsrArrays), row_scales (or None)
+    """
+    tfidfs = tfidfs.tocsr()
+    if dtype == 'float64':
+        return tfidfs, None
+    if dtype == 'float16':
+        return retriever.utils.make_csr(
+            tfidfs.data.astype(np.float16), tfidfs.indices, tfidfs.indptr,
+            tfidfs.shape
+        ), None
+    if dtype == 'uint8':
+        row_scales = (tfidfs.max(axis=1).toarray().ravel() / 255)
+        row_scales = row_scales.astype(np.float32)
+        scales = np.repeat(row_scales, np.diff(tfidfs.indptr))
+        scales[scales == 0] = 1
+        # Keep every posting: small weights are rounded up to 1
+        data = np.clip(np.rint(tfidfs.data / scales), 1, 255)
+        data[tfidfs.data == 0] = 0
+        return sp.csr_matrix(
+            (data.astype(np.uint8), tfidfs.indices, tfidfs.indptr),
+            shape=tfidfs.shape
+        ), row_scales
+    raise ValueError('Invalid dtype: %s' % dtype)
+
+
 def get_doc_freqs(cnts):
     """Return word --> # of docs it appears in."""
     binary = (cnts > 0).astype(int)
@@ -155,6 +375,65 @@ def get_doc_freqs(cnts):
     return freqs
 
 
+# ------------------------------------------------------------------------------
+# Save the tfidf matrix in shards.
+# ------------------------------------------------------------------------------
+
+
+def save(filename, matrix, metadata, fmt):
+    """Save as a .npz file or a directory of memory-mappable arrays."""
+    if fmt == 'mmap':
+        logger.info('Saving to %s/' % filename)
+        retriever.utils.save_sparse_csr_dir(filename, matrix, metadata)
+    else:
+        logger.info('Saving to %s.npz' % filename)
+        retriever.utils.save_sparse_csr(filename, matrix, metadata)
+
+
+def save_quantized(filename, tfidf, metadata, fmt, dtype):
+    """Quantize the tfidf matrix to dtype and save it.
+
+    Postings are sorted by doc, and the max weight of each ngram is saved
+    (as row_max), for early termination (see TfidfDocRanker).
+    """
+    tfidf = tfidf.tocsr()
+    tfidf.sort_indices()
+    tfidf, row_scales = quantize_tfidf_matrix(tfidf, dtype)
+    metadata = dict(metadata, quantization=dtype,
+                    row_max=retriever.utils.row_max(tfidf))
+    if row_scales is not None:
+        metadata['row_scales'] = row_scales
+    save(filename, tfidf, metadata, fmt)
+
+
+def save_shards(dirname, tfidf, metadata, doc_ids, num_shards, fmt,
+                dtype='float64'):
+    """Split the documents (columns) in num_shards ranges, saved to dirname
+    with a manifest (see retriever.ShardedTfidfDocRanker).
+
+    Every shard keeps the global doc freqs and number of docs, so that
+    queries are weighted the same on all shards. Shards are quantized to
+    dtype separately.
+    """
+    os.makedirs(dirname, exist_ok=True)
+    tfidf = tfidf.tocsc()
+    bounds = np.linspace(0, len(doc_ids), num_shards + 1).astype(int)
+    names = []
+    for i in range(num_shards):
+        start, end = bounds[i], bounds[i + 1]
+        shard_metadata = dict(metadata)
+        shard_metadata.update(
+            retriever.utils.DocIdTable.build(doc_ids[start:end]).to_metadata()
+        )
+        shard_metadata['num_docs'] = len(doc_ids)
+        name = 'shard-%d' % i
+        save_quantized(os.path.join(dirname, name), tfidf[:, start:end],
+                       shard_metadata, fmt, dtype)
+        names.append(name + ('.npz' if fmt == 'npz' else ''))
+    with open(os.path.join(dirname, 'shards.json'), 'w') as f:
+        json.dump({'num_docs': len(doc_ids), 'shards': names}, f)
+
+
 # ------------------------------------------------------------------------------
 # Main.
 # ------------------------------------------------------------------------------
@@ -166,6 +445,8 @@ if __name__ == '__main__':
                         help='Path to sqlite db holding document texts')
     parser.add_argument('out_dir', type=str, default=None,
                         help='Directory for saving output files')
+    parser.add_argument('--db', type=str, default='sqlite',
+                        help="Doc db class (e.g. 'compressed')")
     parser.add_argument('--ngram', type=int, default=2,
                         help=('Use up to N-size n-grams '
                               '(e.g. 2 = unigrams + bigrams)'))
@@ -176,30 +457,96 @@ if __name__ == '__main__':
                               "(e.g. 'corenlp')"))
     parser.add_argument('--num-workers', type=int, default=None,
                         help='Number of CPU processes (for tokenizing, etc)')
+    parser.add_argument('--tokenizer-cache', type=str, default=None,
+                        help='Path to an on-disk cache of tokenized texts')
+    parser.add_argument('--memory-budget', type=int, default=1024,
+                        help=('Memory (MB) for buffering counts before '
+                              'spilling them to disk'))
+    parser.add_argument('--tmp-dir', type=str, default=None,
+                        help='Directory for spilled count shards')
+    parser.add_argument('--save-counts', action='store_true',
+                        help=('Also save the count matrix, so that the index '
+                              'can be updated later (see --update)'))
+    parser.add_argument('--update', type=str, default=None,
+                        help=('Counts saved by a previous run: only recount '
+                              'the changed docs and save a new generation'))
+    parser.add_argument('--added', type=str, default=None,
+                        help='File of added doc ids (one per line)')
+    parser.add_argument('--removed', type=str, default=None,
+                        help='File of removed doc ids (one per line)')
+    parser.add_argument('--modified', type=str, default=None,
+                        help='File of modified doc ids (one per line)')
+    parser.add_argument('--format', type=str, default='npz',
+                        choices=['npz', 'mmap'],
+                        help=('Save as a single .npz file, or as a directory '
+                              'of .npy arrays that can be memory-mapped'))
+    parser.add_argument('--dtype', type=str, default='float64',
+                        choices=['float64', 'float16', 'uint8'],
+                        help=('Type of the stored weights (uint8 weights are '
+                              'scaled per ngram)'))
+    parser.add_argument('--prune-threshold', type=float, default=None,
+                        help='Drop postings with a tfidf weight below this')
+    parser.add_argument('--prune-top', type=int, default=None,
+                        help='Only keep the top N weighted docs of each ngram')
+    parser.add_argument('--num-shards', type=int, default=1,
+                        help=('Split the index in N shards of documents, to '
+                              'be served by ShardedTfidfDocRanker'))
     args = parser.parse_args()
 
-    logging.info('Counting words...')
-    count_matrix, doc_dict = get_count_matrix(
-        args, 'sqlite', {'db_path': args.db_path}
-    )
+    if args.update:
+        logging.info('Updating counts...')
+        count_matrix, doc_ids, freqs, previous = update_count_matrix(
+            args, args.db, {'db_path': args.db_path}
+        )
+        generation = previous.get('generation', 0) + 1
+        args.save_counts = True
+    else:
+        logging.info('Counting words...')
+        count_matrix, (_, doc_ids) = get_count_matrix(
+            args, args.db, {'db_path': args.db_path}
+        )
+
+        logger.info('Getting word-doc frequencies...')
+        freqs = get_doc_freqs(count_matrix)
+        generation = 0
 
     logger.info('Making tfidf vectors...')
-    tfidf = get_tfidf_matrix(count_matrix)
-
-    logger.info('Getting word-doc frequencies...')
-    freqs = get_doc_freqs(count_matrix)
-
-    basename = os.path.splitext(os.path.basename(args.db_path))[0]
+    tfidf = get_tfidf_matrix(count_matrix, freqs)
+
+    if args.prune_threshold or args.prune_top:
+        logger.info('Pruning tfidf vectors...')
+        nnz = tfidf.nnz
+        tfidf = prune_tfidf_matrix(tfidf, args.prune_threshold,
+                                   args.prune_top)
+        logger.info('Kept %d/%d postings' % (tfidf.nnz, nnz))
+
+    basename = os.path.splitext(
+        os.path.basename(os.path.normpath(args.db_path))
+    )[0]
     basename += ('-tfidf-ngram=%d-hash=%d-tokenizer=%s' %
                  (args.ngram, args.hash_size, args.tokenizer))
+    if generation > 0:
+        basename += '-gen=%d' % generation
+    if args.prune_threshold:
+        basename += '-min=%g' % args.prune_threshold
+    if args.prune_top:
+        basename += '-top=%d' % args.prune_top
+    if args.dtype != 'float64':
+        basename += '-%s' % args.dtype
     filename = os.path.join(args.out_dir, basename)
 
-    logger.info('Saving to %s.npz' % filename)
     metadata = {
         'doc_freqs': freqs,
         'tokenizer': args.tokenizer,
         'hash_size': args.hash_size,
         'ngram': args.ngram,
-        'doc_dict': doc_dict
+        'generation': generation,
     }
-    retriever.utils.save_sparse_csr(filename, tfidf, metadata)
+    metadata.update(retriever.utils.DocIdTable.build(doc_ids).to_metadata())
+    if args.num_shards > 1:
+        save_shards(filename + '-shards=%d' % args.num_shards, tfidf, metadata,
+                    doc_ids, args.num_shards, args.format, args.dtype)
+    else:
+        save_quantized(filename, tfidf, metadata, args.format, args.dtype)
+    if args.save_counts:
+        save(filename + '-counts', count_matrix, metadata, args.format)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""A script to tokenize and annotate all paragraphs of a doc db, offline.
+
+The pipeline (and Predictor) look the paragraphs up in the resulting store
+instead of tokenizing them. See drqa.tokenizers.TokenStore for the format.
+With --dataset, the contexts of a SQuAD formatted dataset are stored instead
+(e.g. for scripts/shinra/predict_shinra.py).
+"""
+
+import argparse
+import json
+import os
+import logging
+
+from multiprocessing import Pool as ProcessPool
+from multiprocessing.util import Finalize
+from functools import partial
+from tqdm import tqdm
+
+from drqa import retriever
+from drqa import tokenizers
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+fmt = logging.Formatter('%(asctime)s: [ %(message)s ]', '%m/%d/%Y %I:%M:%S %p')
+console = logging.StreamHandler()
+console.setFormatter(fmt)
+logger.addHandler(console)
+
+
+# ------------------------------------------------------------------------------
+# Multiprocessing functions
+# ------------------------------------------------------------------------------
+
+PROCESS_TOK = None
+PROCESS_DB = None
+
+
+def init(tokenizer_class, tokenizer_opts, db_class=None, db_opts=None):
+    global PROCESS_TOK, PROCESS_DB
+    PROCESS_TOK = tokenizer_class(**tokenizer_opts)
+    Finalize(PROCESS_TOK, PROCESS_TOK.shutdown, exitpriority=100)
+    if db_class is not None:
+        PROCESS_DB = db_class(**db_opts)
+        Finalize(PROCESS_DB, PROCESS_DB.close, exitpriority=100)
+
+
+def group_paragraphs(paragraphs, group_length):
+    """Group the paragraphs of a doc as the pipeline does (see
+    DrQA._group_paragraphs).
+    """
+    curr = []
+    curr_len = 0
+    for split in paragraphs:
+        if len(curr) > 0 and curr_len + len(split) > group_length:
+            yield ' '.join(curr)
+            curr = []
+            curr_len = 0
+        curr.append(split)
+        curr_len += len(split)
+    if len(curr) > 0:
+        yield ' '.join(curr)
+
+
+def tokenize_docs(group_length, doc_ids):
+    """Fetch the paragraphs of docs, and tokenize them."""
+    global PROCESS_TOK, PROCESS_DB
+    results = []
+    for paragraphs in PROCESS_DB.get_doc_paragraphs(doc_ids):
+        for text in group_paragraphs(paragraphs, group_length):
+            results.append((text, PROCESS_TOK.tokenize(text)))
+    return results
+
+
+def tokenize_texts(texts):
+    global PROCESS_TOK
+    return [(text, PROCESS_TOK.tokenize(text)) for text in texts]
+
+
+# ------------------------------------------------------------------------------
+# Main.
+# ------------------------------------------------------------------------------
+
+
+def load_contexts(filename):
+    """Distinct paragraph contexts of a SQuAD formatted dataset."""
+    with open(filename) as f:
+        data = json.load(f)['data']
+    contexts = {}
+    for article in data:
+        for paragraph in article['paragraphs']:
+            contexts.setdefault(paragraph['context'])
+    return list(contexts)
+
+
+def build_token_store(args):
+    annotators = set(a for a in args.annotators.split(',') if a)
+    tok_class = tokenizers.get_class(args.tokenizer)
+    step = args.batch_size
+    if args.dataset:
+        contexts = load_contexts(args.db_path)
+        logger.info('Tokenizing %d contexts...' % len(contexts))
+        initargs = (tok_class, {'annotators': annotators})
+        batches = [contexts[i:i + step] for i in range(0, len(contexts), step)]
+        _tokenize = tokenize_texts
+    else:
+        db_class = retriever.get_class(args.db)
+        with db_class(args.db_path) as doc_db:
+            doc_ids = doc_db.get_doc_ids()
+        logger.info('Tokenizing %d docs...' % len(doc_ids))
+        initargs = (tok_class, {'annotators': annotators},
+                    db_class, {'db_path': args.db_path})
+        batches = [doc_ids[i:i + step] for i in range(0, len(doc_ids), step)]
+        _tokenize = partial(tokenize_docs, args.group_length)
+
+    workers = ProcessPool(args.num_workers, initializer=init,
+                          initargs=initargs)
+    with tokenizers.TokenStoreWriter(args.out_dir, tok_class,
+                                     annotators) as writer:
+        for results in tqdm(workers.imap(_tokenize, batches),
+                            total=len(batches)):
+            for text, tokens in results:
+                writer.add(text, tokens)
+    workers.close()
+    workers.join()
+
+    store = tokenizers.TokenStore(args.out_dir)
+    logger.info('Stored %d texts (%d tokens, %d strings)' %
+                (len(store), store.metadata['num_tokens'],
+                 store.metadata['num_strings']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('db_path', type=str,
+                        help='Path to the doc db (or dataset)')
+    parser.add_argument('out_dir', type=str,
+                        help='Directory to save the token store to')
+    parser.add_argument('--db', type=str, default='sqlite',
+                        help="Doc db class (e.g. 'compressed')")
+    parser.add_argument('--dataset', action='store_true',
+                        help=('db_path is a SQuAD formatted dataset: store '
+                              'its contexts'))
+    parser.add_argument('--tokenizer', type=str, default='mecab',
+                        help=("String option specifying tokenizer type to use "
+                              "(must be the one of the reader)"))
+    parser.add_argument('--annotators', type=str, default='pos,lemma,ner',
+                        help='Comma separated annotators (of the reader)')
+    parser.add_argument('--group-length', type=int, default=0,
+                        help='GROUP_LENGTH of the pipeline')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='Number of docs (or contexts) per worker task')
+    parser.add_argument('--num-workers', type=int, default=None,
+                        help='Number of CPU processes (for tokenizing, etc)')
+    args = parser.parse_args()
+
+    if os.path.exists(args.out_dir):
+        raise RuntimeError('%s already exists! Not overwriting.' %
+                           args.out_dir)
+    build_token_store(args)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""A script to convert a sqlite doc db to a compressed doc db.
+
+See drqa.retriever.CompressedDocDB for the format.
+"""
+
+import argparse
+import json
+import os
+import random
+import zlib
+import logging
+import numpy as np
+
+from tqdm import tqdm
+from drqa import retriever
+from drqa.retriever.compressed_doc_db import zstandard
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+fmt = logging.Formatter('%(asctime)s: [ %(message)s ]', '%m/%d/%Y %I:%M:%S %p')
+console = logging.StreamHandler()
+console.setFormatter(fmt)
+logger.addHandler(console)
+
+
+def get_compressor(args, db, doc_ids):
+    """Return the compress function (and dictionary) for args.codec."""
+    if args.codec == 'zlib':
+        return lambda data: zlib.compress(data, args.level), None
+    if zstandard is None:
+        raise RuntimeError('zstandard is needed for --codec zstd')
+
+    dictionary = None
+    if args.dict_size > 0:
+        samples = random.Random(0).sample(
+            doc_ids, min(args.dict_samples, len(doc_ids))
+        )
+        logger.info('Training a %d bytes dictionary on %d docs' %
+                    (args.dict_size, len(samples)))
+        dictionary = zstandard.train_dictionary(
+            args.dict_size,
+            [text.encode('utf-8') for text in db.get_doc_texts(samples)
+             if text]
+        )
+    compressor = zstandard.ZstdCompressor(level=args.level,
+                                          dict_data=dictionary)
+    return compressor.compress, dictionary
+
+
+def compress_db(args):
+    os.makedirs(args.out_dir)
+    with retriever.DocDB(args.db_path) as db:
+        doc_ids = db.get_doc_ids()
+        compress, dictionary = get_compressor(args, db, doc_ids)
+
+        doc_block = np.zeros(len(doc_ids), dtype=np.int64)
+        doc_start = np.zeros(len(doc_ids), dtype=np.int64)
+        doc_length = np.zeros(len(doc_ids), dtype=np.int64)
+        block_offsets = [0]
+        block = []
+        block_size = 0
+
+        with open(os.path.join(args.out_dir, 'blocks.bin'), 'wb') as f:
+            def flush():
+                compressed = compress(b''.join(block))
+                f.write(compressed)
+                block_offsets.append(block_offsets[-1] + len(compressed))
+
+            step = 1000
+            for i in tqdm(range(0, len(doc_ids), step)):
+                texts = db.get_doc_texts(doc_ids[i:i + step])
+                for j, text in enumerate(texts, i):
+                    data = (text or '').encode('utf-8')
+                    doc_block[j] = len(block_offsets) - 1
+                    doc_start[j] = block_size
+                    doc_length[j] = len(data)
+                    block.append(data)
+                    block_size += len(data)
+                    if block_size >= args.block_size * 1024:
+                        flush()
+                        block, block_size = [], 0
+            if block:
+                flush()
+
+    arrays = {
+        'block_offsets': np.array(block_offsets, dtype=np.int64),
+        'doc_block': doc_block,
+        'doc_start': doc_start,
+        'doc_length': doc_length,
+    }
+    arrays.update(retriever.utils.DocIdTable.build(doc_ids).to_metadata())
+    for name, array in arrays.items():
+        np.save(os.path.join(args.out_dir, name + '.npy'), array)
+    if dictionary is not None:
+        with open(os.path.join(args.out_dir, 'dictionary.bin'), 'wb') as f:
+            f.write(dictionary.as_bytes())
+    metadata = {
+        'codec': args.codec,
+        'level': args.level,
+        'block_size': args.block_size,
+        'dictionary': dictionary is not None,
+        'num_docs': len(doc_ids),
+    }
+    with open(os.path.join(args.out_dir, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f)
+
+    size = os.path.getsize(args.db_path)
+    logger.info('Compressed %d docs in %d blocks: %d -> %d bytes' %
+                (len(doc_ids), len(block_offsets) - 1, size,
+                 block_offsets[-1]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('db_path', type=str,
+                        help='Path to the sqlite db holding document texts')
+    parser.add_argument('out_dir', type=str,
+                        help='Directory to save the compressed db to')
+    parser.add_argument('--codec', type=str, default='zstd',
+                        choices=['zstd', 'zlib'])
+    parser.add_argument('--level', type=int, default=9,
+                        help='Compression level')
+    parser.add_argument('--block-size', type=int, default=16,
+                        help='Target size (KB) of blocks before compression')
+    parser.add_argument('--dict-size', type=int, default=112640,
+                        help='Size of the zstd dictionary (0 for none)')
+    parser.add_argument('--dict-samples', type=int, default=10000,
+                        help='Number of docs to train the dictionary on')
+    args = parser.parse_args()
+
+    if os.path.exists(args.out_dir):
+        raise RuntimeError('%s already exists! Not overwriting.' %
+                           args.out_dir)
+    compress_db(args)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""A script to convert a .npz tf-idf index to the memory-mappable format."""
+
+import argparse
+import os
+import logging
+
+from drqa import retriever
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+fmt = logging.Formatter('%(asctime)s: [ %(message)s ]', '%m/%d/%Y %I:%M:%S %p')
+console = logging.StreamHandler()
+console.setFormatter(fmt)
+logger.addHandler(console)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tfidf_path', type=str,
+                        help='Path to the .npz tf-idf index to convert')
+    parser.add_argument('out_dir', type=str, nargs='?', default=None,
+                        help=('Directory to save the index to (defaults to '
+                              'tfidf_path without the .npz extension)'))
+    args = parser.parse_args()
+
+    out_dir = args.out_dir or os.path.splitext(args.tfidf_path)[0]
+    if os.path.exists(out_dir):
+        raise RuntimeError('%s already exists! Not overwriting.' % out_dir)
+
+    logger.info('Loading %s' % args.tfidf_path)
+    matrix, metadata = retriever.utils.load_sparse_csr(args.tfidf_path)
+    if 'doc_dict' in metadata:
+        logger.info('Converting doc_dict to a doc id table')
+        doc_ids = retriever.utils.DocIdTable.from_metadata(metadata)
+        del metadata['doc_dict']
+        metadata.update(doc_ids.to_metadata())
+
+    logger.info('Saving to %s/' % out_dir)
+    retriever.utils.save_sparse_csr_dir(out_dir, matrix, metadata)
@@ -47,14 +47,13 @@ def regex_match(text, pattern):
     return pattern.search(text) is not None
 
 
-def has_answer(answer, doc_id, match):
-    """Check if a document contains an answer string.
+def has_answer(answer, text, match):
+    """Check if a document text contains an answer string.
 
     If `match` is string, token matching is done between the text and answer.
     If `match` is regex, we search the whole text with the regex.
     """
-    global PROCESS_DB, PROCESS_TOK
-    text = PROCESS_DB.get_doc_text(doc_id)
+    global PROCESS_TOK
     text = utils.normalize(text)
     if match == 'string':
         # Answer is a list of possible strings
@@ -76,9 +75,10 @@ def has_answer(answer, doc_id, match):
 
 def get_score(answer_doc, match):
     """Search through all the top docs to see if they have the answer."""
+    global PROCESS_DB
     answer, (doc_ids, doc_scores) = answer_doc
-    for doc_id in doc_ids:
-        if has_answer(answer, doc_id, match):
+    for text in PROCESS_DB.get_doc_texts(doc_ids):
+        if has_answer(answer, text, match):
             return 1
     return 0
 
@@ -100,6 +100,11 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('dataset', type=str, default=None)
     parser.add_argument('--model', type=str, default=None)
+    parser.add_argument('--ranker', type=str, default='tfidf',
+                        help="Ranker class (e.g. 'sharded_tfidf')")
+    parser.add_argument('--full-model', type=str, default=None,
+                        help=('Full index to compare a pruned/quantized '
+                              '--model with: report the recall lost'))
     parser.add_argument('--doc-db', type=str, default=None,
                         help='Path to Document DB')
     parser.add_argument('--tokenizer', type=str, default='regexp')
@@ -125,7 +130,7 @@ if __name__ == '__main__':
 
     # get the closest docs for each question.
     logger.info('Initializing ranker...')
-    ranker = retriever.get_class('tfidf')(tfidf_path=args.model)
+    ranker = retriever.get_class(args.ranker)(tfidf_path=args.model)
 
     logger.info('Ranking...')
     closest_docs = ranker.batch_closest_docs(
@@ -133,6 +138,15 @@ if __name__ == '__main__':
     )
     answers_docs = zip(answers, closest_docs)
 
+    if args.full_model:
+        logger.info('Ranking with the full index...')
+        full_ranker = retriever.get_class(args.ranker)(
+            tfidf_path=args.full_model
+        )
+        full_closest_docs = full_ranker.batch_closest_docs(
+            questions, k=args.n_docs, num_workers=args.num_workers
+        )
+
     # define processes
     tok_class = tokenizers.get_class(args.tokenizer)
     tok_opts = {}
@@ -148,6 +162,9 @@ if __name__ == '__main__':
     logger.info('Retrieving and computing scores...')
     get_score_partial = partial(get_score, match=args.match)
     scores = processes.map(get_score_partial, answers_docs)
+    if args.full_model:
+        full_scores = processes.map(get_score_partial,
+                                    zip(answers, full_closest_docs))
 
     filename = os.path.basename(args.dataset)
     stats = (
@@ -167,3 +184,25 @@ if __name__ == '__main__':
     )
 
     print(stats)
+
+    if args.full_model:
+        # Fraction of the docs retrieved by the full index that are kept
+        overlaps = [
+            len(set(docs[0]) & set(full_docs[0])) / len(full_docs[0])
+            for docs, full_docs in zip(closest_docs, full_closest_docs)
+            if len(full_docs[0]) > 0
+        ]
+        full_p = sum(full_scores) / len(full_scores) * 100
+        stats = (
+            "Full index {full_model}\n" +
+            "Match % in top {k}:\t\t{p:2.2f}\n" +
+            "Match % lost:\t\t\t{lost:2.2f}\n" +
+            "Recall@{k} of full index docs:\t{r:2.2f}\n"
+        ).format(
+            full_model=args.full_model,
+            k=args.n_docs,
+            p=full_p,
+            lost=full_p - sum(scores) / len(scores) * 100,
+            r=sum(overlaps) / max(len(overlaps), 1) * 100,
+        )
+        print(stats)
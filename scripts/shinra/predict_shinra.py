@@ -51,6 +51,14 @@ parser.add_argument('--tokenizer', type=str, default=None,
                           "(e.g. 'corenlp')"))
 parser.add_argument('--num-workers', type=int, default=None,
                     help='Number of CPU processes (for tokenizing, etc)')
+parser.add_argument('--tokenizer-cache', type=str, default=None,
+                    help='Path to an on-disk cache of tokenized texts')
+parser.add_argument('--token-store', type=str, default=None,
+                    help=('Path to a store of pre-tokenized texts (see '
+                          'scripts/retriever/build_token_store.py)'))
+parser.add_argument('--feature-store', type=str, default=None,
+                    help=('Path to the precomputed model inputs of the token '
+                          'store (see scripts/reader/build_feature_store.py)'))
 parser.add_argument('--no-cuda', action='store_true',
                     help='Use CPU only')
 parser.add_argument('--gpu', type=int, default=-1,
@@ -65,6 +73,10 @@ parser.add_argument('--addtitle', type='bool', default=True,
                       help='add title to question string')
 parser.add_argument('--multiple-answer', type='bool', default=False,
                       help='Use multiple answer model')
+parser.add_argument('--multi-question', type='bool', default=True,
+                      help=('Encode each article once and score all of its '
+                            'attribute questions against it (--batch-size '
+                            'then counts articles)'))
 args = parser.parse_args()
 t0 = time.time()
 
@@ -80,6 +92,9 @@ predictor = Predictor(
     tokenizer=args.tokenizer,
     embedding_file=args.embedding_file,
     num_workers=args.num_workers,
+    tokenizer_cache=args.tokenizer_cache,
+    token_store=args.token_store,
+    feature_store=args.feature_store,
 )
 if args.cuda:
     predictor.cuda()
@@ -100,6 +115,7 @@ examples = []
 questions = []
 answer_attr = OrderedDict()
 wiki_ids = []
+groups = []
 
 with open(args.dataset) as f:
     data = json.load(f)['data']
@@ -113,6 +129,7 @@ with open(args.dataset) as f:
             context = paragraph['context']
             #if len(context) > 50000:
             #    context = context[:50000]
+            group = []
             for attr in attrs:
                 questions.append(attr)
                 wiki_ids.append(wiki_id)
@@ -120,14 +137,27 @@ with open(args.dataset) as f:
                     q = title+'の'+attr+'は？'
                 else:
                     q = attr
+                group.append(len(examples))
                 examples.append((context, q))
-
-for i in tqdm(range(0, len(examples), args.batch_size)):
-    predictions = predictor.predict_batch(
-        examples[i:i + args.batch_size], top_n=args.top_n)
-    for j in range(len(predictions)):
-        #answer_attr[wiki_ids[i+j]]['Attributes'][examples[i+j][1]].append(predictions[j][0][0])
-        answer_attr[wiki_ids[i+j]]['Attributes'][questions[i+j]] = [(p[0], float(p[1])) for p in predictions[j]]
+            groups.append((context, group))
+
+if args.multi_question:
+    for i in tqdm(range(0, len(groups), args.batch_size)):
+        batch = groups[i:i + args.batch_size]
+        predictions = predictor.predict_multi_batch(
+            [(context, [examples[k][1] for k in group])
+             for context, group in batch],
+            top_n=args.top_n)
+        for (_, group), group_predictions in zip(batch, predictions):
+            for k, prediction in zip(group, group_predictions):
+                answer_attr[wiki_ids[k]]['Attributes'][questions[k]] = [(p[0], float(p[1])) for p in prediction]
+else:
+    for i in tqdm(range(0, len(examples), args.batch_size)):
+        predictions = predictor.predict_batch(
+            examples[i:i + args.batch_size], top_n=args.top_n)
+        for j in range(len(predictions)):
+            #answer_attr[wiki_ids[i+j]]['Attributes'][examples[i+j][1]].append(predictions[j][0][0])
+            answer_attr[wiki_ids[i+j]]['Attributes'][questions[i+j]] = [(p[0], float(p[1])) for p in predictions[j]]
 
 model = os.path.splitext(os.path.basename(args.model or 'default'))[0]
 basename = os.path.splitext(os.path.basename(args.dataset))[0]
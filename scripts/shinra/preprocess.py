@@ -13,28 +13,38 @@ import sys
 import json
 import time
 
+from collections import deque
 from multiprocessing import Pool
 from multiprocessing.util import Finalize
-from functools import partial
+from threading import Event, Semaphore
 from drqa import tokenizers
+from drqa.reader import utils
+from drqa.reader.example_store import ExampleStoreWriter
 
 # ------------------------------------------------------------------------------
 # Tokenize + annotate.
 # ------------------------------------------------------------------------------
 
 TOK = None
+Q_TOK = None
 
 
 def init(tokenizer_class, options):
-    global TOK
-    TOK = tokenizer_class(**options)
+    """Start a tokenizer for contexts (lemma, pos, ner) and one for questions
+    (lemma only).
+    """
+    global TOK, Q_TOK
+    TOK = tokenizer_class(annotators={'lemma', 'pos', 'ner'}, **options)
     Finalize(TOK, TOK.shutdown, exitpriority=100)
+    Q_TOK = tokenizer_class(annotators={'lemma'}, **options)
+    Finalize(Q_TOK, Q_TOK.shutdown, exitpriority=100)
 
 
-def tokenize(text):
-    """Call the global process tokenizer on the input text."""
-    global TOK
-    tokens = TOK.tokenize(text)
+def tokenize(text, question=False):
+    """Call the global process tokenizer (of questions, if question) on the
+    input text.
+    """
+    tokens = (Q_TOK if question else TOK).tokenize(text)
     output = {
         'words': tokens.words(),
         'offsets': tokens.offsets(),
@@ -52,22 +62,19 @@ def tokenize(text):
 
 
 def load_dataset(path):
-    """Load json file and store fields separately."""
-    with open(path) as f:
-        data = json.load(f)['data']
-    output = {'qids': [], 'questions': [], 'answers': [],
-              'contexts': [], 'qid2cid': [], 'page_id': []}
-    for article in data:
+    """Iterate the paragraphs of a json file, reading it incrementally. Each
+    paragraph is a dict of its context, qids, questions, answers and page_id.
+    """
+    for article in utils.iter_articles(path):
         for paragraph in article['paragraphs']:
-            output['contexts'].append(paragraph['context'])
-            output['page_id'].append(article['WikipediaID'])
+            output = {'context': paragraph['context'], 'qids': [],
+                      'questions': [], 'answers': [],
+                      'page_id': article['WikipediaID']}
             for qa in paragraph['qas']:
                 output['qids'].append(qa['id'])
                 output['questions'].append(qa['question'])
-                output['qid2cid'].append(len(output['contexts']) - 1)
-                if 'answers' in qa:
-                    output['answers'].append(qa['answers'])
-    return output
+                output['answers'].append(qa.get('answers', []))
+            yield output
 
 def find_answer(offset_line_id, answer_start, answer_end):
     """Match token offsets with the char begin/end offsets of the answer."""
@@ -89,71 +96,120 @@ def set_answer_to_offsets(offsets, answers):
 		answer_offsets[ans[0]:ans[1]+1] = [1] * (ans[1]-ans[0]+1)
 	return answer_offsets
   
-def process_dataset(data, tokenizer, workers=None):
-    """Iterate processing (tokenize, parse, etc) dataset multithreaded."""
+def tokenize_paragraph(texts):
+    """Tokenize the (context, questions) of a paragraph."""
+    context, questions = texts
+    return tokenize(context), [tokenize(q, question=True) for q in questions]
+
+
+def process_dataset(data, tokenizer, workers=None, cache=None,
+                    dedup_contexts=False, buffer_size=1000):
+    """Iterate processing (tokenize, parse, etc) dataset multithreaded.
+
+    Paragraphs are read, tokenized and yielded as a stream, in order, with at
+    most buffer_size of them in flight.
+
+    With dedup_contexts, each context (document, offsets, lemma, pos, ner) is
+    yielded once, with a 'context_id', before its first example, and examples
+    only reference it by 'context_id' (see drqa.reader.utils.read_examples).
+    Their answer_offsets are not written either, but rebuilt from the answers.
+    """
+    num_workers = workers or os.cpu_count() or 1
     tokenizer_class = tokenizers.get_class(tokenizer)
-    make_pool = partial(Pool, workers, initializer=init)
-    workers = make_pool(initargs=(tokenizer_class, {'annotators': {'lemma'}}))
-    q_tokens = workers.map(tokenize, data['questions'])
-    workers.close()
-    workers.join()
+    options = {}
+    if cache:
+        options = {'tokenizer_class': tokenizer_class, 'cache_path': cache}
+        tokenizer_class = tokenizers.CachedTokenizer
+    workers = Pool(workers, initializer=init,
+                   initargs=(tokenizer_class, options))
 
-    workers = make_pool(
-        initargs=(tokenizer_class, {'annotators': {'lemma', 'pos', 'ner'}})
-    )
-    c_tokens = workers.map(tokenize, data['contexts'])
-    
-    #offsets_lineid = dict()
-    #for i, cnt in enumerate(data['contexts']):
-    #    offsets_lineid[data['page_id'][i]] = line_id_to_offset(cnt, c_tokens[i]['offsets'])
-    
+    # imap reads its input in a separate thread, as fast as it can: the
+    # semaphore bounds the paragraphs that are read but not yet written.
+    # Paragraphs are sent to the workers in chunks (about 4 in flight per
+    # worker), which must be smaller than the buffer.
+    paragraphs = deque()
+    slots = Semaphore(buffer_size)
+    stopped = Event()
+    chunksize = max(1, buffer_size // (4 * num_workers))
+
+    def feed():
+        for paragraph in data:
+            slots.acquire()
+            if stopped.is_set():
+                return
+            paragraphs.append(paragraph)
+            yield paragraph['context'], paragraph['questions']
+
+    try:
+        results = workers.imap(tokenize_paragraph, feed(), chunksize)
+        for cid, (c_tokens, q_tokens) in enumerate(results):
+            paragraph = paragraphs.popleft()
+            slots.release()
+            document = c_tokens['words']
+            offsets = c_tokens['offsets']
+            line_offsets = c_tokens['line_offsets']
+            lemma = c_tokens['lemma']
+            pos = c_tokens['pos']
+            ner = c_tokens['ner']
+            if dedup_contexts and paragraph['qids']:
+                context = {
+                    'context_id': cid,
+                    'document': document,
+                    'offsets': offsets,
+                    'lemma': lemma,
+                    'pos': pos,
+                    'ner': ner,
+                }
+                if args.multiple_answer:
+                    # Rebuilt from the answers of each example when loaded.
+                    context['answer_offsets'] = True
+                yield context
+            for idx in range(len(paragraph['qids'])):
+                question = q_tokens[idx]['words']
+                qlemma = q_tokens[idx]['lemma']
+                ans_tokens = []
+                for ans in paragraph['answers'][idx]:
+                    found = find_answer(line_offsets,
+                                        ans['answer_start'],
+                                        ans['answer_end'])
+                    if found:
+                        ans_tokens.append(found)
+                if dedup_contexts:
+                    ex = {
+                        'id': paragraph['qids'][idx],
+                        'question': question,
+                        'context_id': cid,
+                        'answers': ans_tokens,
+                        'qlemma': qlemma,
+                    }
+                else:
+                    ex = {
+                        'id': paragraph['qids'][idx],
+                        'question': question,
+                        'document': document,
+                        'offsets': offsets,
+                        'answers': ans_tokens,
+                        'qlemma': qlemma,
+                        'lemma': lemma,
+                        'pos': pos,
+                        'ner': ner,
+                    }
+                if args.multiple_answer and not dedup_contexts:
+                    ex['answer_offsets'] = set_answer_to_offsets(offsets,
+                                                                 ans_tokens)
+                yield ex
+    except BaseException:
+        # On failure (or if the caller stops early), wake the feeding
+        # thread up so that the pool can be terminated.
+        stopped.set()
+        slots.release()
+        workers.terminate()
+        workers.join()
+        raise
+    # Let the workers exit (and shut their tokenizers down) normally
     workers.close()
     workers.join()
 
-    for idx in range(len(data['qids'])):
-        question = q_tokens[idx]['words']
-        qlemma = q_tokens[idx]['lemma']
-        document = c_tokens[data['qid2cid'][idx]]['words']
-        offsets = c_tokens[data['qid2cid'][idx]]['offsets']
-        line_offsets = c_tokens[data['qid2cid'][idx]]['line_offsets']
-        lemma = c_tokens[data['qid2cid'][idx]]['lemma']
-        pos = c_tokens[data['qid2cid'][idx]]['pos']
-        ner = c_tokens[data['qid2cid'][idx]]['ner']
-        ans_tokens = []
-        if len(data['answers']) > 0:
-            for ans in data['answers'][idx]:
-                found = find_answer(line_offsets,
-                                    ans['answer_start'],
-                                    ans['answer_end'])
-                if found:
-                    ans_tokens.append(found)
-        if args.multiple_answer:
-            answer_offsets = set_answer_to_offsets(offsets,ans_tokens)
-            yield {
-                'id': data['qids'][idx],
-                'question': question,
-                'document': document,
-                'offsets': offsets,
-                'answers': ans_tokens,
-                'answer_offsets': answer_offsets,
-                'qlemma': qlemma,
-                'lemma': lemma,
-                'pos': pos,
-                'ner': ner,
-            }
-        else:
-            yield {
-                'id': data['qids'][idx],
-                'question': question,
-                'document': document,
-                'offsets': offsets,
-                'answers': ans_tokens,
-                'qlemma': qlemma,
-                'lemma': lemma,
-                'pos': pos,
-                'ner': ner,
-            }
-
 
 # -----------------------------------------------------------------------------
 # Commandline options
@@ -167,8 +223,19 @@ parser.add_argument('--split', type=str, help='Filename for train/dev split',
                     default='SQuAD-v1.1-train')
 parser.add_argument('--workers', type=int, default=None)
 parser.add_argument('--tokenizer', type=str, default='corenlp')
+parser.add_argument('--tokenizer-cache', type=str, default=None,
+                    help='Path to an on-disk cache of tokenized texts')
 parser.add_argument('--multiple-answer', action='store_true', help='Use multiple answer model')
+parser.add_argument('--buffer-size', type=int, default=1000,
+                    help='Max number of paragraphs read but not yet written')
+parser.add_argument('--format', type=str, default='json',
+                    choices=['json', 'binary'],
+                    help='JSON lines, or a memory-mapped binary directory')
+parser.add_argument('--dedup-contexts', action='store_true',
+                    help='JSON lines: write each context once, on its own line')
 args = parser.parse_args()
+if args.buffer_size < 1:
+    parser.error('--buffer-size must be at least 1')
 
 t0 = time.time()
 
@@ -177,10 +244,22 @@ print('Loading dataset %s' % in_file, file=sys.stderr)
 dataset = load_dataset(in_file)
 
 out_file = os.path.join(
-    args.out_dir, '%s-processed-%s.txt' % (args.split, args.tokenizer)
+    args.out_dir, '%s-processed-%s' % (args.split, args.tokenizer)
 )
-print('Will write to file %s' % out_file, file=sys.stderr)
-with open(out_file, 'w') as f:
-    for ex in process_dataset(dataset, args.tokenizer, args.workers):
-        f.write(json.dumps(ex, ensure_ascii=False) + '\n')
+if args.format == 'binary':
+    print('Will write to directory %s' % out_file, file=sys.stderr)
+    with ExampleStoreWriter(out_file) as writer:
+        # Contexts are written once, keyed by paragraph.
+        for ex in process_dataset(dataset, args.tokenizer, args.workers,
+                                  args.tokenizer_cache, dedup_contexts=True,
+                                  buffer_size=args.buffer_size):
+            writer.add(ex)
+else:
+    out_file += '.txt'
+    print('Will write to file %s' % out_file, file=sys.stderr)
+    with open(out_file, 'w') as f:
+        for ex in process_dataset(dataset, args.tokenizer, args.workers,
+                                  args.tokenizer_cache, args.dedup_contexts,
+                                  args.buffer_size):
+            f.write(json.dumps(ex, ensure_ascii=False) + '\n')
 print('Total time: %.4f (s)' % (time.time() - t0))